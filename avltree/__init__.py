@@ -0,0 +1,73 @@
+"""
+AVL trees with a common interface.
+
+The backend is imported the first time `AVLTree` is used, so that
+importing the package is cheap. By default the C module is used if it
+can be imported, otherwise the optimized pure Python module. Set the
+environment variable AVLTREE_BACKEND to one of BACKENDS to choose.
+"""
+
+import importlib
+import os
+
+__all__ = [ 'AVLTree', 'PersistentTree', 'BACKENDS', 'backend' ]
+
+BACKENDS = {
+    'c':      'cavltree',
+    'python': 'pyavltree',
+}
+
+PREFERENCE = [ 'c', 'python' ]
+
+EXPORTS = [ 'AVLTree', 'PersistentTree' ]
+
+_backend = None
+
+
+def backend() -> str:
+    """
+    Return name of the selected backend, importing it if needed.
+    """
+    global _backend
+
+    if _backend is not None:
+        return _backend
+
+    name = os.environ.get('AVLTREE_BACKEND')
+
+    if name:
+        if name not in BACKENDS:
+            raise ImportError(f'AVLTREE_BACKEND: unknown backend: {name!r}')
+
+        module = importlib.import_module(BACKENDS[name])
+
+    else:
+        for name in PREFERENCE:
+            try:
+                module = importlib.import_module(BACKENDS[name])
+                break
+
+            except ImportError:
+                continue
+
+        else:
+            raise ImportError('no avltree backend available')
+
+    for export in EXPORTS:
+        globals()[export] = getattr(module, export)
+
+    _backend = name
+
+    return _backend
+
+
+def __getattr__(name: str):
+    if name in EXPORTS:
+        backend()
+        return globals()[name]
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(EXPORTS))
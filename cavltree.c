@@ -2,41 +2,152 @@
 
 #include <Python.h>
 
+#include <math.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+#ifdef Py_GIL_DISABLED
+#include <pthread.h>
+#endif
+
+
+/* Per-tree reader-writer lock.
+ *
+ * With the GIL, the interpreter serializes all access and the lock
+ * compiles away. Without it, lookups and iteration take the lock
+ * shared and modifications take it exclusive. A thread blocks with
+ * its thread state detached, so it does not hold up the GC. Note
+ * that the lock is not re-entrant: element comparisons must not
+ * modify the tree being operated on.
+ */
+#ifdef Py_GIL_DISABLED
+typedef pthread_rwlock_t RWLock;
+
+#define RWLOCK_INIT(l)     pthread_rwlock_init((l), NULL)
+#define RWLOCK_DESTROY(l)  pthread_rwlock_destroy(l)
+#define RWLOCK_RELEASE(l)  pthread_rwlock_unlock(l)
+
+#define RWLOCK_ACQUIRE(l, try, wait)		\
+    do {					\
+	if (try(l) != 0) {			\
+	    Py_BEGIN_ALLOW_THREADS		\
+	    wait(l);				\
+	    Py_END_ALLOW_THREADS		\
+	}					\
+    } while(0)
+
+#define RWLOCK_READ(l)  RWLOCK_ACQUIRE((l), pthread_rwlock_tryrdlock, pthread_rwlock_rdlock)
+#define RWLOCK_WRITE(l) RWLOCK_ACQUIRE((l), pthread_rwlock_trywrlock, pthread_rwlock_wrlock)
+#else
+typedef char RWLock;
+
+#define RWLOCK_INIT(l)     ((void) (l))
+#define RWLOCK_DESTROY(l)  ((void) (l))
+#define RWLOCK_RELEASE(l)  ((void) (l))
+#define RWLOCK_READ(l)     ((void) (l))
+#define RWLOCK_WRITE(l)    ((void) (l))
+#endif
 
-/* Tree node.
+
+/* Tree node. Besides the tree links, nodes are threaded in order
+ * through prev and next. Rotations do not change the order, so only
+ * insert and delete need to maintain the thread.
  */
 struct Node {
     PyObject     *element;
     struct Node  *left;
     struct Node  *right;
+    struct Node  *prev;
+    struct Node  *next;
     unsigned int  height;
 };
 
 
+/* Operation counters of a tree, allocated when collection is turned
+ * on. Updates are inserts and deletes that changed the tree, and
+ * unwind counts the ancestors visited while rebalancing after them.
+ * The callback is called every interval updates.
+ */
+struct Stats {
+    uint64_t   comparisons;
+    uint64_t   rotations;
+    uint64_t   double_rotations;
+    uint64_t   allocs;
+    uint64_t   frees;
+    uint64_t   updates;
+    uint64_t   unwind;
+    uint64_t   unwind_max;
+    uint64_t   interval;
+    uint64_t   notified;
+    PyObject  *callback;
+};
+
+
 /* AVLTree class
  */
 struct AVLTree {
     PyObject_HEAD
 
-    struct Node *root;
+    struct Node   *root;
+    struct Node   *first;
+    struct Node   *last;
+    struct Stats  *stats;
+    PyObject      *index;
+    Py_ssize_t     count;
+    RWLock         lock;
+    unsigned int   version;
 };
 
 
-/* Entry state.
+/* Counting is compiled in unless AVLTREE_STATS is defined as 0, and
+ * costs a test of the stats pointer when collection is off. Readers
+ * count comparisons concurrently under the shared lock, so without
+ * the GIL the adds are atomic.
+ */
+#ifndef AVLTREE_STATS
+#define AVLTREE_STATS 1
+#endif
+
+#if !AVLTREE_STATS
+#define STATS_ADD(tree, field, n) ((void) 0)
+#elif defined(Py_GIL_DISABLED)
+#define STATS_ADD(tree, field, n)					\
+    ((tree)->stats != NULL ? (void) __atomic_add_fetch(&(tree)->stats->field, (n), __ATOMIC_RELAXED) : (void) 0)
+#else
+#define STATS_ADD(tree, field, n)					\
+    ((tree)->stats != NULL ? (void) ((tree)->stats->field += (n)) : (void) 0)
+#endif
+
+#define TREE_LT(tree, a, b)						\
+    (STATS_ADD((tree), comparisons, 1), PyObject_RichCompareBool((a), (b), Py_LT))
+
+
+/* Numbers read from a buffer, widened to 64 bits so that they can be
+ * sorted and linked into a tree without the GIL.
  */
-enum State {
-    STATE_LEFT,
-    STATE_ELEMENT,
-    STATE_RIGHT,
-    STATE_UP,
+enum Kind {
+    KIND_SIGNED,
+    KIND_UNSIGNED,
+    KIND_FLOAT,
+};
+
+union Value {
+    long long           i;
+    unsigned long long  u;
+    double              d;
 };
 
 
-/* Iterator entry
+/* Long bulk operations let other threads, such as an event loop,
+ * run every UPDATE_CHUNK elements.
  */
-struct Entry {
-    struct Node  *node;
-    enum State    state;
+enum Update {
+    UPDATE_CHUNK = 65536,
 };
 
 
@@ -53,22 +164,257 @@ struct Iterator {
     PyObject_HEAD
 
     struct AVLTree  *tree;
-    struct Entry     stack[STACK_MAX];
-    unsigned int     count;
+    struct Node     *node;
+    PyObject        *stop;
+    Py_ssize_t       remaining;
+    unsigned int     version;
+    int              reverse;
+};
+
+
+/* File offset of a mapped node (0 ==> none).
+ */
+typedef uint64_t Offset;
+
+
+/* Mapped file header, stored at offset 0.
+ */
+struct MappedHeader {
+    char      magic[8];
+    Offset    root;
+    Offset    free;
+    Offset    end;
+    uint64_t  count;
+    uint64_t  reserved[3];
+};
+
+
+/* Mapped tree node. Same layout as `struct Node', but with file
+ * offsets instead of pointers and an unsigned 64-bit element.
+ */
+struct MappedNode {
+    uint64_t  element;
+    Offset    left;
+    Offset    right;
+    uint32_t  height;
+    uint32_t  reserved;
+};
+
+
+/* Mapped file parameters.
+ */
+enum Mapped {
+    MAPPED_INITIAL = 1024, /* nodes */
+};
+
+
+static const char MAPPED_MAGIC[8] = "AVLTREE";
+
+
+/* MappedTree class
+ */
+struct MappedTree {
+    PyObject_HEAD
+
+    int          fd;
+    char        *base;
+    size_t       size;
+    unsigned int version;
+    RWLock       lock;
+};
+
+
+/* Mapped tree iterator.
+ */
+struct MappedIterator {
+    PyObject_HEAD
+
+    struct MappedTree  *tree;
+    Offset              stack[STACK_MAX];
+    unsigned int        count;
+    unsigned int        version;
+};
+
+
+/* Persistent tree node. Nodes never change once they are part of a
+ * tree, so trees share them and they are reference counted: refs is
+ * the number of parents and trees that point to the node.
+ */
+struct PersistentNode {
+    PyObject               *element;
+    struct PersistentNode  *left;
+    struct PersistentNode  *right;
+    Py_ssize_t              refs;
+    unsigned int            height;
+};
+
+
+/* PersistentTree class. Immutable, so there is no lock.
+ */
+struct PersistentTree {
+    PyObject_HEAD
+
+    struct PersistentNode  *root;
+    Py_ssize_t              count;
+};
+
+
+/* Persistent tree iterator.
+ */
+struct PersistentIterator {
+    PyObject_HEAD
+
+    struct PersistentTree  *tree;
+    struct PersistentNode  *stack[STACK_MAX];
+    unsigned int            count;
+    PyObject               *stop;
+    Py_ssize_t              remaining;
+    int                     reverse;
+};
+
+
+/* In-order walk for diff. An entry is either a subtree that has not
+ * been visited, or an expanded node whose left subtree is done.
+ */
+struct DiffCursor {
+    struct PersistentNode  *node[STACK_MAX];
+    char                    expanded[STACK_MAX];
+    unsigned int            count;
+};
+
+
+/* Persistent node reference counts. The last tree to let go of a
+ * node may be in another thread when the GIL is disabled.
+ */
+#ifdef Py_GIL_DISABLED
+#define PNODE_INCREF(n)  ((void) __atomic_add_fetch(&(n)->refs, 1, __ATOMIC_RELAXED))
+#define PNODE_DECREF(n)  (__atomic_sub_fetch(&(n)->refs, 1, __ATOMIC_ACQ_REL) == 0)
+#define PNODE_SHARED(n)  (__atomic_load_n(&(n)->refs, __ATOMIC_ACQUIRE) > 1)
+#else
+#define PNODE_INCREF(n)  ((void) ++(n)->refs)
+#define PNODE_DECREF(n)  (--(n)->refs == 0)
+#define PNODE_SHARED(n)  ((n)->refs > 1)
+#endif
+
+#define PNODE_XINCREF(n)			\
+    do {					\
+	if ((n) != NULL) {			\
+	    PNODE_INCREF(n);			\
+	}					\
+    } while(0)
+
+
+/* Module state.
+ */
+struct ModuleState {
+    PyTypeObject *avltree_type;
+    PyTypeObject *iterator_type;
+    PyTypeObject *mappedtree_type;
+    PyTypeObject *mappediterator_type;
+    PyTypeObject *persistenttree_type;
+    PyTypeObject *persistentiterator_type;
 };
 
 
+#define MAPPED_HEADER(tree) ((struct MappedHeader *) (tree)->base)
+#define MAPPED_NODE(tree, off) ((struct MappedNode *) ((tree)->base + (off)))
+#define MAPPED_REF(tree, off) ((Offset *) ((tree)->base + (off)))
+
+
+static int cavltree_exec(PyObject *m);
+static int cavltree_traverse(PyObject *m, visitproc visit, void *arg);
+static int cavltree_clear(PyObject *m);
+static struct ModuleState *type_state(PyTypeObject *type);
+static inline int parse_args(const char *name, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+			     const char *const *kwds, Py_ssize_t count, Py_ssize_t required, PyObject **values);
+
+static PyObject *AVLTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs);
+static PyObject *AVLTree_vectorcall(PyObject *type, PyObject *const *args, size_t nargsf, PyObject *kwnames);
 static int AVLTree_init(struct AVLTree *self, PyObject *args, PyObject *kwargs);
 static void AVLTree_dealloc(struct AVLTree *self);
 static PyObject *AVLTree_iter(struct AVLTree *self);
-static PyObject *AVLTree_insert(struct AVLTree *self, PyObject *element);
-static PyObject *AVLTree_delete(struct AVLTree *self, PyObject *element);
+static PyObject *AVLTree_reversed(struct AVLTree *self, PyObject *);
+static Py_ssize_t AVLTree_len(struct AVLTree *self);
+static int AVLTree_contains(struct AVLTree *self, PyObject *element);
+static PyObject *AVLTree_get(struct AVLTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *AVLTree_insert(struct AVLTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *AVLTree_delete(struct AVLTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *AVLTree_range(struct AVLTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *AVLTree_pop_until(struct AVLTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *AVLTree_pop_expired(struct AVLTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *AVLTree_next_deadline(struct AVLTree *self, PyObject *);
+static PyObject *AVLTree_update(struct AVLTree *self, PyObject *iterable);
+static PyObject *AVLTree_aupdate(struct AVLTree *self, PyObject *iterable);
+static PyObject *AVLTree_build_sorted(PyTypeObject *type, PyObject *buffer);
+static PyObject *AVLTree_abuild_sorted(PyTypeObject *type, PyObject *buffer);
 static PyObject *AVLTree_to_tuple(struct AVLTree *self, PyObject *);
+static PyObject *AVLTree_to_list(struct AVLTree *self, PyObject *);
 static PyObject *AVLTree_getheight(struct AVLTree *self, void *);
+static PyObject *AVLTree_stats(struct AVLTree *self, PyObject *);
+static PyObject *AVLTree_reset_stats(struct AVLTree *self, PyObject *);
+static PyObject *AVLTree_set_stats_callback(struct AVLTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *AVLTree_getcollect_stats(struct AVLTree *self, void *);
+static int AVLTree_setcollect_stats(struct AVLTree *self, PyObject *value, void *);
+static PyObject *AVLTree_getindexed(struct AVLTree *self, void *);
+static int AVLTree_setindexed(struct AVLTree *self, PyObject *value, void *);
+static PyObject *AVLTree_sizeof(struct AVLTree *self, PyObject *);
 
 static int Iterator_init(struct Iterator *self, PyObject *args, PyObject *kwargs);
 static void Iterator_dealloc(struct Iterator *self);
 static PyObject *Iterator_next(struct Iterator *self);
+static PyObject *Iterator_length_hint(struct Iterator *self, PyObject *);
+
+static PyObject *MappedTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs);
+static int MappedTree_init(struct MappedTree *self, PyObject *args, PyObject *kwargs);
+static void MappedTree_dealloc(struct MappedTree *self);
+static PyObject *MappedTree_iter(struct MappedTree *self);
+static Py_ssize_t MappedTree_len(struct MappedTree *self);
+static int MappedTree_contains(struct MappedTree *self, PyObject *element);
+static PyObject *MappedTree_insert(struct MappedTree *self, PyObject *element);
+static PyObject *MappedTree_delete(struct MappedTree *self, PyObject *element);
+static PyObject *MappedTree_to_tuple(struct MappedTree *self, PyObject *);
+static PyObject *MappedTree_flush(struct MappedTree *self, PyObject *);
+static PyObject *MappedTree_sync(struct MappedTree *self, PyObject *);
+static PyObject *MappedTree_close(struct MappedTree *self, PyObject *);
+static PyObject *MappedTree_enter(struct MappedTree *self, PyObject *);
+static PyObject *MappedTree_exit(struct MappedTree *self, PyObject *);
+static PyObject *MappedTree_getheight(struct MappedTree *self, void *);
+
+static void MappedIterator_dealloc(struct MappedIterator *self);
+static PyObject *MappedIterator_next(struct MappedIterator *self);
+
+static PyObject *PersistentTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs);
+static void PersistentTree_dealloc(struct PersistentTree *self);
+static PyObject *PersistentTree_iter(struct PersistentTree *self);
+static PyObject *PersistentTree_reversed(struct PersistentTree *self, PyObject *);
+static Py_ssize_t PersistentTree_len(struct PersistentTree *self);
+static int PersistentTree_contains(struct PersistentTree *self, PyObject *element);
+static PyObject *PersistentTree_insert(struct PersistentTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *PersistentTree_delete(struct PersistentTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *PersistentTree_range(struct PersistentTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *PersistentTree_diff(struct PersistentTree *self, PyObject *other);
+static PyObject *PersistentTree_to_tuple(struct PersistentTree *self, PyObject *);
+static PyObject *PersistentTree_to_list(struct PersistentTree *self, PyObject *);
+static PyObject *PersistentTree_getheight(struct PersistentTree *self, void *);
+
+static void PersistentIterator_dealloc(struct PersistentIterator *self);
+static PyObject *PersistentIterator_next(struct PersistentIterator *self);
+static PyObject *PersistentIterator_length_hint(struct PersistentIterator *self, PyObject *);
+
+static int tree_update(struct AVLTree *self, PyObject *iterable);
+static int tree_build(struct AVLTree *self, union Value *values, Py_ssize_t count, enum Kind kind);
+static PyObject *tree_insert(struct AVLTree *self, PyObject *element, int replace);
+static PyObject *tree_delete(struct AVLTree *self, PyObject *element);
+static PyObject *tree_pop(struct AVLTree *self, PyObject *bound, int inclusive);
+
+static int stats_enable(struct AVLTree *self, int enable);
+static inline void stats_update(struct AVLTree *self, unsigned int unwind);
+static inline int stats_due(struct AVLTree *self);
+static void stats_notify(struct AVLTree *self);
+static PyObject *stats_dict(struct Stats *stats);
+
+static int index_enable(struct AVLTree *self, int enable);
+static void index_discard(struct AVLTree *self, PyObject *element);
 
 static struct Node *node_alloc(PyObject *element);
 static void node_dealloc(struct Node *node);
@@ -77,8 +423,60 @@ static unsigned int node_update_height(struct Node *node);
 static inline int node_balance_factor(struct Node *node);
 static struct Node *node_rotate_left(struct Node *node);
 static struct Node *node_rotate_right(struct Node *node);
+static struct Node *node_balance(struct AVLTree *self, struct Node *node);
+static struct Node *node_join(struct AVLTree *self, struct Node *left, struct Node *node, struct Node *right);
+static struct Node *node_build(struct Node **nodes, Py_ssize_t count);
 static PyObject *node_to_tuple(struct Node *node);
 
+static int value_compare_signed(const void *a, const void *b);
+static int value_compare_unsigned(const void *a, const void *b);
+static int value_compare_float(const void *a, const void *b);
+static int buffer_values(PyObject *buffer, int sorted, union Value **values, Py_ssize_t *count, enum Kind *kind);
+static PyObject *value_object(union Value value, enum Kind kind);
+static inline void yield_gil(void);
+static PyObject *run_in_executor(PyObject *func, PyObject *arg);
+
+static PyObject *mapped_insert(struct MappedTree *self, PyObject *element);
+static PyObject *mapped_delete(struct MappedTree *self, PyObject *element);
+static void mapped_close(struct MappedTree *self);
+static int mapped_check(struct MappedTree *self);
+static int mapped_valid(struct MappedTree *self);
+static inline int mapped_slot(struct MappedTree *self, Offset off);
+static int mapped_grow(struct MappedTree *self);
+static Offset mnode_alloc(struct MappedTree *self, uint64_t element);
+static void mnode_free(struct MappedTree *self, Offset node);
+static inline unsigned int mnode_height(struct MappedTree *self, Offset node);
+static unsigned int mnode_update_height(struct MappedTree *self, Offset node);
+static inline int mnode_balance_factor(struct MappedTree *self, Offset node);
+static Offset mnode_rotate_left(struct MappedTree *self, Offset node);
+static Offset mnode_rotate_right(struct MappedTree *self, Offset node);
+static void mnode_unwind(struct MappedTree *self, Offset *stack, unsigned int count);
+static PyObject *mnode_to_tuple(struct MappedTree *self, Offset node, unsigned int depth);
+
+static PyObject *persistent_alloc(PyTypeObject *type, struct PersistentNode *root, Py_ssize_t count);
+static PyObject *persistent_iter(struct PersistentTree *self, PyObject *lo, PyObject *hi, int reverse);
+static inline int parse_range(PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+			      PyObject **lo, PyObject **hi, int *reverse);
+static int diff_push(struct DiffCursor *cursor, struct PersistentNode *node);
+static int diff_expand(struct DiffCursor *cursor);
+static int diff_advance(struct DiffCursor *cursor);
+
+static struct PersistentNode *pnode_alloc(PyObject *element, struct PersistentNode *left, struct PersistentNode *right);
+static void pnode_release(struct PersistentNode *node);
+static struct PersistentNode *pnode_own(struct PersistentNode *node);
+static inline unsigned int pnode_height(struct PersistentNode *node);
+static void pnode_update_height(struct PersistentNode *node);
+static inline int pnode_balance_factor(struct PersistentNode *node);
+static struct PersistentNode *pnode_rotate_left(struct PersistentNode *node);
+static struct PersistentNode *pnode_rotate_right(struct PersistentNode *node);
+static struct PersistentNode *pnode_balance(struct PersistentNode *node);
+static int pnode_unwind(struct PersistentNode **path, const char *right, unsigned int count, struct PersistentNode **node);
+static int pnode_insert(struct PersistentNode *root, PyObject *element, int replace,
+			struct PersistentNode **result, Py_ssize_t *count);
+static int pnode_delete(struct PersistentNode *root, PyObject *element,
+			struct PersistentNode **result, Py_ssize_t *count);
+static PyObject *pnode_to_tuple(struct PersistentNode *node);
+
 
 #define STACK_PUSH(stk, cnt, elt)			\
     do {						\
@@ -93,565 +491,4199 @@ static PyObject *node_to_tuple(struct Node *node);
     } while(0)
 
 
+/* Links read from a mapped file are checked before they are followed,
+ * and paths longer than STACK_MAX mean the file is corrupt.
+ */
+#define MAPPED_FOLLOW(tree, off)			\
+    do {						\
+	if ((off) != 0 && !mapped_slot(tree, off)) {	\
+	    PyErr_SetString(PyExc_ValueError,		\
+			    "corrupt mapped tree");	\
+	    goto cleanup;				\
+	}						\
+    } while(0)
+
+#define MAPPED_PUSH(stk, cnt, elt)			\
+    do {						\
+	if ((cnt) < STACK_MAX) {			\
+	    (stk)[(cnt)++] = (elt);			\
+	}						\
+	else {						\
+	    PyErr_SetString(PyExc_ValueError,		\
+			    "corrupt mapped tree");	\
+	    goto cleanup;				\
+	}						\
+    } while(0)
+
+
 static PyMethodDef AVLTREE_METHODS[] = {
-    { "insert",   (PyCFunction)AVLTree_insert,   METH_O,      "Insert element" },
-    { "delete",   (PyCFunction)AVLTree_delete,   METH_O,      "Delete element" },
-    { "to_tuple", (PyCFunction)AVLTree_to_tuple, METH_NOARGS, "Return tree as tuples" },
+    { "insert",       (PyCFunction)AVLTree_insert,   METH_FASTCALL|METH_KEYWORDS, "Insert element" },
+    { "delete",       (PyCFunction)AVLTree_delete,   METH_FASTCALL|METH_KEYWORDS, "Delete element" },
+    { "get",          (PyCFunction)AVLTree_get,      METH_FASTCALL|METH_KEYWORDS, "Return element equal to key, or default" },
+    { "range",        (PyCFunction)AVLTree_range,    METH_FASTCALL|METH_KEYWORDS, "Iterate over elements e where lo <= e < hi" },
+    { "pop_until",    (PyCFunction)AVLTree_pop_until, METH_FASTCALL|METH_KEYWORDS, "Remove and return elements e where e < key" },
+    { "pop_expired",  (PyCFunction)AVLTree_pop_expired, METH_FASTCALL|METH_KEYWORDS, "Remove and return elements e where e <= now" },
+    { "next_deadline", (PyCFunction)AVLTree_next_deadline, METH_NOARGS,         "Return least element, or None" },
+    { "update",       (PyCFunction)AVLTree_update,   METH_O,                  "Insert elements of iterable" },
+    { "aupdate",      (PyCFunction)AVLTree_aupdate,  METH_O,                  "Run update(iterable) in the event loop's executor" },
+    { "build_sorted", (PyCFunction)AVLTree_build_sorted, METH_O|METH_CLASS,   "Return tree of the sorted numbers in buffer" },
+    { "abuild_sorted", (PyCFunction)AVLTree_abuild_sorted, METH_O|METH_CLASS, "Run build_sorted(buffer) in the event loop's executor" },
+    { "to_tuple",     (PyCFunction)AVLTree_to_tuple, METH_NOARGS,             "Return tree as tuples" },
+    { "to_list",      (PyCFunction)AVLTree_to_list,  METH_NOARGS,             "Return elements as a list" },
+    { "__reversed__", (PyCFunction)AVLTree_reversed, METH_NOARGS,             "Return reverse iterator" },
+    { "stats",        (PyCFunction)AVLTree_stats,    METH_NOARGS,             "Return operation counters" },
+    { "reset_stats",  (PyCFunction)AVLTree_reset_stats, METH_NOARGS,          "Reset operation counters" },
+    { "set_stats_callback", (PyCFunction)AVLTree_set_stats_callback, METH_FASTCALL|METH_KEYWORDS,
+      "Call callback(stats) every interval updates" },
+    { "__sizeof__",   (PyCFunction)AVLTree_sizeof,   METH_NOARGS,             "Size of tree in memory, in bytes" },
+    { NULL } /* Sentinel */
+};
+
+
+static PyMethodDef ITERATOR_METHODS[] = {
+    { "__length_hint__", (PyCFunction)Iterator_length_hint, METH_NOARGS, "Number of remaining elements" },
     { NULL } /* Sentinel */
 };
 
 
 static PyGetSetDef AVLTREE_GETSETTERS[] = {
     { "height", (getter) AVLTree_getheight, NULL, "Tree height", NULL},
+    { "collect_stats", (getter) AVLTree_getcollect_stats, (setter) AVLTree_setcollect_stats,
+      "Count operations", NULL},
+    { "indexed", (getter) AVLTree_getindexed, (setter) AVLTree_setindexed,
+      "Keep a hash index of elements", NULL},
     { NULL }  /* Sentinel */
 };
 
 
-static PyTypeObject AVLTREE_TYPE = {
-    PyVarObject_HEAD_INIT(NULL, 0)
+static PyType_Slot AVLTREE_SLOTS[] = {
+    { Py_tp_doc,      "AVLTree objects" },
+    { Py_tp_new,      AVLTree_new },
+    { Py_tp_init,     AVLTree_init },
+    { Py_tp_dealloc,  AVLTree_dealloc },
+    { Py_tp_iter,     AVLTree_iter },
+    { Py_sq_length,   AVLTree_len },
+    { Py_sq_contains, AVLTree_contains },
+    { Py_tp_methods,  AVLTREE_METHODS },
+    { Py_tp_getset,   AVLTREE_GETSETTERS },
+    { 0, NULL }  /* Sentinel */
+};
+
+
+static PyType_Spec AVLTREE_SPEC = {
+    .name      = "cavltree.AVLTree",
+    .basicsize = sizeof(struct AVLTree),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE,
+    .slots     = AVLTREE_SLOTS,
+};
+
+
+static PyType_Slot ITERATOR_SLOTS[] = {
+    { Py_tp_doc,      "AVLTree iterator" },
+    { Py_tp_new,      PyType_GenericNew },
+    { Py_tp_init,     Iterator_init },
+    { Py_tp_dealloc,  Iterator_dealloc },
+    { Py_tp_iter,     PyObject_SelfIter },
+    { Py_tp_iternext, Iterator_next },
+    { Py_tp_methods,  ITERATOR_METHODS },
+    { 0, NULL }  /* Sentinel */
+};
+
 
-    .tp_name      = "cavltree.AVLTree",
-    .tp_doc       = "AVLTree objects",
-    .tp_basicsize = sizeof(struct AVLTree),
-    .tp_itemsize  = 0,
-    .tp_flags     = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE,
-    .tp_new       = PyType_GenericNew,
-    .tp_init      = (initproc) AVLTree_init,
-    .tp_dealloc   = (destructor) AVLTree_dealloc,
-    .tp_iter      = (getiterfunc) AVLTree_iter,
-    .tp_methods   = AVLTREE_METHODS,
-    .tp_getset    = AVLTREE_GETSETTERS,
+static PyType_Spec ITERATOR_SPEC = {
+    .name      = "cavltree.Iterator",
+    .basicsize = sizeof(struct Iterator),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT,
+    .slots     = ITERATOR_SLOTS,
 };
 
 
-static PyTypeObject ITERATOR_TYPE = {
-    PyVarObject_HEAD_INIT(NULL, 0)
+static PyMethodDef MAPPEDTREE_METHODS[] = {
+    { "insert",    (PyCFunction)MappedTree_insert,   METH_O,      "Insert element" },
+    { "delete",    (PyCFunction)MappedTree_delete,   METH_O,      "Delete element" },
+    { "to_tuple",  (PyCFunction)MappedTree_to_tuple, METH_NOARGS, "Return tree as tuples" },
+    { "flush",     (PyCFunction)MappedTree_flush,    METH_NOARGS, "Schedule write back of changes" },
+    { "sync",      (PyCFunction)MappedTree_sync,     METH_NOARGS, "Write back changes and wait for completion" },
+    { "close",     (PyCFunction)MappedTree_close,    METH_NOARGS, "Unmap and close file" },
+    { "__enter__", (PyCFunction)MappedTree_enter,    METH_NOARGS, NULL },
+    { "__exit__",  (PyCFunction)MappedTree_exit,     METH_VARARGS, NULL },
+    { NULL } /* Sentinel */
+};
 
-    .tp_name      = "cavltree.Iterator",
-    .tp_doc       = "AVLTree iterator",
-    .tp_basicsize = sizeof(struct Iterator),
-    .tp_itemsize  = 0,
-    .tp_flags     = Py_TPFLAGS_DEFAULT,
-    .tp_new       = PyType_GenericNew,
-    .tp_init      = (initproc) Iterator_init,
-    .tp_dealloc   = (destructor) Iterator_dealloc,
-    .tp_iter      = PyObject_SelfIter,
-    .tp_iternext  = (iternextfunc) Iterator_next,
+
+static PyGetSetDef MAPPEDTREE_GETSETTERS[] = {
+    { "height", (getter) MappedTree_getheight, NULL, "Tree height", NULL},
+    { NULL }  /* Sentinel */
 };
 
 
-static PyModuleDef CAVLTREE_MODULE = {
-    PyModuleDef_HEAD_INIT,
+static PyType_Slot MAPPEDTREE_SLOTS[] = {
+    { Py_tp_doc,      "File-backed AVLTree of unsigned 64-bit integers" },
+    { Py_tp_new,      MappedTree_new },
+    { Py_tp_init,     MappedTree_init },
+    { Py_tp_dealloc,  MappedTree_dealloc },
+    { Py_tp_iter,     MappedTree_iter },
+    { Py_sq_length,   MappedTree_len },
+    { Py_sq_contains, MappedTree_contains },
+    { Py_tp_methods,  MAPPEDTREE_METHODS },
+    { Py_tp_getset,   MAPPEDTREE_GETSETTERS },
+    { 0, NULL }  /* Sentinel */
+};
+
 
-    .m_name = "cavltree",
-    .m_doc  = "AVL tree extension type.",
-    .m_size = -1,
+static PyType_Spec MAPPEDTREE_SPEC = {
+    .name      = "cavltree.MappedTree",
+    .basicsize = sizeof(struct MappedTree),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE,
+    .slots     = MAPPEDTREE_SLOTS,
 };
 
 
-PyMODINIT_FUNC PyInit_cavltree(void)
-{
-    PyObject *m = NULL, *rv = NULL;
+static PyType_Slot MAPPEDITERATOR_SLOTS[] = {
+    { Py_tp_doc,      "MappedTree iterator" },
+    { Py_tp_dealloc,  MappedIterator_dealloc },
+    { Py_tp_iter,     PyObject_SelfIter },
+    { Py_tp_iternext, MappedIterator_next },
+    { 0, NULL }  /* Sentinel */
+};
 
-    if (PyType_Ready(&AVLTREE_TYPE) == -1 ||
-	PyType_Ready(&ITERATOR_TYPE) == -1) {
-        goto cleanup;
-    }
 
-    if ((m = PyModule_Create(&CAVLTREE_MODULE)) == NULL) {
-        goto cleanup;
-    }
+static PyType_Spec MAPPEDITERATOR_SPEC = {
+    .name      = "cavltree.MappedIterator",
+    .basicsize = sizeof(struct MappedIterator),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT,
+    .slots     = MAPPEDITERATOR_SLOTS,
+};
 
-    Py_INCREF(&AVLTREE_TYPE);
 
-    if (PyModule_AddObject(m, "AVLTree", (PyObject *) &AVLTREE_TYPE) == -1) {
-	goto cleanup;
-    }
+static PyMethodDef PERSISTENTTREE_METHODS[] = {
+    { "insert",       (PyCFunction)PersistentTree_insert,   METH_FASTCALL|METH_KEYWORDS, "Return tree with element inserted" },
+    { "delete",       (PyCFunction)PersistentTree_delete,   METH_FASTCALL|METH_KEYWORDS, "Return tree with element deleted" },
+    { "range",        (PyCFunction)PersistentTree_range,    METH_FASTCALL|METH_KEYWORDS, "Iterate over elements e where lo <= e < hi" },
+    { "diff",         (PyCFunction)PersistentTree_diff,     METH_O,                  "Return (removed, added) elements relative to other tree" },
+    { "to_tuple",     (PyCFunction)PersistentTree_to_tuple, METH_NOARGS,             "Return tree as tuples" },
+    { "to_list",      (PyCFunction)PersistentTree_to_list,  METH_NOARGS,             "Return elements as a list" },
+    { "__reversed__", (PyCFunction)PersistentTree_reversed, METH_NOARGS,             "Return reverse iterator" },
+    { NULL } /* Sentinel */
+};
 
-    rv = m;
-    m = NULL;
 
- cleanup:
-    if (m != NULL) {
-	Py_DECREF(m);
-	Py_DECREF(&AVLTREE_TYPE);
-    }
+static PyMethodDef PERSISTENTITERATOR_METHODS[] = {
+    { "__length_hint__", (PyCFunction)PersistentIterator_length_hint, METH_NOARGS, "Number of remaining elements" },
+    { NULL } /* Sentinel */
+};
 
-    return rv;
+
+static PyGetSetDef PERSISTENTTREE_GETSETTERS[] = {
+    { "height", (getter) PersistentTree_getheight, NULL, "Tree height", NULL},
+    { NULL }  /* Sentinel */
+};
+
+
+static PyType_Slot PERSISTENTTREE_SLOTS[] = {
+    { Py_tp_doc,      "Immutable AVLTree, modifications return new trees that share nodes" },
+    { Py_tp_new,      PersistentTree_new },
+    { Py_tp_dealloc,  PersistentTree_dealloc },
+    { Py_tp_iter,     PersistentTree_iter },
+    { Py_sq_length,   PersistentTree_len },
+    { Py_sq_contains, PersistentTree_contains },
+    { Py_tp_methods,  PERSISTENTTREE_METHODS },
+    { Py_tp_getset,   PERSISTENTTREE_GETSETTERS },
+    { 0, NULL }  /* Sentinel */
+};
+
+
+static PyType_Spec PERSISTENTTREE_SPEC = {
+    .name      = "cavltree.PersistentTree",
+    .basicsize = sizeof(struct PersistentTree),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE,
+    .slots     = PERSISTENTTREE_SLOTS,
+};
+
+
+static PyType_Slot PERSISTENTITERATOR_SLOTS[] = {
+    { Py_tp_doc,      "PersistentTree iterator" },
+    { Py_tp_dealloc,  PersistentIterator_dealloc },
+    { Py_tp_iter,     PyObject_SelfIter },
+    { Py_tp_iternext, PersistentIterator_next },
+    { Py_tp_methods,  PERSISTENTITERATOR_METHODS },
+    { 0, NULL }  /* Sentinel */
+};
+
+
+static PyType_Spec PERSISTENTITERATOR_SPEC = {
+    .name      = "cavltree.PersistentIterator",
+    .basicsize = sizeof(struct PersistentIterator),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT,
+    .slots     = PERSISTENTITERATOR_SLOTS,
+};
+
+
+static PyModuleDef_Slot CAVLTREE_SLOTS[] = {
+    { Py_mod_exec, cavltree_exec },
+#ifdef Py_mod_gil
+    { Py_mod_gil,  Py_MOD_GIL_NOT_USED },
+#endif
+    { 0, NULL }  /* Sentinel */
+};
+
+
+static PyModuleDef CAVLTREE_MODULE = {
+    PyModuleDef_HEAD_INIT,
+
+    .m_name     = "cavltree",
+    .m_doc      = "AVL tree extension type.",
+    .m_size     = sizeof(struct ModuleState),
+    .m_slots    = CAVLTREE_SLOTS,
+    .m_traverse = cavltree_traverse,
+    .m_clear    = cavltree_clear,
+    .m_free     = (freefunc) cavltree_clear,
+};
+
+
+PyMODINIT_FUNC PyInit_cavltree(void)
+{
+    return PyModuleDef_Init(&CAVLTREE_MODULE);
 }
 
 
-static int AVLTree_init(struct AVLTree *self, PyObject *args, PyObject *kwargs)
+static int cavltree_exec(PyObject *m)
 {
-    static char *KWDS[] = { "iterable", NULL };
-    PyObject *iterable = NULL, *iterator = NULL, *element = NULL, *result = NULL;
+    struct ModuleState *state = PyModule_GetState(m);
     int rv = -1;
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", KWDS, &iterable)) {
+    if ((state->avltree_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &AVLTREE_SPEC, NULL)) == NULL ||
+	(state->iterator_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &ITERATOR_SPEC, NULL)) == NULL ||
+	(state->mappedtree_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &MAPPEDTREE_SPEC, NULL)) == NULL ||
+	(state->mappediterator_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &MAPPEDITERATOR_SPEC, NULL)) == NULL ||
+	(state->persistenttree_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &PERSISTENTTREE_SPEC, NULL)) == NULL ||
+	(state->persistentiterator_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &PERSISTENTITERATOR_SPEC, NULL)) == NULL) {
 	goto cleanup;
     }
 
-    if (iterable != NULL) {
-	if ((iterator = PyObject_GetIter(iterable)) == NULL) {
-	    goto cleanup;
-	}
-
-	while ((element = PyIter_Next(iterator)) != NULL) {
-	    result = AVLTree_insert(self, element);
-	    Py_DECREF(element);
-
-	    if (result == NULL) {
-		goto cleanup;
-	    }
-
-	    Py_DECREF(result);
-	}
+    /* Construct instances of the exact type without an argument tuple. */
+    state->avltree_type->tp_vectorcall = AVLTree_vectorcall;
 
-	if (PyErr_Occurred()) {
-	    goto cleanup;
-	}
+    if (PyModule_AddType(m, state->avltree_type) == -1 ||
+	PyModule_AddType(m, state->mappedtree_type) == -1 ||
+	PyModule_AddType(m, state->persistenttree_type) == -1) {
+	goto cleanup;
     }
 
     rv = 0;
 
  cleanup:
-    Py_XDECREF(iterator);
-
     return rv;
 }
 
 
-static void AVLTree_dealloc(struct AVLTree *self)
+static int cavltree_traverse(PyObject *m, visitproc visit, void *arg)
 {
-    node_dealloc(self->root);
-    Py_TYPE(self)->tp_free((PyObject *) self);
+    struct ModuleState *state = PyModule_GetState(m);
+
+    Py_VISIT(state->avltree_type);
+    Py_VISIT(state->iterator_type);
+    Py_VISIT(state->mappedtree_type);
+    Py_VISIT(state->mappediterator_type);
+    Py_VISIT(state->persistenttree_type);
+    Py_VISIT(state->persistentiterator_type);
+
+    return 0;
 }
 
 
-static PyObject *AVLTree_iter(struct AVLTree *self)
+static int cavltree_clear(PyObject *m)
 {
-    return PyObject_CallFunction((PyObject *) &ITERATOR_TYPE, "O", self);
+    struct ModuleState *state = PyModule_GetState(m);
+
+    Py_CLEAR(state->avltree_type);
+    Py_CLEAR(state->iterator_type);
+    Py_CLEAR(state->mappedtree_type);
+    Py_CLEAR(state->mappediterator_type);
+    Py_CLEAR(state->persistenttree_type);
+    Py_CLEAR(state->persistentiterator_type);
+
+    return 0;
 }
 
 
-static PyObject *AVLTree_insert(struct AVLTree *self,
-				PyObject *element)
+static struct ModuleState *type_state(PyTypeObject *type)
 {
-    struct Node **stack[STACK_MAX] = { 0 }, **side = NULL, *node = NULL;
-    unsigned int count = 0, old = 0;
-    int res = -1, bf = 0;
-    PyObject *rv = NULL;
+    PyObject *m = NULL;
+
+#if PY_VERSION_HEX >= 0x030B0000
+    m = PyType_GetModuleByDef(type, &CAVLTREE_MODULE);
+#else
+    /* Find the defining class, type may be a subclass. */
+    for (; type != NULL; type = type->tp_base) {
+	if ((m = PyType_GetModule(type)) != NULL &&
+	    PyModule_GetDef(m) == &CAVLTREE_MODULE) {
+	    break;
+	}
 
-    side = &self->root;
+	PyErr_Clear();
+	m = NULL;
+    }
 
-    while ((node = *side) != NULL) {
-	STACK_PUSH(stack, count, side);
+    if (m == NULL) {
+	PyErr_SetString(PyExc_TypeError, "cavltree type expected");
+    }
+#endif
 
-	/* element < node->element ==> left */
-	if ((res = PyObject_RichCompareBool(element, node->element, Py_LT)) == -1) {
-	    goto cleanup;
-	}
+    return m ? PyModule_GetState(m) : NULL;
+}
 
-	if (res) {
-	    side = &node->left;
-	    continue;
-	}
 
-	/* node->element < element ==> right */
-	if ((res = PyObject_RichCompareBool(node->element, element, Py_LT)) == -1) {
-	    goto cleanup;
-	}
+/* Parse vectorcall arguments into values, in the order of kwds.
+ * Optional arguments that are not given are set to NULL.
+ */
+static inline int parse_args(const char *name, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+			     const char *const *kwds, Py_ssize_t count, Py_ssize_t required, PyObject **values)
+{
+    Py_ssize_t i = 0, j = 0;
+    PyObject *key = NULL;
 
-	if (res) {
-	    side = &node->right;
-	    continue;
+    /* Positional arguments only ==> fast path */
+    if (kwnames == NULL && nargs >= required && nargs <= count) {
+	for (i = 0; i < count; i++) {
+	    values[i] = i < nargs ? args[i] : NULL;
 	}
 
-	/* equal ==> return element */
-	rv = node->element;
-	goto cleanup;
+	return 0;
     }
 
-    if ((node = node_alloc(element)) == NULL) {
-	goto cleanup;
+    if (nargs > count) {
+	PyErr_Format(PyExc_TypeError, "%s() takes at most %zd arguments (%zd given)",
+		     name, count, nargs);
+	return -1;
     }
 
-    *side = node;
+    for (i = 0; i < count; i++) {
+	values[i] = i < nargs ? args[i] : NULL;
+    }
 
-    while (count > 0) {
-	side = stack[--count];
-	node = *side;
-	old = node_update_height(node);
-	bf = node_balance_factor(node);
+    for (i = 0; kwnames != NULL && i < PyTuple_GET_SIZE(kwnames); i++) {
+	key = PyTuple_GET_ITEM(kwnames, i);
 
-	if (bf == 2) {
-	    if (node_balance_factor(node->right) < 0) {
-		node->right = node_rotate_right(node->right);
+	for (j = 0; j < count; j++) {
+	    if (PyUnicode_CompareWithASCIIString(key, kwds[j]) == 0) {
+		break;
 	    }
+	}
 
-	    *side = node_rotate_left(node);
+	if (j == count) {
+	    PyErr_Format(PyExc_TypeError, "%s() got an unexpected keyword argument '%U'",
+			 name, key);
+	    return -1;
 	}
-	else if (bf == -2) {
-	    if (node_balance_factor(node->left) > 0) {
-		node->left = node_rotate_left(node->left);
-	    }
 
-	    *side = node_rotate_right(node);
+	if (values[j] != NULL) {
+	    PyErr_Format(PyExc_TypeError, "%s() got multiple values for argument '%s'",
+			 name, kwds[j]);
+	    return -1;
 	}
-	else if (node->height == old) {
-	    break;
+
+	values[j] = args[nargs + i];
+    }
+
+    for (i = 0; i < required; i++) {
+	if (values[i] == NULL) {
+	    PyErr_Format(PyExc_TypeError, "%s() missing required argument '%s'",
+			 name, kwds[i]);
+	    return -1;
 	}
     }
 
-    rv = Py_None;
+    return 0;
+}
 
- cleanup:
-    Py_XINCREF(rv);
 
-    return rv;
+/* Parse range arguments. A bound of None is unlimited (NULL).
+ */
+static inline int parse_range(PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+			      PyObject **lo, PyObject **hi, int *reverse)
+{
+    static const char *const KWDS[] = { "lo", "hi", "reverse", NULL };
+    PyObject *values[3] = { NULL, NULL, NULL };
+
+    if (parse_args("range", args, nargs, kwnames, KWDS, 3, 0, values) == -1) {
+	return -1;
+    }
+
+    *lo = values[0] != Py_None ? values[0] : NULL;
+    *hi = values[1] != Py_None ? values[1] : NULL;
+    *reverse = 0;
+
+    if (values[2] != NULL && (*reverse = PyObject_IsTrue(values[2])) == -1) {
+	return -1;
+    }
+
+    return 0;
 }
 
 
-static PyObject *AVLTree_delete(struct AVLTree *self,
-				PyObject *element)
+static PyObject *AVLTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
 {
-    struct Node **stack[STACK_MAX] = { 0 }, **side = NULL, *node = NULL;
-    unsigned int count = 0, old = 0;
-    int res = -1, bf = 0;
-    PyObject *rv = NULL;
+    struct AVLTree *self = NULL;
 
-    side = &self->root;
+    if ((self = (struct AVLTree *) PyType_GenericNew(type, args, kwargs)) != NULL) {
+	RWLOCK_INIT(&self->lock);
+    }
 
-    while ((node = *side) != NULL) {
-	STACK_PUSH(stack, count, side);
+    return (PyObject *) self;
+}
 
-	/* element < node->element ==> left */
-	if ((res = PyObject_RichCompareBool(element, node->element, Py_LT)) == -1) {
-	    goto cleanup;
-	}
-
-	if (res) {
-	    side = &node->left;
-	    continue;
-	}
 
-	/* node->element < element ==> right */
-	if ((res = PyObject_RichCompareBool(node->element, element, Py_LT)) == -1) {
-	    goto cleanup;
-	}
-
-	if (res) {
-	    side = &node->right;
-	    continue;
-	}
+static PyObject *AVLTree_vectorcall(PyObject *type, PyObject *const *args,
+				    size_t nargsf, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "iterable", "indexed", NULL };
+    PyObject *values[2] = { NULL, NULL }, *self = NULL;
+    int indexed = 0;
 
-	break; /* equal ==> found */
+    if (parse_args("AVLTree", args, PyVectorcall_NARGS(nargsf), kwnames, KWDS, 2, 0, values) == -1) {
+	return NULL;
     }
 
-    if (node == NULL) {
-	Py_RETURN_NONE;
+    if (values[1] != NULL && (indexed = PyObject_IsTrue(values[1])) == -1) {
+	return NULL;
     }
 
-    if (node->left != NULL && node->right != NULL) {
-	struct Node *target = node;
-
-	side = &node->right;
-	node = *side;
+    if ((self = AVLTree_new((PyTypeObject *) type, NULL, NULL)) == NULL) {
+	return NULL;
+    }
 
-	STACK_PUSH(stack, count, side);
+    if ((indexed && index_enable((struct AVLTree *) self, 1) == -1) ||
+	(values[0] != NULL && tree_update((struct AVLTree *) self, values[0]) == -1)) {
+	Py_CLEAR(self);
+    }
 
-	while (node->left != NULL) {
-	    side = &node->left;
-	    node = *side;
+    return self;
+}
 
-	    STACK_PUSH(stack, count, side);
-	}
 
-	if (node->right != NULL) {
-	    *side = node->right;
-	    node->right = NULL;
-	}
-	else {
-	    *side = NULL;
-	}
+static int AVLTree_init(struct AVLTree *self, PyObject *args, PyObject *kwargs)
+{
+    static char *KWDS[] = { "iterable", "indexed", NULL };
+    PyObject *iterable = NULL;
+    int indexed = 0;
 
-	rv = target->element;
-	target->element = node->element;
-	node->element = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|Op", KWDS, &iterable, &indexed)) {
+	return -1;
     }
-    else {
-	if (node->left != NULL) {
-	    *side = node->left;
-	    node->left = NULL;
-	}
-	else if (node->right != NULL) {
-	    *side = node->right;
-	    node->right = NULL;
-	}
-	else {
-	    *side = NULL;
-	}
 
-	rv = node->element;
-	node->element = NULL;
+    if (indexed && index_enable(self, 1) == -1) {
+	return -1;
     }
 
-    node_dealloc(node);
+    return iterable != NULL ? tree_update(self, iterable) : 0;
+}
+
 
-    if (*side == NULL) {
-	--count;
+static void AVLTree_dealloc(struct AVLTree *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+    struct Node *node = NULL, *next = NULL;
+
+    for (node = self->first; node != NULL; node = next) {
+	next = node->next;
+	node_dealloc(node);
     }
 
-    while (count > 0) {
-	side = stack[--count];
-	node = *side;
-	old = node_update_height(node);
-	bf = node_balance_factor(node);
+    stats_enable(self, 0);
+    Py_XDECREF(self->index);
+    RWLOCK_DESTROY(&self->lock);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
 
-	if (bf == 2) {
-	    if (node_balance_factor(node->right) < 0) {
-		node->right = node_rotate_right(node->right);
-	    }
 
-	    *side = node_rotate_left(node);
-	}
-	else if (bf == -2) {
-	    if (node_balance_factor(node->left) > 0) {
-		node->left = node_rotate_left(node->left);
-	    }
+static PyObject *AVLTree_iter(struct AVLTree *self)
+{
+    struct ModuleState *state = NULL;
 
-	    *side = node_rotate_right(node);
-	}
-	else if (node->height == old) {
-	    break;
-	}
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
     }
 
- cleanup:
-    return rv;
+    return PyObject_CallFunction((PyObject *) state->iterator_type, "O", self);
 }
 
 
-static PyObject *AVLTree_to_tuple(struct AVLTree *self,
+static PyObject *AVLTree_reversed(struct AVLTree *self,
 				  PyObject *Py_UNUSED(ignored))
 {
-    return node_to_tuple(self->root);
+    struct ModuleState *state = NULL;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    return PyObject_CallFunction((PyObject *) state->iterator_type, "OO", self, Py_True);
 }
 
 
-static PyObject *AVLTree_getheight(struct AVLTree *self,
-				   void *Py_UNUSED(ignored))
+static Py_ssize_t AVLTree_len(struct AVLTree *self)
 {
-    return PyLong_FromUnsignedLong(node_height(self->root));
+    Py_ssize_t rv = 0;
+
+    RWLOCK_READ(&self->lock);
+    rv = self->count;
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
 }
 
 
-static int Iterator_init(struct Iterator *self, PyObject *args, PyObject *kwargs)
+static int AVLTree_contains(struct AVLTree *self, PyObject *element)
 {
-    static char *KWDS[] = { "tree", NULL };
-    PyObject *tree = NULL;
-    int rv = -1;
+    struct Node *node = NULL;
+    int res = -1, rv = -1;
+
+    RWLOCK_READ(&self->lock);
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", KWDS, &tree)) {
+    if (self->index != NULL) {
+	rv = PyDict_Contains(self->index, element);
 	goto cleanup;
     }
 
-    Py_INCREF(tree);
-    self->tree = (struct AVLTree *)tree;
+    node = self->root;
 
-    if (self->tree->root != NULL) {
-	self->stack[0].node = self->tree->root;
-	self->stack[0].state = STATE_LEFT;
-	self->count = 1;
-    }
-    else {
-	self->count = 0;
+    while (node != NULL) {
+	/* element < node->element ==> left */
+	if ((res = TREE_LT(self, element, node->element)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    node = node->left;
+	    continue;
+	}
+
+	/* node->element < element ==> right */
+	if ((res = TREE_LT(self, node->element, element)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    node = node->right;
+	    continue;
+	}
+
+	break; /* equal ==> found */
     }
 
-    rv = 0;
+    rv = node != NULL;
 
  cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
     return rv;
 }
 
 
-static void Iterator_dealloc(struct Iterator *self)
+/* Return the stored element equal to key, which may be a different
+ * object than key, or default.
+ */
+static PyObject *AVLTree_get(struct AVLTree *self, PyObject *const *args,
+			     Py_ssize_t nargs, PyObject *kwnames)
 {
-    Py_XDECREF(self->tree);
-    Py_TYPE(self)->tp_free((PyObject *) self);
-}
+    static const char *const KWDS[] = { "key", "default", NULL };
+    PyObject *values[2] = { NULL, NULL }, *key = NULL, *rv = NULL;
+    struct Node *node = NULL;
+    int res = -1;
 
+    if (parse_args("get", args, nargs, kwnames, KWDS, 2, 1, values) == -1) {
+	return NULL;
+    }
 
-static PyObject *Iterator_next(struct Iterator *self)
-{
-    PyObject *element = NULL;
-    struct Entry *entry = NULL;
-    struct Node *next = NULL;
+    key = values[0];
 
-    do  {
-	if (self->count == 0) {
-	    PyErr_SetNone(PyExc_StopIteration);
-	    break;
-	}
+    RWLOCK_READ(&self->lock);
 
-	if (next == NULL) {
-	    entry = &self->stack[ self->count - 1 ];
-	}
-	else if (self->count < STACK_MAX) {
-	    entry = &self->stack[ self->count++ ];
-	    entry->node = next;
-	    entry->state = STATE_LEFT;
-	}
-	else {
-	    PyErr_SetString(PyExc_RuntimeError, "stack overflow");
-	    break;
+    if (self->index != NULL) {
+	if ((rv = PyDict_GetItemWithError(self->index, key)) == NULL && PyErr_Occurred()) {
+	    goto cleanup;
 	}
+    }
+    else {
+	node = self->root;
 
-	switch (entry->state) {
-	case STATE_LEFT:
-	    entry->state = STATE_ELEMENT;
-	    next = entry->node->left;
-	    break;
-
-	case STATE_ELEMENT:
-	    entry->state = STATE_RIGHT;
-	    element = entry->node->element;
-	    Py_INCREF(element);
-	    break;
+	while (node != NULL) {
+	    /* key < node->element ==> left */
+	    if ((res = TREE_LT(self, key, node->element)) == -1) {
+		goto cleanup;
+	    }
 
-	case STATE_RIGHT:
-	    entry->state = STATE_UP;
-	    next = entry->node->right;
-	    break;
+	    if (res) {
+		node = node->left;
+		continue;
+	    }
 
-	case STATE_UP:
-	    self->count--;
-	    next = NULL;
-	    break;
-	}
-    } while (element == NULL);
+	    /* node->element < key ==> right */
+	    if ((res = TREE_LT(self, node->element, key)) == -1) {
+		goto cleanup;
+	    }
 
-    return element;
-}
+	    if (res) {
+		node = node->right;
+		continue;
+	    }
 
+	    break; /* equal ==> found */
+	}
 
-static struct Node *node_alloc(PyObject *element)
-{
-    struct Node *node = NULL;
+	rv = node != NULL ? node->element : NULL;
+    }
 
-    if ((node = calloc(1, sizeof *node)) == NULL) {
-	PyErr_NoMemory();
-	goto cleanup;
+    if (rv == NULL) {
+	rv = values[1] != NULL ? values[1] : Py_None;
     }
 
-    Py_INCREF(element);
-    node->element = element;
-    node->height  = 1;
+    Py_INCREF(rv);
 
  cleanup:
-    return node;
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
 }
 
 
-static void node_dealloc(struct Node *node)
+static PyObject *AVLTree_insert(struct AVLTree *self, PyObject *const *args,
+				Py_ssize_t nargs, PyObject *kwnames)
 {
-    if (node != NULL) {
-	node_dealloc(node->left);
-	node_dealloc(node->right);
-	Py_XDECREF(node->element);
-	free(node);
+    static const char *const KWDS[] = { "element", "replace", NULL };
+    PyObject *values[2] = { NULL, NULL }, *rv = NULL;
+    int replace = 0, due = 0;
+
+    if (parse_args("insert", args, nargs, kwnames, KWDS, 2, 1, values) == -1) {
+	return NULL;
     }
-}
 
+    if (values[1] != NULL && (replace = PyObject_IsTrue(values[1])) == -1) {
+	return NULL;
+    }
 
-static inline unsigned int node_height(struct Node *node)
-{
-    return node ? node->height : 0;
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_insert(self, values[0], replace);
+    due = rv != NULL && stats_due(self);
+    RWLOCK_RELEASE(&self->lock);
+
+    if (due) {
+	stats_notify(self);
+    }
+
+    return rv;
 }
 
 
-static unsigned int node_update_height(struct Node *node)
+static PyObject *AVLTree_delete(struct AVLTree *self, PyObject *const *args,
+				Py_ssize_t nargs, PyObject *kwnames)
 {
-    unsigned int rv = 0;
+    static const char *const KWDS[] = { "element", NULL };
+    PyObject *values[1] = { NULL }, *rv = NULL;
+    int due = 0;
 
-    rv = node->height;
+    if (parse_args("delete", args, nargs, kwnames, KWDS, 1, 1, values) == -1) {
+	return NULL;
+    }
 
-    node->height = 1 + Py_MAX(node_height(node->left),
-			      node_height(node->right));
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_delete(self, values[0]);
+    due = rv != NULL && stats_due(self);
+    RWLOCK_RELEASE(&self->lock);
+
+    if (due) {
+	stats_notify(self);
+    }
 
     return rv;
 }
 
 
-static inline int node_balance_factor(struct Node *node)
+static PyObject *AVLTree_pop_until(struct AVLTree *self, PyObject *const *args,
+				   Py_ssize_t nargs, PyObject *kwnames)
 {
-    return node_height(node->right) - node_height(node->left);
+    static const char *const KWDS[] = { "key", NULL };
+    PyObject *values[1] = { NULL }, *rv = NULL;
+    int due = 0;
+
+    if (parse_args("pop_until", args, nargs, kwnames, KWDS, 1, 1, values) == -1) {
+	return NULL;
+    }
+
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_pop(self, values[0], 0);
+    due = rv != NULL && stats_due(self);
+    RWLOCK_RELEASE(&self->lock);
+
+    if (due) {
+	stats_notify(self);
+    }
+
+    return rv;
 }
 
 
-static struct Node *node_rotate_left(struct Node *node)
+static PyObject *AVLTree_pop_expired(struct AVLTree *self, PyObject *const *args,
+				     Py_ssize_t nargs, PyObject *kwnames)
 {
-    struct Node *root = NULL;
+    static const char *const KWDS[] = { "now", NULL };
+    PyObject *values[1] = { NULL }, *rv = NULL;
+    int due = 0;
 
-    root = node->right;
-    node->right = root->left;
-    root->left = node;
+    if (parse_args("pop_expired", args, nargs, kwnames, KWDS, 1, 1, values) == -1) {
+	return NULL;
+    }
 
-    node_update_height(node);
-    node_update_height(root);
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_pop(self, values[0], 1);
+    due = rv != NULL && stats_due(self);
+    RWLOCK_RELEASE(&self->lock);
 
-    return root;
+    if (due) {
+	stats_notify(self);
+    }
+
+    return rv;
 }
 
 
-static struct Node *node_rotate_right(struct Node *node)
+static PyObject *AVLTree_next_deadline(struct AVLTree *self,
+				       PyObject *Py_UNUSED(ignored))
 {
-    struct Node *root = NULL;
+    PyObject *rv = NULL;
 
-    root = node->left;
-    node->left = root->right;
-    root->right = node;
+    RWLOCK_READ(&self->lock);
+    rv = self->first != NULL ? self->first->element : Py_None;
+    Py_INCREF(rv);
+    RWLOCK_RELEASE(&self->lock);
 
-    node_update_height(node);
-    node_update_height(root);
+    return rv;
+}
 
-    return root;
+
+static PyObject *AVLTree_update(struct AVLTree *self, PyObject *iterable)
+{
+    if (tree_update(self, iterable) == -1) {
+	return NULL;
+    }
+
+    Py_RETURN_NONE;
 }
 
 
-static PyObject *node_to_tuple(struct Node *node)
+static PyObject *AVLTree_aupdate(struct AVLTree *self, PyObject *iterable)
 {
-    PyObject *l = NULL, *r = NULL, *e = NULL, *h = NULL, *t = NULL;
+    PyObject *update = NULL, *rv = NULL;
 
-    if (node == NULL) {
-	Py_RETURN_NONE;
+    if ((update = PyObject_GetAttrString((PyObject *) self, "update")) != NULL) {
+	rv = run_in_executor(update, iterable);
+	Py_DECREF(update);
     }
 
-    if ((l = node_to_tuple(node->left)) == NULL) {
-	goto cleanup;
-    }
+    return rv;
+}
 
-    if ((r = node_to_tuple(node->right)) == NULL) {
+
+static PyObject *AVLTree_build_sorted(PyTypeObject *type, PyObject *buffer)
+{
+    union Value *values = NULL;
+    Py_ssize_t count = 0;
+    enum Kind kind = KIND_SIGNED;
+    PyObject *self = NULL;
+    int numeric = 0;
+
+    if ((numeric = buffer_values(buffer, 1, &values, &count, &kind)) == -1) {
 	goto cleanup;
     }
 
-    e = node->element;
-    Py_INCREF(e);
-
-    if ((h = PyLong_FromUnsignedLong(node->height)) == NULL) {
+    if (!numeric) {
+	PyErr_Format(PyExc_TypeError, "build_sorted() argument must be a buffer of numbers, not %.200s",
+		     Py_TYPE(buffer)->tp_name);
 	goto cleanup;
     }
 
-    if ((t = PyTuple_Pack(4, l, e, h, r)) == NULL) {
+    if ((self = AVLTree_new(type, NULL, NULL)) == NULL) {
 	goto cleanup;
     }
 
-    l = r = e = h = NULL;
+    if (tree_build((struct AVLTree *) self, values, count, kind) == -1) {
+	Py_CLEAR(self);
+    }
 
  cleanup:
-    Py_XDECREF(l);
-    Py_XDECREF(r);
-    Py_XDECREF(e);
+    PyMem_RawFree(values);
+
+    return self;
+}
+
+
+static PyObject *AVLTree_abuild_sorted(PyTypeObject *type, PyObject *buffer)
+{
+    PyObject *build_sorted = NULL, *rv = NULL;
+
+    if ((build_sorted = PyObject_GetAttrString((PyObject *) type, "build_sorted")) != NULL) {
+	rv = run_in_executor(build_sorted, buffer);
+	Py_DECREF(build_sorted);
+    }
+
+    return rv;
+}
+
+
+/* Start at the least element e where lo <= e, or when reversed, the
+ * greatest element where e < hi. The iterator stops at the other
+ * bound.
+ */
+static PyObject *AVLTree_range(struct AVLTree *self, PyObject *const *args,
+			       Py_ssize_t nargs, PyObject *kwnames)
+{
+    struct Iterator *iterator = NULL;
+    struct ModuleState *state = NULL;
+    struct Node *node = NULL, *start = NULL;
+    PyObject *lo = NULL, *hi = NULL, *bound = NULL;
+    int reverse = 0, res = -1;
+
+    if (parse_range(args, nargs, kwnames, &lo, &hi, &reverse) == -1) {
+	return NULL;
+    }
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    if ((iterator = (struct Iterator *) PyObject_CallFunction((PyObject *) state->iterator_type, "OO",
+							      self, reverse ? Py_True : Py_False)) == NULL) {
+	return NULL;
+    }
+
+    RWLOCK_READ(&self->lock);
+
+    iterator->version = self->version;
+    iterator->remaining = -1;
+    iterator->stop = reverse ? lo : hi;
+    Py_XINCREF(iterator->stop);
+
+    /* Take the start node and version together. */
+    iterator->node = reverse ? self->last : self->first;
+
+    if ((bound = reverse ? hi : lo) != NULL) {
+	node = self->root;
+
+	while (node != NULL) {
+	    /* node->element < bound ==> right */
+	    if ((res = TREE_LT(self, node->element, bound)) == -1) {
+		Py_CLEAR(iterator);
+		goto cleanup;
+	    }
+
+	    if (res == reverse) {
+		start = node;
+	    }
+
+	    node = res ? node->right : node->left;
+	}
+
+	iterator->node = start;
+    }
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return (PyObject *) iterator;
+}
+
+
+static PyObject *AVLTree_to_tuple(struct AVLTree *self,
+				  PyObject *Py_UNUSED(ignored))
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_READ(&self->lock);
+    rv = node_to_tuple(self->root);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+/* Fill a list of the exact size by following the thread.
+ */
+static PyObject *AVLTree_to_list(struct AVLTree *self,
+				 PyObject *Py_UNUSED(ignored))
+{
+    struct Node *node = NULL;
+    PyObject *rv = NULL;
+    Py_ssize_t i = 0;
+
+    RWLOCK_READ(&self->lock);
+
+    if ((rv = PyList_New(self->count)) == NULL) {
+	goto cleanup;
+    }
+
+    for (node = self->first; node != NULL; node = node->next) {
+	Py_INCREF(node->element);
+	PyList_SET_ITEM(rv, i++, node->element);
+    }
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *AVLTree_getheight(struct AVLTree *self,
+				   void *Py_UNUSED(ignored))
+{
+    unsigned int height = 0;
+
+    RWLOCK_READ(&self->lock);
+    height = node_height(self->root);
+    RWLOCK_RELEASE(&self->lock);
+
+    return PyLong_FromUnsignedLong(height);
+}
+
+
+static PyObject *AVLTree_stats(struct AVLTree *self,
+			       PyObject *Py_UNUSED(ignored))
+{
+    struct Stats none = { 0 };
+    PyObject *rv = NULL;
+
+    RWLOCK_READ(&self->lock);
+    rv = stats_dict(self->stats != NULL ? self->stats : &none);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+/* Zero the counters, keeping the callback and its interval.
+ */
+static PyObject *AVLTree_reset_stats(struct AVLTree *self,
+				     PyObject *Py_UNUSED(ignored))
+{
+    struct Stats *stats = NULL;
+
+    RWLOCK_WRITE(&self->lock);
+
+    if ((stats = self->stats) != NULL) {
+	*stats = (struct Stats) {
+	    .interval = stats->interval,
+	    .callback = stats->callback,
+	};
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    Py_RETURN_NONE;
+}
+
+
+/* Set a callback to sample the counters, turning collection on. A
+ * callback of None removes it.
+ */
+static PyObject *AVLTree_set_stats_callback(struct AVLTree *self, PyObject *const *args,
+					    Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "callback", "interval", NULL };
+    PyObject *values[2] = { NULL, NULL }, *callback = NULL;
+    unsigned long long interval = 1024;
+
+    if (parse_args("set_stats_callback", args, nargs, kwnames, KWDS, 2, 1, values) == -1) {
+	return NULL;
+    }
+
+    if (values[0] != Py_None && !PyCallable_Check(values[0])) {
+	PyErr_SetString(PyExc_TypeError, "callback must be callable or None");
+	return NULL;
+    }
+
+    if (values[1] != NULL) {
+	if ((interval = PyLong_AsUnsignedLongLong(values[1])) == (unsigned long long) -1 && PyErr_Occurred()) {
+	    return NULL;
+	}
+
+	if (interval == 0) {
+	    PyErr_SetString(PyExc_ValueError, "interval must be positive");
+	    return NULL;
+	}
+    }
+
+    if (values[0] != Py_None && stats_enable(self, 1) == -1) {
+	return NULL;
+    }
+
+    RWLOCK_WRITE(&self->lock);
+
+    if (self->stats != NULL) {
+	callback = self->stats->callback;
+	self->stats->callback = values[0] != Py_None ? values[0] : NULL;
+	Py_XINCREF(self->stats->callback);
+	self->stats->interval = interval;
+	self->stats->notified = self->stats->updates;
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    Py_XDECREF(callback);
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *AVLTree_getcollect_stats(struct AVLTree *self,
+					  void *Py_UNUSED(ignored))
+{
+    return PyBool_FromLong(self->stats != NULL);
+}
+
+
+static int AVLTree_setcollect_stats(struct AVLTree *self, PyObject *value,
+				    void *Py_UNUSED(ignored))
+{
+    int enable = 0;
+
+    if (value == NULL) {
+	PyErr_SetString(PyExc_AttributeError, "cannot delete collect_stats");
+	return -1;
+    }
+
+    if ((enable = PyObject_IsTrue(value)) == -1) {
+	return -1;
+    }
+
+    return stats_enable(self, enable);
+}
+
+
+static PyObject *AVLTree_getindexed(struct AVLTree *self,
+				    void *Py_UNUSED(ignored))
+{
+    return PyBool_FromLong(self->index != NULL);
+}
+
+
+static int AVLTree_setindexed(struct AVLTree *self, PyObject *value,
+			      void *Py_UNUSED(ignored))
+{
+    int enable = 0;
+
+    if (value == NULL) {
+	PyErr_SetString(PyExc_AttributeError, "cannot delete indexed");
+	return -1;
+    }
+
+    if ((enable = PyObject_IsTrue(value)) == -1) {
+	return -1;
+    }
+
+    return index_enable(self, enable);
+}
+
+
+/* Nodes, counters and index, not counting the elements.
+ */
+static PyObject *AVLTree_sizeof(struct AVLTree *self,
+				PyObject *Py_UNUSED(ignored))
+{
+    PyObject *index = NULL, *rv = NULL;
+    Py_ssize_t size = 0;
+
+    RWLOCK_READ(&self->lock);
+
+    size = Py_TYPE(self)->tp_basicsize + self->count * sizeof(struct Node);
+
+    if (self->stats != NULL) {
+	size += sizeof(struct Stats);
+    }
+
+    index = self->index;
+    Py_XINCREF(index);
+
+    RWLOCK_RELEASE(&self->lock);
+
+    if (index != NULL) {
+	if ((rv = PyObject_CallMethod(index, "__sizeof__", NULL)) == NULL) {
+	    goto cleanup;
+	}
+
+	size += PyLong_AsSsize_t(rv);
+	Py_CLEAR(rv);
+
+	if (PyErr_Occurred()) {
+	    goto cleanup;
+	}
+    }
+
+    rv = PyLong_FromSsize_t(size);
+
+ cleanup:
+    Py_XDECREF(index);
+
+    return rv;
+}
+
+
+/* Insert the elements of iterable one by one, each under the write
+ * lock, so that readers see a consistent tree in between. A buffer of
+ * numbers is read and sorted without the GIL, and an empty tree is
+ * built from it in one go. Other threads get to run every
+ * UPDATE_CHUNK elements.
+ */
+static int tree_update(struct AVLTree *self, PyObject *iterable)
+{
+    PyObject *iterator = NULL, *element = NULL, *result = NULL;
+    union Value *values = NULL;
+    Py_ssize_t count = 0, i = 0;
+    enum Kind kind = KIND_SIGNED;
+    int rv = -1, numeric = 0, empty = 0;
+
+    if ((numeric = buffer_values(iterable, 0, &values, &count, &kind)) == -1) {
+	goto cleanup;
+    }
+
+    if (numeric) {
+	RWLOCK_READ(&self->lock);
+	empty = self->count == 0;
+	RWLOCK_RELEASE(&self->lock);
+
+	if (empty) {
+	    rv = tree_build(self, values, count, kind);
+	    goto cleanup;
+	}
+    }
+    else if ((iterator = PyObject_GetIter(iterable)) == NULL) {
+	goto cleanup;
+    }
+
+    for (i = 1; ; i++) {
+	if (numeric) {
+	    element = i <= count ? value_object(values[i - 1], kind) : NULL;
+	}
+	else {
+	    element = PyIter_Next(iterator);
+	}
+
+	if (element == NULL) {
+	    break;
+	}
+
+	RWLOCK_WRITE(&self->lock);
+	result = tree_insert(self, element, 0);
+	RWLOCK_RELEASE(&self->lock);
+
+	Py_DECREF(element);
+
+	if (result == NULL) {
+	    goto cleanup;
+	}
+
+	Py_DECREF(result);
+
+	if (i % UPDATE_CHUNK == 0) {
+	    yield_gil();
+	}
+    }
+
+    if (PyErr_Occurred()) {
+	goto cleanup;
+    }
+
+    rv = 0;
+
+ cleanup:
+    Py_XDECREF(iterator);
+    PyMem_RawFree(values);
+
+    return rv;
+}
+
+
+/* Build a tree of count sorted, distinct values and swap it in. The
+ * nodes are allocated and linked without the GIL and the elements are
+ * created with it, all out of sight of readers, so they see the tree
+ * either empty or complete. Should another thread have inserted in
+ * the meantime, the elements are inserted one by one instead.
+ */
+static int tree_build(struct AVLTree *self, union Value *values, Py_ssize_t count, enum Kind kind)
+{
+    struct Node **nodes = NULL, *root = NULL;
+    PyObject *index = NULL, *result = NULL;
+    Py_ssize_t i = 0, built = 0;
+    int rv = -1, swapped = 0;
+
+    if (count == 0) {
+	return 0;
+    }
+
+    if ((nodes = PyMem_RawMalloc(count * sizeof *nodes)) == NULL) {
+	PyErr_NoMemory();
+	goto cleanup;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (built = 0; built < count; built++) {
+	if ((nodes[built] = PyMem_RawCalloc(1, sizeof **nodes)) == NULL) {
+	    break;
+	}
+
+	if (built > 0) {
+	    nodes[built]->prev = nodes[built - 1];
+	    nodes[built - 1]->next = nodes[built];
+	}
+    }
+
+    if (built == count) {
+	root = node_build(nodes, count);
+    }
+    Py_END_ALLOW_THREADS
+
+    if (built < count) {
+	PyErr_NoMemory();
+	goto cleanup;
+    }
+
+    for (i = 0; i < count; i++) {
+	if ((nodes[i]->element = value_object(values[i], kind)) == NULL) {
+	    goto cleanup;
+	}
+
+	if ((i + 1) % UPDATE_CHUNK == 0) {
+	    yield_gil();
+	}
+    }
+
+    RWLOCK_WRITE(&self->lock);
+
+    if (self->count == 0) {
+	if (self->index != NULL) {
+	    if ((index = PyDict_New()) == NULL) {
+		RWLOCK_RELEASE(&self->lock);
+		goto cleanup;
+	    }
+
+	    for (i = 0; i < count; i++) {
+		if (PyDict_SetItem(index, nodes[i]->element, nodes[i]->element) == -1) {
+		    RWLOCK_RELEASE(&self->lock);
+		    goto cleanup;
+		}
+	    }
+
+	    result = self->index;
+	    self->index = index;
+	    index = result;
+	}
+
+	self->root  = root;
+	self->first = nodes[0];
+	self->last  = nodes[count - 1];
+	self->count = count;
+	self->version++;
+	STATS_ADD(self, allocs, count);
+	swapped = 1;
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    for (i = 0; !swapped && i < count; i++) {
+	RWLOCK_WRITE(&self->lock);
+	result = tree_insert(self, nodes[i]->element, 0);
+	RWLOCK_RELEASE(&self->lock);
+
+	if (result == NULL) {
+	    goto cleanup;
+	}
+
+	Py_DECREF(result);
+    }
+
+    rv = 0;
+
+ cleanup:
+    for (i = 0; !swapped && i < built; i++) {
+	node_dealloc(nodes[i]);
+    }
+
+    PyMem_RawFree(nodes);
+    Py_XDECREF(index);
+
+    return rv;
+}
+
+
+static PyObject *tree_insert(struct AVLTree *self,
+			     PyObject *element, int replace)
+{
+    struct Node **stack[STACK_MAX] = { 0 }, **side = NULL, *node = NULL, *parent = NULL;
+    unsigned int count = 0, old = 0, unwind = 0;
+    int res = -1, bf = 0;
+    PyObject *rv = NULL;
+
+    /* Indexed ==> duplicates are found without a descent */
+    if (self->index != NULL && !replace &&
+	((rv = PyDict_GetItemWithError(self->index, element)) != NULL || PyErr_Occurred())) {
+	goto cleanup;
+    }
+
+    side = &self->root;
+
+    while ((node = *side) != NULL) {
+	STACK_PUSH(stack, count, side);
+	parent = node;
+
+	/* element < node->element ==> left */
+	if ((res = TREE_LT(self, element, node->element)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    side = &node->left;
+	    continue;
+	}
+
+	/* node->element < element ==> right */
+	if ((res = TREE_LT(self, node->element, element)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    side = &node->right;
+	    continue;
+	}
+
+	/* equal ==> return element */
+	if (replace) {
+	    if (self->index != NULL && PyDict_SetItem(self->index, element, element) == -1) {
+		goto cleanup;
+	    }
+
+	    /* The reference to the old element passes to the caller. */
+	    rv = node->element;
+	    Py_INCREF(element);
+	    node->element = element;
+	    return rv;
+	}
+
+	rv = node->element;
+	goto cleanup;
+    }
+
+    if ((node = node_alloc(element)) == NULL) {
+	goto cleanup;
+    }
+
+    if (self->index != NULL && PyDict_SetItem(self->index, element, element) == -1) {
+	node_dealloc(node);
+	goto cleanup;
+    }
+
+    STATS_ADD(self, allocs, 1);
+
+    /* A new left child precedes its parent, a right child follows it. */
+    if (parent == NULL) {
+	/* empty tree ==> only node */
+    }
+    else if (side == &parent->left) {
+	node->next = parent;
+	node->prev = parent->prev;
+	parent->prev = node;
+    }
+    else {
+	node->prev = parent;
+	node->next = parent->next;
+	parent->next = node;
+    }
+
+    if (node->prev != NULL) {
+	node->prev->next = node;
+    }
+    else {
+	self->first = node;
+    }
+
+    if (node->next != NULL) {
+	node->next->prev = node;
+    }
+    else {
+	self->last = node;
+    }
+
+    *side = node;
+    self->count++;
+    self->version++;
+
+    while (count > 0) {
+	side = stack[--count];
+	node = *side;
+	old = node_update_height(node);
+	unwind++;
+	bf = node_balance_factor(node);
+
+	if (bf == 2) {
+	    if (node_balance_factor(node->right) < 0) {
+		node->right = node_rotate_right(node->right);
+		STATS_ADD(self, double_rotations, 1);
+	    }
+	    else {
+		STATS_ADD(self, rotations, 1);
+	    }
+
+	    *side = node_rotate_left(node);
+	}
+	else if (bf == -2) {
+	    if (node_balance_factor(node->left) > 0) {
+		node->left = node_rotate_left(node->left);
+		STATS_ADD(self, double_rotations, 1);
+	    }
+	    else {
+		STATS_ADD(self, rotations, 1);
+	    }
+
+	    *side = node_rotate_right(node);
+	}
+	else if (node->height == old) {
+	    break;
+	}
+    }
+
+    stats_update(self, unwind);
+    rv = Py_None;
+
+ cleanup:
+    Py_XINCREF(rv);
+
+    return rv;
+}
+
+
+static PyObject *tree_delete(struct AVLTree *self,
+			     PyObject *element)
+{
+    struct Node **stack[STACK_MAX] = { 0 }, **side = NULL, *node = NULL;
+    unsigned int count = 0, old = 0, unwind = 0;
+    int res = -1, bf = 0;
+    PyObject *rv = NULL;
+
+    /* Indexed ==> missing elements are found without a descent */
+    if (self->index != NULL) {
+	if ((res = PyDict_Contains(self->index, element)) == -1) {
+	    goto cleanup;
+	}
+
+	if (!res) {
+	    Py_RETURN_NONE;
+	}
+    }
+
+    side = &self->root;
+
+    while ((node = *side) != NULL) {
+	STACK_PUSH(stack, count, side);
+
+	/* element < node->element ==> left */
+	if ((res = TREE_LT(self, element, node->element)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    side = &node->left;
+	    continue;
+	}
+
+	/* node->element < element ==> right */
+	if ((res = TREE_LT(self, node->element, element)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    side = &node->right;
+	    continue;
+	}
+
+	break; /* equal ==> found */
+    }
+
+    if (node == NULL) {
+	Py_RETURN_NONE;
+    }
+
+    if (self->index != NULL && PyDict_DelItem(self->index, element) == -1) {
+	goto cleanup;
+    }
+
+    if (node->left != NULL && node->right != NULL) {
+	struct Node *target = node;
+
+	side = &node->right;
+	node = *side;
+
+	STACK_PUSH(stack, count, side);
+
+	while (node->left != NULL) {
+	    side = &node->left;
+	    node = *side;
+
+	    STACK_PUSH(stack, count, side);
+	}
+
+	if (node->right != NULL) {
+	    *side = node->right;
+	    node->right = NULL;
+	}
+	else {
+	    *side = NULL;
+	}
+
+	rv = target->element;
+	target->element = node->element;
+	node->element = NULL;
+    }
+    else {
+	if (node->left != NULL) {
+	    *side = node->left;
+	    node->left = NULL;
+	}
+	else if (node->right != NULL) {
+	    *side = node->right;
+	    node->right = NULL;
+	}
+	else {
+	    *side = NULL;
+	}
+
+	rv = node->element;
+	node->element = NULL;
+    }
+
+    /* Unlink the removed node from the thread. In the two children
+     * case it is the successor of target, which takes its place.
+     */
+    if (node->prev != NULL) {
+	node->prev->next = node->next;
+    }
+    else {
+	self->first = node->next;
+    }
+
+    if (node->next != NULL) {
+	node->next->prev = node->prev;
+    }
+    else {
+	self->last = node->prev;
+    }
+
+    node_dealloc(node);
+    STATS_ADD(self, frees, 1);
+    self->count--;
+    self->version++;
+
+    /* The subtree that took the place of the removed node has not
+     * changed height, so balancing starts at its parent.
+     */
+    --count;
+
+    while (count > 0) {
+	side = stack[--count];
+	node = *side;
+	old = node_update_height(node);
+	unwind++;
+	bf = node_balance_factor(node);
+
+	if (bf == 2) {
+	    if (node_balance_factor(node->right) < 0) {
+		node->right = node_rotate_right(node->right);
+		STATS_ADD(self, double_rotations, 1);
+	    }
+	    else {
+		STATS_ADD(self, rotations, 1);
+	    }
+
+	    *side = node_rotate_left(node);
+	}
+	else if (bf == -2) {
+	    if (node_balance_factor(node->left) > 0) {
+		node->left = node_rotate_left(node->left);
+		STATS_ADD(self, double_rotations, 1);
+	    }
+	    else {
+		STATS_ADD(self, rotations, 1);
+	    }
+
+	    *side = node_rotate_right(node);
+	}
+	else if (node->height == old) {
+	    break;
+	}
+    }
+
+    stats_update(self, unwind);
+
+ cleanup:
+    return rv;
+}
+
+
+/* Remove the elements e where e < bound, or when inclusive, where
+ * !(bound < e), and return them in order. Only the nodes on the path
+ * to the bound where it turns left are kept, and they are joined back
+ * together with their right subtrees, so removing k elements takes
+ * O(k + log n) instead of a delete per element.
+ */
+static PyObject *tree_pop(struct AVLTree *self,
+			  PyObject *bound, int inclusive)
+{
+    struct Node *stack[STACK_MAX] = { 0 }, *node = NULL, *first = NULL, *root = NULL, *next = NULL;
+    unsigned int count = 0, i = 0;
+    Py_ssize_t n = 0, k = 0;
+    PyObject *rv = NULL;
+    int res = -1;
+
+    node = self->root;
+
+    while (node != NULL) {
+	/* e < bound, or !(bound < e) when inclusive ==> popped, right */
+	if ((res = inclusive ? TREE_LT(self, bound, node->element) : TREE_LT(self, node->element, bound)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res != inclusive) {
+	    node = node->right;
+	    continue;
+	}
+
+	STACK_PUSH(stack, count, node);
+	node = node->left;
+    }
+
+    /* The popped elements are those before the least kept one. */
+    first = count > 0 ? stack[count - 1] : NULL;
+
+    for (node = self->first; node != first; node = node->next) {
+	k++;
+    }
+
+    if ((rv = PyList_New(k)) == NULL || k == 0) {
+	goto cleanup;
+    }
+
+    for (i = count; i > 0; i--) {
+	node = stack[i - 1];
+	root = node_join(self, root, node, node->right);
+    }
+
+    /* Publish the kept tree before the popped nodes are freed, as
+     * the index may run Python code that looks at the tree.
+     */
+    next = self->first;
+
+    if (first != NULL) {
+	first->prev = NULL;
+    }
+    else {
+	self->last = NULL;
+    }
+
+    self->root = root;
+    self->first = first;
+    self->count -= k;
+    self->version++;
+
+    /* The references to the elements pass to the list. */
+    for (node = next; n < k; node = next) {
+	next = node->next;
+	index_discard(self, node->element);
+	PyList_SET_ITEM(rv, n++, node->element);
+	node->element = NULL;
+	node_dealloc(node);
+    }
+
+    STATS_ADD(self, frees, k);
+
+    stats_update(self, count);
+
+ cleanup:
+    return rv;
+}
+
+
+/* Allocate or free the counters of a tree. Freeing them drops the
+ * callback too.
+ */
+static int stats_enable(struct AVLTree *self, int enable)
+{
+#if AVLTREE_STATS
+    struct Stats *stats = NULL;
+
+    if (enable && self->stats == NULL) {
+	if ((stats = PyMem_RawCalloc(1, sizeof *stats)) == NULL) {
+	    PyErr_NoMemory();
+	    return -1;
+	}
+
+	stats->interval = 1024;
+    }
+
+    RWLOCK_WRITE(&self->lock);
+
+    if (enable && self->stats == NULL) {
+	self->stats = stats;
+	stats = NULL;
+    }
+    else if (!enable) {
+	stats = self->stats;
+	self->stats = NULL;
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    if (stats != NULL) {
+	Py_XDECREF(stats->callback);
+	PyMem_RawFree(stats);
+    }
+
+    return 0;
+#else
+    if (enable) {
+	PyErr_SetString(PyExc_NotImplementedError, "built without AVLTREE_STATS");
+	return -1;
+    }
+
+    return 0;
+#endif
+}
+
+
+/* Count an update that rebalanced through unwind ancestors. Called
+ * with the lock held exclusive.
+ */
+static inline void stats_update(struct AVLTree *self, unsigned int unwind)
+{
+#if AVLTREE_STATS
+    struct Stats *stats = self->stats;
+
+    if (stats != NULL) {
+	stats->updates++;
+	stats->unwind += unwind;
+
+	if (unwind > stats->unwind_max) {
+	    stats->unwind_max = unwind;
+	}
+    }
+#endif
+}
+
+
+/* True when interval updates have passed since the callback was
+ * last called. Called with the lock held exclusive.
+ */
+static inline int stats_due(struct AVLTree *self)
+{
+    struct Stats *stats = self->stats;
+
+    if (stats == NULL || stats->callback == NULL ||
+	stats->updates - stats->notified < stats->interval) {
+	return 0;
+    }
+
+    stats->notified = stats->updates;
+
+    return 1;
+}
+
+
+/* Call the callback without the lock, so it may use the tree. The
+ * update that triggered it has succeeded, so errors are reported as
+ * unraisable rather than raised.
+ */
+static void stats_notify(struct AVLTree *self)
+{
+    PyObject *callback = NULL, *stats = NULL, *result = NULL;
+
+    RWLOCK_READ(&self->lock);
+
+    if (self->stats != NULL && self->stats->callback != NULL) {
+	callback = self->stats->callback;
+	Py_INCREF(callback);
+	stats = stats_dict(self->stats);
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    if (callback == NULL) {
+	return;
+    }
+
+    if (stats == NULL || (result = PyObject_CallOneArg(callback, stats)) == NULL) {
+	PyErr_WriteUnraisable(callback);
+    }
+
+    Py_XDECREF(result);
+    Py_XDECREF(stats);
+    Py_DECREF(callback);
+}
+
+
+static PyObject *stats_dict(struct Stats *stats)
+{
+    return Py_BuildValue("{sKsKsKsKsKsKsKsK}",
+			 "comparisons",      (unsigned long long) stats->comparisons,
+			 "rotations",        (unsigned long long) stats->rotations,
+			 "double_rotations", (unsigned long long) stats->double_rotations,
+			 "allocs",           (unsigned long long) stats->allocs,
+			 "frees",            (unsigned long long) stats->frees,
+			 "updates",          (unsigned long long) stats->updates,
+			 "unwind",           (unsigned long long) stats->unwind,
+			 "unwind_max",       (unsigned long long) stats->unwind_max);
+}
+
+
+/* Build or drop the hash index, a dict of the elements. Building it
+ * hashes every element, so it fails on unhashable ones.
+ */
+static int index_enable(struct AVLTree *self, int enable)
+{
+    PyObject *index = NULL;
+    struct Node *node = NULL;
+    int rv = -1;
+
+    RWLOCK_WRITE(&self->lock);
+
+    if (enable && self->index == NULL) {
+	if ((index = PyDict_New()) == NULL) {
+	    goto cleanup;
+	}
+
+	for (node = self->first; node != NULL; node = node->next) {
+	    if (PyDict_SetItem(index, node->element, node->element) == -1) {
+		goto cleanup;
+	    }
+	}
+
+	self->index = index;
+	index = NULL;
+    }
+    else if (!enable) {
+	index = self->index;
+	self->index = NULL;
+    }
+
+    rv = 0;
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+    Py_XDECREF(index);
+
+    return rv;
+}
+
+
+/* Remove element from the index after the tree has let go of it. If
+ * that fails, the index can no longer be trusted and is dropped.
+ */
+static void index_discard(struct AVLTree *self, PyObject *element)
+{
+    if (self->index != NULL && PyDict_DelItem(self->index, element) == -1) {
+	PyErr_WriteUnraisable(element);
+	Py_CLEAR(self->index);
+    }
+}
+
+
+/* Comparison of values for qsort().
+ */
+static int value_compare_signed(const void *a, const void *b)
+{
+    long long x = ((const union Value *) a)->i, y = ((const union Value *) b)->i;
+
+    return (x > y) - (x < y);
+}
+
+
+static int value_compare_unsigned(const void *a, const void *b)
+{
+    unsigned long long x = ((const union Value *) a)->u, y = ((const union Value *) b)->u;
+
+    return (x > y) - (x < y);
+}
+
+
+static int value_compare_float(const void *a, const void *b)
+{
+    double x = ((const union Value *) a)->d, y = ((const union Value *) b)->d;
+
+    return (x > y) - (x < y);
+}
+
+
+/* Read a one-dimensional buffer of native integers or floats into a
+ * new array of values, sort it unless sorted is set, and drop
+ * duplicates, all with the GIL released. Return 1 on success, 0 if
+ * buffer is not such a buffer, and -1 with an exception set if it is
+ * not sorted when sorted is set. A buffer holding NaN has no order:
+ * it is an error when sorted is set, otherwise it is not such a
+ * buffer, so that its elements are inserted by rich comparison.
+ */
+static int buffer_values(PyObject *buffer, int sorted, union Value **values,
+			 Py_ssize_t *count, enum Kind *kind)
+{
+    int (*compare)(const void *, const void *) = NULL;
+    const char *format = NULL, *item = NULL;
+    union Value *array = NULL;
+    Py_ssize_t i = 0, j = 0, n = 0;
+    Py_buffer view;
+    int rv = 0, nan = 0, unsorted = 0;
+    char code = 0;
+
+    if (!PyObject_CheckBuffer(buffer)) {
+	return 0;
+    }
+
+    if (PyObject_GetBuffer(buffer, &view, PyBUF_FORMAT|PyBUF_C_CONTIGUOUS) == -1) {
+	PyErr_Clear();
+	return 0;
+    }
+
+    format = view.format != NULL ? view.format : "B";
+    format += *format == '@';
+    code = *format;
+
+    if (view.ndim != 1 || code == 0 || format[1] != 0 || strchr("bBhHiIlLqQnNfd", code) == NULL) {
+	goto cleanup;
+    }
+
+    n = view.len / view.itemsize;
+
+    if ((array = PyMem_RawMalloc(Py_MAX(n, 1) * sizeof *array)) == NULL) {
+	PyErr_NoMemory();
+	rv = -1;
+	goto cleanup;
+    }
+
+    if (code == 'f' || code == 'd') {
+	*kind = KIND_FLOAT;
+	compare = value_compare_float;
+    }
+    else if (strchr("BHILQN", code) != NULL) {
+	*kind = KIND_UNSIGNED;
+	compare = value_compare_unsigned;
+    }
+    else {
+	*kind = KIND_SIGNED;
+	compare = value_compare_signed;
+    }
+
+#define VALUE_READ(type, field)				\
+    do {						\
+	type value_;					\
+	memcpy(&value_, item, sizeof value_);		\
+	array[i].field = value_;			\
+    } while(0)
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < n; i++) {
+	item = (const char *) view.buf + i * view.itemsize;
+
+	switch (code) {
+	case 'b': VALUE_READ(signed char, i); break;
+	case 'B': VALUE_READ(unsigned char, u); break;
+	case 'h': VALUE_READ(short, i); break;
+	case 'H': VALUE_READ(unsigned short, u); break;
+	case 'i': VALUE_READ(int, i); break;
+	case 'I': VALUE_READ(unsigned int, u); break;
+	case 'l': VALUE_READ(long, i); break;
+	case 'L': VALUE_READ(unsigned long, u); break;
+	case 'q': VALUE_READ(long long, i); break;
+	case 'Q': VALUE_READ(unsigned long long, u); break;
+	case 'n': VALUE_READ(Py_ssize_t, i); break;
+	case 'N': VALUE_READ(size_t, u); break;
+	case 'f': VALUE_READ(float, d); break;
+	case 'd': VALUE_READ(double, d); break;
+	}
+
+	nan |= *kind == KIND_FLOAT && isnan(array[i].d);
+    }
+
+    if (!nan && !sorted) {
+	qsort(array, n, sizeof *array, compare);
+    }
+
+    for (i = 0; !nan && i < n; i++) {
+	if (j > 0 && compare(&array[j - 1], &array[i]) >= 0) {
+	    unsorted |= compare(&array[j - 1], &array[i]) > 0;
+	    continue;
+	}
+
+	array[j++] = array[i];
+    }
+    Py_END_ALLOW_THREADS
+
+#undef VALUE_READ
+
+    if (nan && !sorted) {
+	goto cleanup;
+    }
+
+    if (nan || unsorted) {
+	PyErr_SetString(PyExc_ValueError, nan ? "cannot order NaN" : "buffer is not sorted");
+	rv = -1;
+	goto cleanup;
+    }
+
+    *values = array;
+    *count = j;
+    array = NULL;
+    rv = 1;
+
+ cleanup:
+    PyMem_RawFree(array);
+    PyBuffer_Release(&view);
+
+    return rv;
+}
+
+
+static PyObject *value_object(union Value value, enum Kind kind)
+{
+    switch (kind) {
+    case KIND_SIGNED:
+	return PyLong_FromLongLong(value.i);
+    case KIND_UNSIGNED:
+	return PyLong_FromUnsignedLongLong(value.u);
+    default:
+	return PyFloat_FromDouble(value.d);
+    }
+}
+
+
+/* Let other threads run for a moment.
+ */
+static inline void yield_gil(void)
+{
+    Py_BEGIN_ALLOW_THREADS
+    Py_END_ALLOW_THREADS
+}
+
+
+/* Call func(arg) in the default executor of the running event loop
+ * and return the future.
+ */
+static PyObject *run_in_executor(PyObject *func, PyObject *arg)
+{
+    PyObject *asyncio = NULL, *loop = NULL, *rv = NULL;
+
+    if ((asyncio = PyImport_ImportModule("asyncio")) == NULL) {
+	goto cleanup;
+    }
+
+    if ((loop = PyObject_CallMethod(asyncio, "get_running_loop", NULL)) == NULL) {
+	goto cleanup;
+    }
+
+    rv = PyObject_CallMethod(loop, "run_in_executor", "OOO", Py_None, func, arg);
+
+ cleanup:
+    Py_XDECREF(loop);
+    Py_XDECREF(asyncio);
+
+    return rv;
+}
+
+
+static int Iterator_init(struct Iterator *self, PyObject *args, PyObject *kwargs)
+{
+    static char *KWDS[] = { "tree", "reverse", NULL };
+    struct ModuleState *state = NULL;
+    PyObject *tree = NULL;
+    int rv = -1, reverse = 0;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	goto cleanup;
+    }
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!|p", KWDS,
+				     state->avltree_type, &tree, &reverse)) {
+	goto cleanup;
+    }
+
+    Py_INCREF(tree);
+    Py_XSETREF(self->tree, (struct AVLTree *)tree);
+    Py_CLEAR(self->stop);
+
+    RWLOCK_READ(&self->tree->lock);
+
+    self->version = self->tree->version;
+    self->node = reverse ? self->tree->last : self->tree->first;
+    self->remaining = self->tree->count;
+    self->reverse = reverse;
+
+    RWLOCK_RELEASE(&self->tree->lock);
+
+    rv = 0;
+
+ cleanup:
+    return rv;
+}
+
+
+static void Iterator_dealloc(struct Iterator *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+
+    Py_XDECREF(self->tree);
+    Py_XDECREF(self->stop);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
+
+
+static PyObject *Iterator_next(struct Iterator *self)
+{
+    PyObject *element = NULL;
+    int res = -1;
+
+    if (self->node == NULL) {
+	return NULL;
+    }
+
+    RWLOCK_READ(&self->tree->lock);
+
+    if (self->version != self->tree->version) {
+	PyErr_SetString(PyExc_RuntimeError, "AVLTree changed during iteration");
+	self->node = NULL;
+	self->remaining = 0;
+	goto cleanup;
+    }
+
+    /* !(e < hi), or when reversed e < lo ==> end of range */
+    if (self->stop != NULL) {
+	if ((res = TREE_LT(self->tree, self->node->element, self->stop)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res == self->reverse) {
+	    self->node = NULL;
+	    goto cleanup;
+	}
+    }
+
+    element = self->node->element;
+    Py_INCREF(element);
+
+    self->node = self->reverse ? self->node->prev : self->node->next;
+
+    if (self->remaining > 0) {
+	self->remaining--;
+    }
+
+ cleanup:
+    RWLOCK_RELEASE(&self->tree->lock);
+
+    return element;
+}
+
+
+/* The length of a range is not known (-1).
+ */
+static PyObject *Iterator_length_hint(struct Iterator *self,
+				      PyObject *Py_UNUSED(ignored))
+{
+    if (self->remaining < 0) {
+	Py_RETURN_NOTIMPLEMENTED;
+    }
+
+    return PyLong_FromSsize_t(self->remaining);
+}
+
+
+static PyObject *MappedTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    struct MappedTree *self = NULL;
+
+    if ((self = (struct MappedTree *) PyType_GenericNew(type, args, kwargs)) != NULL) {
+	self->fd = -1;
+	RWLOCK_INIT(&self->lock);
+    }
+
+    return (PyObject *) self;
+}
+
+
+static int MappedTree_init(struct MappedTree *self, PyObject *args, PyObject *kwargs)
+{
+    static char *KWDS[] = { "path", "iterable", NULL };
+    PyObject *path = NULL, *iterable = NULL, *iterator = NULL, *element = NULL, *result = NULL;
+    struct MappedHeader *header = NULL;
+    struct stat st;
+    int fresh = 0, rv = -1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O&|O", KWDS,
+				     PyUnicode_FSConverter, &path, &iterable)) {
+	goto cleanup;
+    }
+
+    if (self->base != NULL) {
+	PyErr_SetString(PyExc_RuntimeError, "tree already open");
+	goto cleanup;
+    }
+
+    if ((self->fd = open(PyBytes_AS_STRING(path), O_RDWR|O_CREAT, 0644)) == -1 ||
+	fstat(self->fd, &st) == -1) {
+	PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+	goto cleanup;
+    }
+
+    if (st.st_size == 0) {
+	st.st_size = sizeof *header + MAPPED_INITIAL * sizeof(struct MappedNode);
+	fresh = 1;
+
+	if (ftruncate(self->fd, st.st_size) == -1) {
+	    PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+	    goto cleanup;
+	}
+    }
+    else if ((size_t) st.st_size < sizeof *header) {
+	PyErr_Format(PyExc_ValueError, "%R: not a mapped tree", path);
+	goto cleanup;
+    }
+
+    self->size = st.st_size;
+
+    if ((self->base = mmap(NULL, self->size, PROT_READ|PROT_WRITE,
+			   MAP_SHARED, self->fd, 0)) == MAP_FAILED) {
+	self->base = NULL;
+	PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+	goto cleanup;
+    }
+
+    header = MAPPED_HEADER(self);
+
+    if (header->magic[0] == '\0' && fresh) {
+	memcpy(header->magic, MAPPED_MAGIC, sizeof header->magic);
+	header->end = sizeof *header;
+    }
+    else if (memcmp(header->magic, MAPPED_MAGIC, sizeof header->magic) != 0 ||
+	     !mapped_valid(self)) {
+	PyErr_Format(PyExc_ValueError, "%R: not a mapped tree", path);
+	goto cleanup;
+    }
+
+    if (iterable != NULL) {
+	if ((iterator = PyObject_GetIter(iterable)) == NULL) {
+	    goto cleanup;
+	}
+
+	while ((element = PyIter_Next(iterator)) != NULL) {
+	    result = MappedTree_insert(self, element);
+	    Py_DECREF(element);
+
+	    if (result == NULL) {
+		goto cleanup;
+	    }
+
+	    Py_DECREF(result);
+	}
+
+	if (PyErr_Occurred()) {
+	    goto cleanup;
+	}
+    }
+
+    rv = 0;
+
+ cleanup:
+    Py_XDECREF(path);
+    Py_XDECREF(iterator);
+
+    return rv;
+}
+
+
+static void MappedTree_dealloc(struct MappedTree *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+
+    mapped_close(self);
+    RWLOCK_DESTROY(&self->lock);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
+
+
+static PyObject *MappedTree_iter(struct MappedTree *self)
+{
+    struct MappedIterator *iterator = NULL;
+    struct ModuleState *state = NULL;
+    PyObject *rv = NULL;
+    Offset node = 0;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    if ((iterator = PyObject_New(struct MappedIterator, state->mappediterator_type)) == NULL) {
+	return NULL;
+    }
+
+    Py_INCREF(self);
+    iterator->tree = self;
+    iterator->count = 0;
+
+    RWLOCK_READ(&self->lock);
+
+    iterator->version = self->version;
+
+    if (mapped_check(self) == -1) {
+	goto cleanup;
+    }
+
+    for (node = MAPPED_HEADER(self)->root; node != 0; node = MAPPED_NODE(self, node)->left) {
+	MAPPED_FOLLOW(self, node);
+	MAPPED_PUSH(iterator->stack, iterator->count, node);
+    }
+
+    rv = (PyObject *) iterator;
+    iterator = NULL;
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+    Py_XDECREF(iterator);
+
+    return rv;
+}
+
+
+static Py_ssize_t MappedTree_len(struct MappedTree *self)
+{
+    Py_ssize_t rv = -1;
+
+    RWLOCK_READ(&self->lock);
+
+    if (mapped_check(self) == 0) {
+	rv = MAPPED_HEADER(self)->count;
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static int MappedTree_contains(struct MappedTree *self, PyObject *element)
+{
+    unsigned long long value = 0;
+    struct MappedNode *node = NULL;
+    unsigned int depth = 0;
+    Offset off = 0;
+    int rv = -1;
+
+    value = PyLong_AsUnsignedLongLong(element);
+
+    if (value == (unsigned long long) -1 && PyErr_Occurred()) {
+	if (PyErr_ExceptionMatches(PyExc_OverflowError) ||
+	    PyErr_ExceptionMatches(PyExc_TypeError)) {
+	    PyErr_Clear();
+	    rv = 0;
+	}
+
+	return rv;
+    }
+
+    RWLOCK_READ(&self->lock);
+
+    if (mapped_check(self) == -1) {
+	goto cleanup;
+    }
+
+    off = MAPPED_HEADER(self)->root;
+
+    while (off != 0) {
+	MAPPED_FOLLOW(self, off);
+
+	if (++depth > STACK_MAX) {
+	    PyErr_SetString(PyExc_ValueError, "corrupt mapped tree");
+	    goto cleanup;
+	}
+
+	node = MAPPED_NODE(self, off);
+
+	if (value < node->element) {
+	    off = node->left;
+	}
+	else if (node->element < value) {
+	    off = node->right;
+	}
+	else {
+	    break; /* equal ==> found */
+	}
+    }
+
+    rv = off != 0;
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *MappedTree_insert(struct MappedTree *self,
+				   PyObject *element)
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_WRITE(&self->lock);
+    rv = mapped_insert(self, element);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *MappedTree_delete(struct MappedTree *self,
+				   PyObject *element)
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_WRITE(&self->lock);
+    rv = mapped_delete(self, element);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *MappedTree_to_tuple(struct MappedTree *self,
+				     PyObject *Py_UNUSED(ignored))
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_READ(&self->lock);
+
+    if (mapped_check(self) == 0) {
+	rv = mnode_to_tuple(self, MAPPED_HEADER(self)->root, 0);
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *MappedTree_flush(struct MappedTree *self,
+				  PyObject *Py_UNUSED(ignored))
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_READ(&self->lock);
+
+    if (mapped_check(self) == -1) {
+	goto cleanup;
+    }
+
+    if (msync(self->base, self->size, MS_ASYNC) == -1) {
+	PyErr_SetFromErrno(PyExc_OSError);
+	goto cleanup;
+    }
+
+    rv = Py_None;
+    Py_INCREF(rv);
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *MappedTree_sync(struct MappedTree *self,
+				 PyObject *Py_UNUSED(ignored))
+{
+    PyObject *rv = NULL;
+    int res = 0;
+
+    RWLOCK_READ(&self->lock);
+
+    if (mapped_check(self) == -1) {
+	goto cleanup;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    res = msync(self->base, self->size, MS_SYNC);
+
+    if (res == 0) {
+	res = fsync(self->fd);
+    }
+    Py_END_ALLOW_THREADS
+
+    if (res == -1) {
+	PyErr_SetFromErrno(PyExc_OSError);
+	goto cleanup;
+    }
+
+    rv = Py_None;
+    Py_INCREF(rv);
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *MappedTree_close(struct MappedTree *self,
+				  PyObject *Py_UNUSED(ignored))
+{
+    RWLOCK_WRITE(&self->lock);
+    mapped_close(self);
+    RWLOCK_RELEASE(&self->lock);
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *MappedTree_enter(struct MappedTree *self,
+				  PyObject *Py_UNUSED(ignored))
+{
+    if (mapped_check(self) == -1) {
+	return NULL;
+    }
+
+    Py_INCREF(self);
+
+    return (PyObject *) self;
+}
+
+
+static PyObject *MappedTree_exit(struct MappedTree *self,
+				 PyObject *Py_UNUSED(args))
+{
+    return MappedTree_close(self, NULL);
+}
+
+
+static PyObject *MappedTree_getheight(struct MappedTree *self,
+				      void *Py_UNUSED(ignored))
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_READ(&self->lock);
+
+    if (mapped_check(self) == 0) {
+	rv = PyLong_FromUnsignedLong(mnode_height(self, MAPPED_HEADER(self)->root));
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static void MappedIterator_dealloc(struct MappedIterator *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+
+    Py_XDECREF(self->tree);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
+
+
+static PyObject *MappedIterator_next(struct MappedIterator *self)
+{
+    struct MappedTree *tree = self->tree;
+    struct MappedNode *node = NULL;
+    PyObject *rv = NULL;
+    Offset off = 0;
+
+    if (self->count == 0) {
+	return NULL;
+    }
+
+    RWLOCK_READ(&tree->lock);
+
+    if (mapped_check(tree) == -1) {
+	goto cleanup;
+    }
+
+    if (self->version != tree->version) {
+	PyErr_SetString(PyExc_RuntimeError, "MappedTree changed during iteration");
+	self->count = 0;
+	goto cleanup;
+    }
+
+    node = MAPPED_NODE(tree, self->stack[--self->count]);
+
+    for (off = node->right; off != 0; off = MAPPED_NODE(tree, off)->left) {
+	MAPPED_FOLLOW(tree, off);
+	MAPPED_PUSH(self->stack, self->count, off);
+    }
+
+    rv = PyLong_FromUnsignedLongLong(node->element);
+
+ cleanup:
+    RWLOCK_RELEASE(&tree->lock);
+
+    return rv;
+}
+
+
+static PyObject *PersistentTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *KWDS[] = { "iterable", NULL };
+    PyObject *iterable = NULL, *iterator = NULL, *element = NULL, *rv = NULL;
+    struct PersistentNode *root = NULL, *result = NULL;
+    Py_ssize_t count = 0;
+    int res = -1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:PersistentTree", KWDS, &iterable)) {
+	return NULL;
+    }
+
+    if (iterable != NULL) {
+	if ((iterator = PyObject_GetIter(iterable)) == NULL) {
+	    goto cleanup;
+	}
+
+	while ((element = PyIter_Next(iterator)) != NULL) {
+	    res = pnode_insert(root, element, 0, &result, &count);
+	    Py_DECREF(element);
+
+	    if (res == -1) {
+		goto cleanup;
+	    }
+
+	    if (res == 1) {
+		pnode_release(root);
+		root = result;
+	    }
+	}
+
+	if (PyErr_Occurred()) {
+	    goto cleanup;
+	}
+    }
+
+    rv = persistent_alloc(type, root, count);
+    root = NULL;
+
+ cleanup:
+    Py_XDECREF(iterator);
+    pnode_release(root);
+
+    return rv;
+}
+
+
+static void PersistentTree_dealloc(struct PersistentTree *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+
+    pnode_release(self->root);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
+
+
+static PyObject *PersistentTree_iter(struct PersistentTree *self)
+{
+    return persistent_iter(self, NULL, NULL, 0);
+}
+
+
+static PyObject *PersistentTree_reversed(struct PersistentTree *self,
+					 PyObject *Py_UNUSED(ignored))
+{
+    return persistent_iter(self, NULL, NULL, 1);
+}
+
+
+static Py_ssize_t PersistentTree_len(struct PersistentTree *self)
+{
+    return self->count;
+}
+
+
+static int PersistentTree_contains(struct PersistentTree *self, PyObject *element)
+{
+    struct PersistentNode *node = NULL;
+    int res = -1;
+
+    node = self->root;
+
+    while (node != NULL) {
+	/* element < node->element ==> left */
+	if ((res = PyObject_RichCompareBool(element, node->element, Py_LT)) == -1) {
+	    return -1;
+	}
+
+	if (res) {
+	    node = node->left;
+	    continue;
+	}
+
+	/* node->element < element ==> right */
+	if ((res = PyObject_RichCompareBool(node->element, element, Py_LT)) == -1) {
+	    return -1;
+	}
+
+	if (res) {
+	    node = node->right;
+	    continue;
+	}
+
+	break; /* equal ==> found */
+    }
+
+    return node != NULL;
+}
+
+
+static PyObject *PersistentTree_insert(struct PersistentTree *self, PyObject *const *args,
+				       Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "element", "replace", NULL };
+    PyObject *values[2] = { NULL, NULL };
+    struct PersistentNode *root = NULL;
+    Py_ssize_t count = self->count;
+    int replace = 0, res = -1;
+
+    if (parse_args("insert", args, nargs, kwnames, KWDS, 2, 1, values) == -1) {
+	return NULL;
+    }
+
+    if (values[1] != NULL && (replace = PyObject_IsTrue(values[1])) == -1) {
+	return NULL;
+    }
+
+    if ((res = pnode_insert(self->root, values[0], replace, &root, &count)) == -1) {
+	return NULL;
+    }
+
+    if (res == 0) {
+	Py_INCREF(self);
+	return (PyObject *) self;
+    }
+
+    return persistent_alloc(Py_TYPE(self), root, count);
+}
+
+
+static PyObject *PersistentTree_delete(struct PersistentTree *self, PyObject *const *args,
+				       Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "element", NULL };
+    PyObject *values[1] = { NULL };
+    struct PersistentNode *root = NULL;
+    Py_ssize_t count = self->count;
+    int res = -1;
+
+    if (parse_args("delete", args, nargs, kwnames, KWDS, 1, 1, values) == -1) {
+	return NULL;
+    }
+
+    if ((res = pnode_delete(self->root, values[0], &root, &count)) == -1) {
+	return NULL;
+    }
+
+    if (res == 0) {
+	Py_INCREF(self);
+	return (PyObject *) self;
+    }
+
+    return persistent_alloc(Py_TYPE(self), root, count);
+}
+
+
+static PyObject *PersistentTree_range(struct PersistentTree *self, PyObject *const *args,
+				      Py_ssize_t nargs, PyObject *kwnames)
+{
+    PyObject *lo = NULL, *hi = NULL;
+    int reverse = 0;
+
+    if (parse_range(args, nargs, kwnames, &lo, &hi, &reverse) == -1) {
+	return NULL;
+    }
+
+    return persistent_iter(self, lo, hi, reverse);
+}
+
+
+/* Walk both trees in order. Subtrees that the trees share are the
+ * same, so they are skipped without looking at their elements. Of
+ * two unvisited subtrees, the taller one is expanded first, so that
+ * shared subtrees line up. Elements that compare equal are unchanged.
+ */
+static PyObject *PersistentTree_diff(struct PersistentTree *self, PyObject *other)
+{
+    struct DiffCursor a = { .count = 0 }, b = { .count = 0 };
+    PyObject *removed = NULL, *added = NULL, *rv = NULL, *ea = NULL, *eb = NULL;
+    struct ModuleState *state = NULL;
+    int res = -1;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    if (!PyObject_TypeCheck(other, state->persistenttree_type)) {
+	PyErr_Format(PyExc_TypeError, "diff() argument must be PersistentTree, not %.200s",
+		     Py_TYPE(other)->tp_name);
+	return NULL;
+    }
+
+    if ((removed = PyList_New(0)) == NULL ||
+	(added = PyList_New(0)) == NULL) {
+	goto cleanup;
+    }
+
+    if (diff_push(&a, self->root) == -1 ||
+	diff_push(&b, ((struct PersistentTree *) other)->root) == -1) {
+	goto cleanup;
+    }
+
+    while (a.count > 0 || b.count > 0) {
+	if (a.count > 0 && !a.expanded[a.count - 1] &&
+	    b.count > 0 && !b.expanded[b.count - 1]) {
+	    if (a.node[a.count - 1] == b.node[b.count - 1]) {
+		a.count--;
+		b.count--;
+		continue;
+	    }
+
+	    res = a.node[a.count - 1]->height >= b.node[b.count - 1]->height ?
+		diff_expand(&a) : diff_expand(&b);
+	}
+	else if (a.count > 0 && !a.expanded[a.count - 1]) {
+	    res = diff_expand(&a);
+	}
+	else if (b.count > 0 && !b.expanded[b.count - 1]) {
+	    res = diff_expand(&b);
+	}
+	else if (b.count == 0) {
+	    res = PyList_Append(removed, a.node[a.count - 1]->element) == -1 ? -1 : diff_advance(&a);
+	}
+	else if (a.count == 0) {
+	    res = PyList_Append(added, b.node[b.count - 1]->element) == -1 ? -1 : diff_advance(&b);
+	}
+	else {
+	    ea = a.node[a.count - 1]->element;
+	    eb = b.node[b.count - 1]->element;
+
+	    /* ea < eb ==> removed */
+	    if ((res = PyObject_RichCompareBool(ea, eb, Py_LT)) == -1) {
+		goto cleanup;
+	    }
+
+	    if (res) {
+		res = PyList_Append(removed, ea) == -1 ? -1 : diff_advance(&a);
+	    }
+	    /* eb < ea ==> added */
+	    else if ((res = PyObject_RichCompareBool(eb, ea, Py_LT)) == -1) {
+		goto cleanup;
+	    }
+	    else if (res) {
+		res = PyList_Append(added, eb) == -1 ? -1 : diff_advance(&b);
+	    }
+	    else {
+		res = diff_advance(&a) == -1 ? -1 : diff_advance(&b);
+	    }
+	}
+
+	if (res == -1) {
+	    goto cleanup;
+	}
+    }
+
+    rv = PyTuple_Pack(2, removed, added);
+
+ cleanup:
+    Py_XDECREF(removed);
+    Py_XDECREF(added);
+
+    return rv;
+}
+
+
+static PyObject *PersistentTree_to_tuple(struct PersistentTree *self,
+					 PyObject *Py_UNUSED(ignored))
+{
+    return pnode_to_tuple(self->root);
+}
+
+
+static PyObject *PersistentTree_to_list(struct PersistentTree *self,
+					PyObject *Py_UNUSED(ignored))
+{
+    struct PersistentNode *stack[STACK_MAX] = { 0 }, *node = NULL;
+    unsigned int count = 0;
+    PyObject *rv = NULL;
+    Py_ssize_t i = 0;
+
+    if ((rv = PyList_New(self->count)) == NULL) {
+	return NULL;
+    }
+
+    node = self->root;
+
+    while (1) {
+	/* Height is bounded by STACK_MAX, see insert. */
+	for (; node != NULL; node = node->left) {
+	    stack[count++] = node;
+	}
+
+	if (count == 0) {
+	    break;
+	}
+
+	node = stack[--count];
+	Py_INCREF(node->element);
+	PyList_SET_ITEM(rv, i++, node->element);
+	node = node->right;
+    }
+
+    return rv;
+}
+
+
+static PyObject *PersistentTree_getheight(struct PersistentTree *self,
+					  void *Py_UNUSED(ignored))
+{
+    return PyLong_FromUnsignedLong(pnode_height(self->root));
+}
+
+
+static void PersistentIterator_dealloc(struct PersistentIterator *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+
+    Py_XDECREF(self->tree);
+    Py_XDECREF(self->stop);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
+
+
+static PyObject *PersistentIterator_next(struct PersistentIterator *self)
+{
+    struct PersistentNode *node = NULL, *child = NULL;
+    int res = -1;
+
+    if (self->count == 0) {
+	return NULL;
+    }
+
+    node = self->stack[self->count - 1];
+
+    /* !(e < hi), or when reversed e < lo ==> end of range */
+    if (self->stop != NULL) {
+	if ((res = PyObject_RichCompareBool(node->element, self->stop, Py_LT)) == -1) {
+	    return NULL;
+	}
+
+	if (res == self->reverse) {
+	    self->count = 0;
+	    return NULL;
+	}
+    }
+
+    self->count--;
+    child = self->reverse ? node->left : node->right;
+
+    for (; child != NULL; child = self->reverse ? child->right : child->left) {
+	self->stack[self->count++] = child;
+    }
+
+    if (self->remaining > 0) {
+	self->remaining--;
+    }
+
+    Py_INCREF(node->element);
+
+    return node->element;
+}
+
+
+/* The length of a range is not known (-1).
+ */
+static PyObject *PersistentIterator_length_hint(struct PersistentIterator *self,
+						PyObject *Py_UNUSED(ignored))
+{
+    if (self->remaining < 0) {
+	Py_RETURN_NOTIMPLEMENTED;
+    }
+
+    return PyLong_FromSsize_t(self->remaining);
+}
+
+
+static struct Node *node_alloc(PyObject *element)
+{
+    struct Node *node = NULL;
+
+    if ((node = PyMem_RawCalloc(1, sizeof *node)) == NULL) {
+	PyErr_NoMemory();
+	goto cleanup;
+    }
+
+    Py_INCREF(element);
+    node->element = element;
+    node->height  = 1;
+
+ cleanup:
+    return node;
+}
+
+
+static void node_dealloc(struct Node *node)
+{
+    if (node != NULL) {
+	Py_XDECREF(node->element);
+	PyMem_RawFree(node);
+    }
+}
+
+
+static inline unsigned int node_height(struct Node *node)
+{
+    return node ? node->height : 0;
+}
+
+
+static unsigned int node_update_height(struct Node *node)
+{
+    unsigned int rv = 0;
+
+    rv = node->height;
+
+    node->height = 1 + Py_MAX(node_height(node->left),
+			      node_height(node->right));
+
+    return rv;
+}
+
+
+static inline int node_balance_factor(struct Node *node)
+{
+    return node_height(node->right) - node_height(node->left);
+}
+
+
+static struct Node *node_rotate_left(struct Node *node)
+{
+    struct Node *root = NULL;
+
+    root = node->right;
+    node->right = root->left;
+    root->left = node;
+
+    node_update_height(node);
+    node_update_height(root);
+
+    return root;
+}
+
+
+static struct Node *node_rotate_right(struct Node *node)
+{
+    struct Node *root = NULL;
+
+    root = node->left;
+    node->left = root->right;
+    root->right = node;
+
+    node_update_height(node);
+    node_update_height(root);
+
+    return root;
+}
+
+
+/* Update the height of node and rotate it back into balance if
+ * needed. Returns the root of the subtree.
+ */
+static struct Node *node_balance(struct AVLTree *self, struct Node *node)
+{
+    int bf = 0;
+
+    node_update_height(node);
+    bf = node_balance_factor(node);
+
+    if (bf == 2) {
+	if (node_balance_factor(node->right) < 0) {
+	    node->right = node_rotate_right(node->right);
+	    STATS_ADD(self, double_rotations, 1);
+	}
+	else {
+	    STATS_ADD(self, rotations, 1);
+	}
+
+	return node_rotate_left(node);
+    }
+
+    if (bf == -2) {
+	if (node_balance_factor(node->left) > 0) {
+	    node->left = node_rotate_left(node->left);
+	    STATS_ADD(self, double_rotations, 1);
+	}
+	else {
+	    STATS_ADD(self, rotations, 1);
+	}
+
+	return node_rotate_right(node);
+    }
+
+    return node;
+}
+
+
+/* Join left, node and right into a balanced tree, where the elements
+ * of left are less than node and those of right greater. Node goes
+ * down the inner spine of the taller tree to where the other one is
+ * as high, which grows the spine by at most one level, as an insert
+ * would. The spine is no longer than the tree height, well within
+ * STACK_MAX.
+ */
+static struct Node *node_join(struct AVLTree *self, struct Node *left, struct Node *node, struct Node *right)
+{
+    struct Node **stack[STACK_MAX], **side = NULL, *root = NULL;
+    unsigned int count = 0, hl = node_height(left), hr = node_height(right);
+
+    node->left = left;
+    node->right = right;
+    side = &root;
+
+    if (hl > hr + 1) {
+	for (root = left; node_height(*side) > hr + 1; side = &(*side)->right) {
+	    stack[count++] = side;
+	}
+
+	node->left = *side;
+    }
+    else if (hr > hl + 1) {
+	for (root = right; node_height(*side) > hl + 1; side = &(*side)->left) {
+	    stack[count++] = side;
+	}
+
+	node->right = *side;
+    }
+
+    node_update_height(node);
+    *side = node;
+
+    while (count > 0) {
+	side = stack[--count];
+	*side = node_balance(self, *side);
+    }
+
+    return root;
+}
+
+
+/* Link sorted nodes into a tree of minimal height and return its
+ * root. Needs no GIL.
+ */
+static struct Node *node_build(struct Node **nodes, Py_ssize_t count)
+{
+    struct Node *node = NULL;
+    Py_ssize_t middle = count / 2;
+
+    if (count == 0) {
+	return NULL;
+    }
+
+    node = nodes[middle];
+    node->left  = node_build(nodes, middle);
+    node->right = node_build(nodes + middle + 1, count - middle - 1);
+    node_update_height(node);
+
+    return node;
+}
+
+
+static PyObject *node_to_tuple(struct Node *node)
+{
+    PyObject *l = NULL, *r = NULL, *e = NULL, *h = NULL, *t = NULL;
+
+    if (node == NULL) {
+	Py_RETURN_NONE;
+    }
+
+    if ((l = node_to_tuple(node->left)) == NULL) {
+	goto cleanup;
+    }
+
+    if ((r = node_to_tuple(node->right)) == NULL) {
+	goto cleanup;
+    }
+
+    e = node->element;
+    Py_INCREF(e);
+
+    if ((h = PyLong_FromUnsignedLong(node->height)) == NULL) {
+	goto cleanup;
+    }
+
+    t = PyTuple_Pack(4, l, e, h, r);
+
+ cleanup:
+    Py_XDECREF(l);
+    Py_XDECREF(r);
+    Py_XDECREF(e);
+    Py_XDECREF(h);
+
+    return t;
+}
+
+
+static PyObject *mapped_insert(struct MappedTree *self,
+			      PyObject *element)
+{
+    Offset stack[STACK_MAX] = { 0 }, side = 0, off = 0;
+    unsigned long long value = 0;
+    struct MappedNode *node = NULL;
+    unsigned int count = 0;
+    PyObject *rv = NULL;
+
+    if (mapped_check(self) == -1) {
+	goto cleanup;
+    }
+
+    value = PyLong_AsUnsignedLongLong(element);
+
+    if (value == (unsigned long long) -1 && PyErr_Occurred()) {
+	goto cleanup;
+    }
+
+    /* Sides are file offsets of the link fields, so they stay valid
+     * if the file is remapped when allocating the new node.
+     */
+    side = offsetof(struct MappedHeader, root);
+
+    while ((off = *MAPPED_REF(self, side)) != 0) {
+	MAPPED_FOLLOW(self, off);
+	MAPPED_PUSH(stack, count, side);
+	node = MAPPED_NODE(self, off);
+
+	if (value < node->element) {
+	    side = off + offsetof(struct MappedNode, left);
+	}
+	else if (node->element < value) {
+	    side = off + offsetof(struct MappedNode, right);
+	}
+	else {
+	    /* equal ==> return element */
+	    rv = PyLong_FromUnsignedLongLong(node->element);
+	    goto cleanup;
+	}
+    }
+
+    if ((off = mnode_alloc(self, value)) == 0) {
+	goto cleanup;
+    }
+
+    *MAPPED_REF(self, side) = off;
+    MAPPED_HEADER(self)->count++;
+    self->version++;
+
+    mnode_unwind(self, stack, count);
+
+    rv = Py_None;
+    Py_INCREF(rv);
+
+ cleanup:
+    return rv;
+}
+
+
+static PyObject *mapped_delete(struct MappedTree *self,
+			      PyObject *element)
+{
+    Offset stack[STACK_MAX] = { 0 }, side = 0, off = 0;
+    unsigned long long value = 0;
+    struct MappedNode *node = NULL;
+    unsigned int count = 0;
+    PyObject *rv = NULL;
+
+    if (mapped_check(self) == -1) {
+	goto cleanup;
+    }
+
+    value = PyLong_AsUnsignedLongLong(element);
+
+    if (value == (unsigned long long) -1 && PyErr_Occurred()) {
+	goto cleanup;
+    }
+
+    side = offsetof(struct MappedHeader, root);
+
+    while ((off = *MAPPED_REF(self, side)) != 0) {
+	MAPPED_FOLLOW(self, off);
+	MAPPED_PUSH(stack, count, side);
+	node = MAPPED_NODE(self, off);
+
+	if (value < node->element) {
+	    side = off + offsetof(struct MappedNode, left);
+	}
+	else if (node->element < value) {
+	    side = off + offsetof(struct MappedNode, right);
+	}
+	else {
+	    break; /* equal ==> found */
+	}
+    }
+
+    if (off == 0) {
+	Py_RETURN_NONE;
+    }
+
+    MAPPED_FOLLOW(self, node->left);
+
+    if (node->left != 0 && node->right != 0) {
+	struct MappedNode *target = node;
+
+	side = off + offsetof(struct MappedNode, right);
+	off = *MAPPED_REF(self, side);
+	MAPPED_FOLLOW(self, off);
+	node = MAPPED_NODE(self, off);
+
+	MAPPED_PUSH(stack, count, side);
+
+	while (node->left != 0) {
+	    side = off + offsetof(struct MappedNode, left);
+	    off = *MAPPED_REF(self, side);
+	    MAPPED_FOLLOW(self, off);
+	    node = MAPPED_NODE(self, off);
+
+	    MAPPED_PUSH(stack, count, side);
+	}
+
+	MAPPED_FOLLOW(self, node->right);
+
+	if ((rv = PyLong_FromUnsignedLongLong(target->element)) == NULL) {
+	    goto cleanup;
+	}
+
+	*MAPPED_REF(self, side) = node->right;
+	target->element = node->element;
+    }
+    else {
+	MAPPED_FOLLOW(self, node->right);
+
+	if ((rv = PyLong_FromUnsignedLongLong(node->element)) == NULL) {
+	    goto cleanup;
+	}
+
+	*MAPPED_REF(self, side) = node->left != 0 ? node->left : node->right;
+    }
+
+    mnode_free(self, off);
+    MAPPED_HEADER(self)->count--;
+    self->version++;
+
+    /* Balancing starts at the parent of the removed node. */
+    --count;
+
+    mnode_unwind(self, stack, count);
+
+ cleanup:
+    return rv;
+}
+
+
+static void mapped_close(struct MappedTree *self)
+{
+    self->version++;
+
+    if (self->base != NULL) {
+	munmap(self->base, self->size);
+	self->base = NULL;
+	self->size = 0;
+    }
+
+    if (self->fd != -1) {
+	close(self->fd);
+	self->fd = -1;
+    }
+}
+
+
+static int mapped_check(struct MappedTree *self)
+{
+    if (self->base == NULL) {
+	PyErr_SetString(PyExc_ValueError, "I/O operation on closed tree");
+	return -1;
+    }
+
+    return 0;
+}
+
+
+/* Check that the header offsets of an existing file point at node
+ * slots inside the mapping.
+ */
+static int mapped_valid(struct MappedTree *self)
+{
+    struct MappedHeader *header = MAPPED_HEADER(self);
+    const Offset first = sizeof *header, size = sizeof(struct MappedNode);
+
+    if (header->end < first || header->end > self->size ||
+	(header->end - first) % size != 0 ||
+	header->count > (header->end - first) / size) {
+	return 0;
+    }
+
+    if ((header->root != 0 && !mapped_slot(self, header->root)) ||
+	(header->free != 0 && !mapped_slot(self, header->free))) {
+	return 0;
+    }
+
+    return 1;
+}
+
+
+/* Is off the offset of a node slot below the end of the file?
+ */
+static inline int mapped_slot(struct MappedTree *self, Offset off)
+{
+    const Offset first = sizeof(struct MappedHeader), size = sizeof(struct MappedNode);
+
+    return off >= first && off + size <= MAPPED_HEADER(self)->end && (off - first) % size == 0;
+}
+
+
+static int mapped_grow(struct MappedTree *self)
+{
+    size_t size = self->size * 2;
+    char *base = NULL;
+
+    if (ftruncate(self->fd, size) == -1) {
+	PyErr_SetFromErrno(PyExc_OSError);
+	return -1;
+    }
+
+    if ((base = mmap(NULL, size, PROT_READ|PROT_WRITE,
+		     MAP_SHARED, self->fd, 0)) == MAP_FAILED) {
+	PyErr_SetFromErrno(PyExc_OSError);
+	return -1;
+    }
+
+    munmap(self->base, self->size);
+
+    self->base = base;
+    self->size = size;
+
+    return 0;
+}
+
+
+static Offset mnode_alloc(struct MappedTree *self, uint64_t element)
+{
+    struct MappedHeader *header = MAPPED_HEADER(self);
+    struct MappedNode *node = NULL;
+    Offset off = 0;
+
+    if (header->free != 0) {
+	off = header->free;
+
+	if (!mapped_slot(self, off) ||
+	    (MAPPED_NODE(self, off)->left != 0 && !mapped_slot(self, MAPPED_NODE(self, off)->left))) {
+	    PyErr_SetString(PyExc_ValueError, "corrupt mapped tree");
+	    return 0;
+	}
+
+	header->free = MAPPED_NODE(self, off)->left;
+    }
+    else {
+	if (header->end + sizeof *node > self->size) {
+	    if (mapped_grow(self) == -1) {
+		return 0;
+	    }
+
+	    header = MAPPED_HEADER(self);
+	}
+
+	off = header->end;
+	header->end += sizeof *node;
+    }
+
+    node = MAPPED_NODE(self, off);
+    memset(node, 0, sizeof *node);
+    node->element = element;
+    node->height  = 1;
+
+    return off;
+}
+
+
+static void mnode_free(struct MappedTree *self, Offset node)
+{
+    struct MappedHeader *header = MAPPED_HEADER(self);
+
+    /* Free nodes are linked through their left field. */
+    memset(MAPPED_NODE(self, node), 0, sizeof(struct MappedNode));
+    MAPPED_NODE(self, node)->left = header->free;
+    header->free = node;
+}
+
+
+/* A link that is not a node slot counts as empty here; the descent
+ * that reaches it reports the file as corrupt.
+ */
+static inline unsigned int mnode_height(struct MappedTree *self, Offset node)
+{
+    return node && mapped_slot(self, node) ? MAPPED_NODE(self, node)->height : 0;
+}
+
+
+static unsigned int mnode_update_height(struct MappedTree *self, Offset node)
+{
+    struct MappedNode *n = MAPPED_NODE(self, node);
+    unsigned int rv = 0;
+
+    rv = n->height;
+
+    n->height = 1 + Py_MAX(mnode_height(self, n->left),
+			   mnode_height(self, n->right));
+
+    return rv;
+}
+
+
+static inline int mnode_balance_factor(struct MappedTree *self, Offset node)
+{
+    struct MappedNode *n = MAPPED_NODE(self, node);
+
+    return mnode_height(self, n->right) - mnode_height(self, n->left);
+}
+
+
+static Offset mnode_rotate_left(struct MappedTree *self, Offset node)
+{
+    Offset root = 0;
+
+    root = MAPPED_NODE(self, node)->right;
+    MAPPED_NODE(self, node)->right = MAPPED_NODE(self, root)->left;
+    MAPPED_NODE(self, root)->left = node;
+
+    mnode_update_height(self, node);
+    mnode_update_height(self, root);
+
+    return root;
+}
+
+
+static Offset mnode_rotate_right(struct MappedTree *self, Offset node)
+{
+    Offset root = 0;
+
+    root = MAPPED_NODE(self, node)->left;
+    MAPPED_NODE(self, node)->left = MAPPED_NODE(self, root)->right;
+    MAPPED_NODE(self, root)->right = node;
+
+    mnode_update_height(self, node);
+    mnode_update_height(self, root);
+
+    return root;
+}
+
+
+/* Unwind stack of sides, balancing as we go.
+ */
+static void mnode_unwind(struct MappedTree *self, Offset *stack, unsigned int count)
+{
+    struct MappedNode *node = NULL;
+    Offset *side = NULL, off = 0;
+    unsigned int old = 0;
+    int bf = 0;
+
+    while (count > 0) {
+	side = MAPPED_REF(self, stack[--count]);
+	off = *side;
+	node = MAPPED_NODE(self, off);
+	old = mnode_update_height(self, off);
+	bf = mnode_balance_factor(self, off);
+
+	if (bf == 2) {
+	    if (mnode_balance_factor(self, node->right) < 0) {
+		node->right = mnode_rotate_right(self, node->right);
+	    }
+
+	    *side = mnode_rotate_left(self, off);
+	}
+	else if (bf == -2) {
+	    if (mnode_balance_factor(self, node->left) > 0) {
+		node->left = mnode_rotate_left(self, node->left);
+	    }
+
+	    *side = mnode_rotate_right(self, off);
+	}
+	else if (node->height == old) {
+	    break;
+	}
+    }
+}
+
+
+static PyObject *mnode_to_tuple(struct MappedTree *self, Offset node, unsigned int depth)
+{
+    PyObject *l = NULL, *r = NULL, *e = NULL, *h = NULL, *t = NULL;
+    struct MappedNode *n = NULL;
+
+    if (node == 0) {
+	Py_RETURN_NONE;
+    }
+
+    MAPPED_FOLLOW(self, node);
+
+    if (depth >= STACK_MAX) {
+	PyErr_SetString(PyExc_ValueError, "corrupt mapped tree");
+	goto cleanup;
+    }
+
+    n = MAPPED_NODE(self, node);
+
+    if ((l = mnode_to_tuple(self, n->left, depth + 1)) == NULL) {
+	goto cleanup;
+    }
+
+    if ((r = mnode_to_tuple(self, n->right, depth + 1)) == NULL) {
+	goto cleanup;
+    }
+
+    if ((e = PyLong_FromUnsignedLongLong(n->element)) == NULL) {
+	goto cleanup;
+    }
+
+    if ((h = PyLong_FromUnsignedLong(n->height)) == NULL) {
+	goto cleanup;
+    }
+
+    if ((t = PyTuple_Pack(4, l, e, h, r)) == NULL) {
+	goto cleanup;
+    }
+
+ cleanup:
+    Py_XDECREF(l);
+    Py_XDECREF(r);
+    Py_XDECREF(e);
+    Py_XDECREF(h);
+
+    return t;
+}
+
+
+/* Create tree of the given type. Consumes the reference to root,
+ * also on failure.
+ */
+static PyObject *persistent_alloc(PyTypeObject *type, struct PersistentNode *root, Py_ssize_t count)
+{
+    struct PersistentTree *self = NULL;
+
+    if ((self = (struct PersistentTree *) type->tp_alloc(type, 0)) == NULL) {
+	pnode_release(root);
+	return NULL;
+    }
+
+    self->root  = root;
+    self->count = count;
+
+    return (PyObject *) self;
+}
+
+
+/* Iterate over elements e where lo <= e < hi. Bounds may be NULL.
+ * The stack holds the path to the first element, skipping subtrees
+ * before the start of the range.
+ */
+static PyObject *persistent_iter(struct PersistentTree *self, PyObject *lo, PyObject *hi, int reverse)
+{
+    struct PersistentIterator *iterator = NULL;
+    struct ModuleState *state = NULL;
+    struct PersistentNode *node = NULL;
+    PyObject *bound = reverse ? hi : lo;
+    int res = reverse;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    if ((iterator = PyObject_New(struct PersistentIterator, state->persistentiterator_type)) == NULL) {
+	return NULL;
+    }
+
+    Py_INCREF(self);
+    iterator->tree = self;
+    iterator->count = 0;
+    iterator->stop = reverse ? lo : hi;
+    iterator->remaining = lo == NULL && hi == NULL ? self->count : -1;
+    iterator->reverse = reverse;
+
+    Py_XINCREF(iterator->stop);
+
+    /* Height is bounded by STACK_MAX, see insert. */
+    for (node = self->root; node != NULL; node = res ? node->right : node->left) {
+	/* node->element < bound ==> right */
+	if (bound != NULL &&
+	    (res = PyObject_RichCompareBool(node->element, bound, Py_LT)) == -1) {
+	    Py_CLEAR(iterator);
+	    break;
+	}
+
+	if (res == reverse) {
+	    iterator->stack[iterator->count++] = node;
+	}
+    }
+
+    return (PyObject *) iterator;
+}
+
+
+static int diff_push(struct DiffCursor *cursor, struct PersistentNode *node)
+{
+    if (node == NULL) {
+	return 0;
+    }
+
+    if (cursor->count == STACK_MAX) {
+	PyErr_SetString(PyExc_RuntimeError, "stack overflow");
+	return -1;
+    }
+
+    cursor->node[cursor->count] = node;
+    cursor->expanded[cursor->count] = 0;
+    cursor->count++;
+
+    return 0;
+}
+
+
+/* Replace the unvisited subtree on top with its root, followed by
+ * its left subtree.
+ */
+static int diff_expand(struct DiffCursor *cursor)
+{
+    struct PersistentNode *node = cursor->node[cursor->count - 1];
+
+    cursor->expanded[cursor->count - 1] = 1;
+
+    return diff_push(cursor, node->left);
+}
+
+
+/* Replace the expanded node on top with its right subtree.
+ */
+static int diff_advance(struct DiffCursor *cursor)
+{
+    struct PersistentNode *node = cursor->node[--cursor->count];
+
+    return diff_push(cursor, node->right);
+}
+
+
+/* Allocate node with an element and a height computed from its
+ * children. Consumes the references to left and right, also on
+ * failure.
+ */
+static struct PersistentNode *pnode_alloc(PyObject *element, struct PersistentNode *left,
+					  struct PersistentNode *right)
+{
+    struct PersistentNode *node = NULL;
+
+    if ((node = PyMem_RawCalloc(1, sizeof *node)) == NULL) {
+	PyErr_NoMemory();
+	pnode_release(left);
+	pnode_release(right);
+	goto cleanup;
+    }
+
+    Py_INCREF(element);
+    node->element = element;
+    node->left    = left;
+    node->right   = right;
+    node->refs    = 1;
+
+    pnode_update_height(node);
+
+ cleanup:
+    return node;
+}
+
+
+/* Drop a reference to node, releasing its children when it was the
+ * last one. The recursion is bounded by the tree height.
+ */
+static void pnode_release(struct PersistentNode *node)
+{
+    if (node != NULL && PNODE_DECREF(node)) {
+	Py_DECREF(node->element);
+	pnode_release(node->left);
+	pnode_release(node->right);
+	PyMem_RawFree(node);
+    }
+}
+
+
+/* Return node if this is the only reference to it, so that it may be
+ * modified, otherwise a copy that shares its children. Consumes the
+ * reference to node.
+ */
+static struct PersistentNode *pnode_own(struct PersistentNode *node)
+{
+    struct PersistentNode *copy = NULL;
+
+    if (!PNODE_SHARED(node)) {
+	return node;
+    }
+
+    PNODE_XINCREF(node->left);
+    PNODE_XINCREF(node->right);
+
+    copy = pnode_alloc(node->element, node->left, node->right);
+    pnode_release(node);
+
+    return copy;
+}
+
+
+static inline unsigned int pnode_height(struct PersistentNode *node)
+{
+    return node ? node->height : 0;
+}
+
+
+static void pnode_update_height(struct PersistentNode *node)
+{
+    node->height = 1 + Py_MAX(pnode_height(node->left),
+			      pnode_height(node->right));
+}
+
+
+static inline int pnode_balance_factor(struct PersistentNode *node)
+{
+    return pnode_height(node->right) - pnode_height(node->left);
+}
+
+
+/* Rotations copy shared nodes before changing them. Both consume the
+ * reference to node and return NULL on failure.
+ */
+static struct PersistentNode *pnode_rotate_left(struct PersistentNode *node)
+{
+    struct PersistentNode *root = NULL;
+
+    if ((node = pnode_own(node)) == NULL) {
+	return NULL;
+    }
+
+    if ((root = pnode_own(node->right)) == NULL) {
+	node->right = NULL;
+	pnode_release(node);
+	return NULL;
+    }
+
+    node->right = root->left;
+    root->left = node;
+
+    pnode_update_height(node);
+    pnode_update_height(root);
+
+    return root;
+}
+
+
+static struct PersistentNode *pnode_rotate_right(struct PersistentNode *node)
+{
+    struct PersistentNode *root = NULL;
+
+    if ((node = pnode_own(node)) == NULL) {
+	return NULL;
+    }
+
+    if ((root = pnode_own(node->left)) == NULL) {
+	node->left = NULL;
+	pnode_release(node);
+	return NULL;
+    }
+
+    node->left = root->right;
+    root->right = node;
+
+    pnode_update_height(node);
+    pnode_update_height(root);
+
+    return root;
+}
+
+
+/* Balance a node that has just been copied. Consumes the reference
+ * to node and returns the root of the balanced subtree.
+ */
+static struct PersistentNode *pnode_balance(struct PersistentNode *node)
+{
+    int bf = pnode_balance_factor(node);
+
+    if (bf == 2) {
+	if (pnode_balance_factor(node->right) < 0 &&
+	    (node->right = pnode_rotate_right(node->right)) == NULL) {
+	    pnode_release(node);
+	    return NULL;
+	}
+
+	return pnode_rotate_left(node);
+    }
+
+    if (bf == -2) {
+	if (pnode_balance_factor(node->left) > 0 &&
+	    (node->left = pnode_rotate_left(node->left)) == NULL) {
+	    pnode_release(node);
+	    return NULL;
+	}
+
+	return pnode_rotate_right(node);
+    }
+
+    return node;
+}
+
+
+/* Copy the path back to the root, with node in place of the child
+ * that was followed from each parent (right[i] ==> right child),
+ * balancing as we go. Consumes the reference to node and replaces it
+ * with the new root.
+ */
+static int pnode_unwind(struct PersistentNode **path, const char *right, unsigned int count,
+			struct PersistentNode **node)
+{
+    struct PersistentNode *parent = NULL, *copy = NULL;
+
+    while (count > 0) {
+	parent = path[--count];
+
+	if (right[count]) {
+	    PNODE_XINCREF(parent->left);
+	    copy = pnode_alloc(parent->element, parent->left, *node);
+	}
+	else {
+	    PNODE_XINCREF(parent->right);
+	    copy = pnode_alloc(parent->element, *node, parent->right);
+	}
+
+	if (copy == NULL || (*node = pnode_balance(copy)) == NULL) {
+	    *node = NULL;
+	    return -1;
+	}
+    }
+
+    return 0;
+}
+
+
+/* Insert element into the tree at root, copying the path to it.
+ * Returns 1 and the new root in result if the tree changed, 0 if
+ * element exists and is not replaced, or -1 on error. The count is
+ * incremented if element is added.
+ */
+static int pnode_insert(struct PersistentNode *root, PyObject *element, int replace,
+			struct PersistentNode **result, Py_ssize_t *count)
+{
+    struct PersistentNode *path[STACK_MAX] = { 0 }, *node = NULL, *leaf = NULL;
+    char right[STACK_MAX] = { 0 };
+    unsigned int depth = 0;
+    int res = -1, rv = -1;
+
+    node = root;
+
+    while (node != NULL) {
+	STACK_PUSH(path, depth, node);
+
+	/* element < node->element ==> left */
+	if ((res = PyObject_RichCompareBool(element, node->element, Py_LT)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    right[depth - 1] = 0;
+	    node = node->left;
+	    continue;
+	}
+
+	/* node->element < element ==> right */
+	if ((res = PyObject_RichCompareBool(node->element, element, Py_LT)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    right[depth - 1] = 1;
+	    node = node->right;
+	    continue;
+	}
+
+	break; /* equal ==> found */
+    }
+
+    if (node != NULL) {
+	if (!replace) {
+	    rv = 0;
+	    goto cleanup;
+	}
+
+	/* Same children, new element. */
+	depth--;
+	PNODE_XINCREF(node->left);
+	PNODE_XINCREF(node->right);
+	leaf = pnode_alloc(element, node->left, node->right);
+    }
+    else {
+	leaf = pnode_alloc(element, NULL, NULL);
+    }
+
+    if (leaf == NULL || pnode_unwind(path, right, depth, &leaf) == -1) {
+	goto cleanup;
+    }
+
+    if (node == NULL) {
+	(*count)++;
+    }
+
+    *result = leaf;
+    rv = 1;
+
+ cleanup:
+    return rv;
+}
+
+
+/* Delete element from the tree at root, copying the path to it.
+ * Returns 1 and the new root in result if the tree changed, 0 if
+ * element does not exist, or -1 on error. The count is decremented
+ * if element is deleted.
+ */
+static int pnode_delete(struct PersistentNode *root, PyObject *element,
+			struct PersistentNode **result, Py_ssize_t *count)
+{
+    struct PersistentNode *path[STACK_MAX] = { 0 }, *node = NULL, *child = NULL, *copy = NULL;
+    char right[STACK_MAX] = { 0 }, left[STACK_MAX] = { 0 };
+    unsigned int depth = 0, successor = 0;
+    int res = -1, rv = -1;
+
+    node = root;
+
+    while (node != NULL) {
+	/* element < node->element ==> left */
+	if ((res = PyObject_RichCompareBool(element, node->element, Py_LT)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    STACK_PUSH(path, depth, node);
+	    right[depth - 1] = 0;
+	    node = node->left;
+	    continue;
+	}
+
+	/* node->element < element ==> right */
+	if ((res = PyObject_RichCompareBool(node->element, element, Py_LT)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res) {
+	    STACK_PUSH(path, depth, node);
+	    right[depth - 1] = 1;
+	    node = node->right;
+	    continue;
+	}
+
+	break; /* equal ==> found */
+    }
+
+    if (node == NULL) {
+	rv = 0;
+	goto cleanup;
+    }
+
+    if (node->left != NULL && node->right != NULL) {
+	struct PersistentNode *target = node, *spine[STACK_MAX] = { 0 };
+
+	/* Remove the successor from the right subtree, then let it
+	 * take the place of target.
+	 */
+	for (node = target->right; node->left != NULL; node = node->left) {
+	    STACK_PUSH(spine, successor, node);
+	}
+
+	child = node->right;
+	PNODE_XINCREF(child);
+
+	if (pnode_unwind(spine, left, successor, &child) == -1) {
+	    goto cleanup;
+	}
+
+	PNODE_INCREF(target->left);
+
+	if ((copy = pnode_alloc(node->element, target->left, child)) == NULL ||
+	    (child = pnode_balance(copy)) == NULL) {
+	    goto cleanup;
+	}
+    }
+    else {
+	child = node->left != NULL ? node->left : node->right;
+	PNODE_XINCREF(child);
+    }
+
+    if (pnode_unwind(path, right, depth, &child) == -1) {
+	goto cleanup;
+    }
+
+    (*count)--;
+    *result = child;
+    rv = 1;
+
+ cleanup:
+    return rv;
+}
+
+
+static PyObject *pnode_to_tuple(struct PersistentNode *node)
+{
+    PyObject *l = NULL, *r = NULL, *h = NULL, *t = NULL;
+
+    if (node == NULL) {
+	Py_RETURN_NONE;
+    }
+
+    if ((l = pnode_to_tuple(node->left)) == NULL) {
+	goto cleanup;
+    }
+
+    if ((r = pnode_to_tuple(node->right)) == NULL) {
+	goto cleanup;
+    }
+
+    if ((h = PyLong_FromUnsignedLong(node->height)) == NULL) {
+	goto cleanup;
+    }
+
+    t = PyTuple_Pack(4, l, node->element, h, r);
+
+ cleanup:
+    Py_XDECREF(l);
+    Py_XDECREF(r);
     Py_XDECREF(h);
 
     return t;
@@ -0,0 +1,1740 @@
+/* B+tree Python module */
+
+#include <Python.h>
+
+#include <stddef.h>
+#include <string.h>
+
+#ifdef Py_GIL_DISABLED
+#include <pthread.h>
+#endif
+
+
+/* Per-tree reader-writer lock, as in cavltree.
+ *
+ * With the GIL, the interpreter serializes all access and the lock
+ * compiles away. Without it, lookups and iteration take the lock
+ * shared and modifications take it exclusive. Element comparisons
+ * must not modify the tree being operated on.
+ */
+#ifdef Py_GIL_DISABLED
+typedef pthread_rwlock_t RWLock;
+
+#define RWLOCK_INIT(l)     pthread_rwlock_init((l), NULL)
+#define RWLOCK_DESTROY(l)  pthread_rwlock_destroy(l)
+#define RWLOCK_RELEASE(l)  pthread_rwlock_unlock(l)
+
+#define RWLOCK_ACQUIRE(l, try, wait)		\
+    do {					\
+	if (try(l) != 0) {			\
+	    Py_BEGIN_ALLOW_THREADS		\
+	    wait(l);				\
+	    Py_END_ALLOW_THREADS		\
+	}					\
+    } while(0)
+
+#define RWLOCK_READ(l)  RWLOCK_ACQUIRE((l), pthread_rwlock_tryrdlock, pthread_rwlock_rdlock)
+#define RWLOCK_WRITE(l) RWLOCK_ACQUIRE((l), pthread_rwlock_trywrlock, pthread_rwlock_wrlock)
+#else
+typedef char RWLock;
+
+#define RWLOCK_INIT(l)     ((void) (l))
+#define RWLOCK_DESTROY(l)  ((void) (l))
+#define RWLOCK_RELEASE(l)  ((void) (l))
+#define RWLOCK_READ(l)     ((void) (l))
+#define RWLOCK_WRITE(l)    ((void) (l))
+#endif
+
+
+/* Node size and max depth. Leaves hold up to NODE_MAX elements and
+ * inner nodes up to NODE_MAX children. All nodes but the root hold at
+ * least NODE_MIN.
+ */
+enum Limits {
+    NODE_MAX  = 64,
+    NODE_MIN  = NODE_MAX / 2,
+    DEPTH_MAX = 16,
+};
+
+
+/* Node header. Count is the number of elements in a leaf and the
+ * number of children of an inner node.
+ */
+struct Node {
+    unsigned int  leaf;
+    unsigned int  count;
+};
+
+
+/* Leaf. Leaves are linked in order through prev and next.
+ */
+struct Leaf {
+    struct Node   node;
+    struct Leaf  *prev;
+    struct Leaf  *next;
+    PyObject     *elements[NODE_MAX];
+};
+
+
+/* Inner node. keys[i] is greater than the elements under children[i]
+ * and less than or equal to those under children[i + 1]. Keys hold a
+ * reference, so a deleted element may live on as a key until its node
+ * is split or merged.
+ */
+struct Inner {
+    struct Node   node;
+    PyObject     *keys[NODE_MAX - 1];
+    struct Node  *children[NODE_MAX];
+};
+
+
+/* BTree class
+ */
+struct BTree {
+    PyObject_HEAD
+
+    struct Node  *root;
+    struct Leaf  *first;
+    struct Leaf  *last;
+    Py_ssize_t    count;
+    RWLock        lock;
+    unsigned int  version;
+};
+
+
+/* Iterator.
+ */
+struct Iterator {
+    PyObject_HEAD
+
+    struct BTree    *tree;
+    struct Leaf     *leaf;
+    PyObject        *stop;
+    Py_ssize_t       remaining;
+    unsigned int     index;
+    unsigned int     version;
+    int              reverse;
+};
+
+
+/* Module state.
+ */
+struct ModuleState {
+    PyTypeObject *btree_type;
+    PyTypeObject *iterator_type;
+};
+
+
+static int cbtree_exec(PyObject *m);
+static int cbtree_traverse(PyObject *m, visitproc visit, void *arg);
+static int cbtree_clear(PyObject *m);
+static struct ModuleState *type_state(PyTypeObject *type);
+static inline int parse_args(const char *name, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+			     const char *const *kwds, Py_ssize_t count, Py_ssize_t required, PyObject **values);
+
+static PyObject *BTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs);
+static PyObject *BTree_vectorcall(PyObject *type, PyObject *const *args, size_t nargsf, PyObject *kwnames);
+static int BTree_init(struct BTree *self, PyObject *args, PyObject *kwargs);
+static void BTree_dealloc(struct BTree *self);
+static PyObject *BTree_iter(struct BTree *self);
+static PyObject *BTree_reversed(struct BTree *self, PyObject *);
+static Py_ssize_t BTree_len(struct BTree *self);
+static int BTree_contains(struct BTree *self, PyObject *element);
+static PyObject *BTree_insert(struct BTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *BTree_delete(struct BTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *BTree_get(struct BTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *BTree_pop_until(struct BTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *BTree_pop_expired(struct BTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *BTree_next_deadline(struct BTree *self, PyObject *);
+static PyObject *BTree_update(struct BTree *self, PyObject *iterable);
+static PyObject *BTree_aupdate(struct BTree *self, PyObject *iterable);
+static PyObject *BTree_range(struct BTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *BTree_to_tuple(struct BTree *self, PyObject *);
+static PyObject *BTree_to_list(struct BTree *self, PyObject *);
+static PyObject *BTree_stats(struct BTree *self, PyObject *);
+static PyObject *BTree_reset_stats(struct BTree *self, PyObject *);
+static PyObject *BTree_set_stats_callback(struct BTree *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *BTree_getheight(struct BTree *self, void *);
+static PyObject *BTree_getcollect_stats(struct BTree *self, void *);
+static int BTree_setcollect_stats(struct BTree *self, PyObject *value, void *);
+
+static int Iterator_init(struct Iterator *self, PyObject *args, PyObject *kwargs);
+static void Iterator_dealloc(struct Iterator *self);
+static PyObject *Iterator_next(struct Iterator *self);
+static PyObject *Iterator_length_hint(struct Iterator *self, PyObject *);
+
+static int tree_update(struct BTree *self, PyObject *iterable);
+static PyObject *tree_insert(struct BTree *self, PyObject *element, int replace);
+static PyObject *tree_delete(struct BTree *self, PyObject *element);
+static PyObject *tree_remove(struct BTree *self, struct Inner **path, unsigned int *index,
+			     unsigned int depth, struct Leaf *leaf, unsigned int i);
+static PyObject *tree_pop(struct BTree *self, PyObject *bound, int inclusive);
+static int tree_seek(struct BTree *self, PyObject *element, struct Inner **path, unsigned int *index,
+		     unsigned int *depth, struct Leaf **leaf, unsigned int *i);
+
+static struct Leaf *leaf_alloc(void);
+static struct Inner *inner_alloc(void);
+static void node_release(struct Node *node);
+static int leaf_search(struct Leaf *leaf, PyObject *element, unsigned int *i);
+static int inner_search(struct Inner *inner, PyObject *element, unsigned int *i);
+static void leaf_insert(struct Leaf *leaf, unsigned int i, PyObject *element);
+static void inner_insert(struct Inner *inner, unsigned int i, PyObject *key, struct Node *child);
+static void inner_remove(struct Inner *inner, unsigned int i);
+static void leaf_rebalance(struct BTree *self, struct Inner *parent, unsigned int i);
+static void inner_rebalance(struct Inner *parent, unsigned int i);
+static PyObject *node_to_tuple(struct Node *node);
+static PyObject *run_in_executor(PyObject *func, PyObject *arg);
+
+
+static PyMethodDef BTREE_METHODS[] = {
+    { "insert",       (PyCFunction)BTree_insert,   METH_FASTCALL|METH_KEYWORDS, "Insert element" },
+    { "delete",       (PyCFunction)BTree_delete,   METH_FASTCALL|METH_KEYWORDS, "Delete element" },
+    { "get",          (PyCFunction)BTree_get,      METH_FASTCALL|METH_KEYWORDS, "Return element equal to key, or default" },
+    { "range",        (PyCFunction)BTree_range,    METH_FASTCALL|METH_KEYWORDS, "Iterate over elements e where lo <= e < hi" },
+    { "pop_until",    (PyCFunction)BTree_pop_until, METH_FASTCALL|METH_KEYWORDS, "Remove and return elements e where e < key" },
+    { "pop_expired",  (PyCFunction)BTree_pop_expired, METH_FASTCALL|METH_KEYWORDS, "Remove and return elements e where e <= now" },
+    { "next_deadline", (PyCFunction)BTree_next_deadline, METH_NOARGS,         "Return least element, or None" },
+    { "update",       (PyCFunction)BTree_update,   METH_O,                  "Insert elements of iterable" },
+    { "aupdate",      (PyCFunction)BTree_aupdate,  METH_O,                  "Run update(iterable) in the event loop's executor" },
+    { "to_tuple",     (PyCFunction)BTree_to_tuple, METH_NOARGS,             "Return tree as tuples" },
+    { "to_list",      (PyCFunction)BTree_to_list,  METH_NOARGS,             "Return elements as a list" },
+    { "__reversed__", (PyCFunction)BTree_reversed, METH_NOARGS,             "Return reverse iterator" },
+    { "stats",        (PyCFunction)BTree_stats,    METH_NOARGS,             "Return operation counters" },
+    { "reset_stats",  (PyCFunction)BTree_reset_stats, METH_NOARGS,          "Reset operation counters" },
+    { "set_stats_callback", (PyCFunction)BTree_set_stats_callback, METH_FASTCALL|METH_KEYWORDS,
+      "Call callback(stats) every interval updates" },
+    { NULL } /* Sentinel */
+};
+
+
+static PyMethodDef ITERATOR_METHODS[] = {
+    { "__length_hint__", (PyCFunction)Iterator_length_hint, METH_NOARGS, "Number of remaining elements" },
+    { NULL } /* Sentinel */
+};
+
+
+static PyGetSetDef BTREE_GETSETTERS[] = {
+    { "height", (getter) BTree_getheight, NULL, "Tree height", NULL},
+    { "collect_stats", (getter) BTree_getcollect_stats, (setter) BTree_setcollect_stats,
+      "Count operations", NULL},
+    { NULL }  /* Sentinel */
+};
+
+
+static PyType_Slot BTREE_SLOTS[] = {
+    { Py_tp_doc,      "BTree objects, with the interface of cavltree.AVLTree but no indexed, build_sorted or abuild_sorted" },
+    { Py_tp_new,      BTree_new },
+    { Py_tp_init,     BTree_init },
+    { Py_tp_dealloc,  BTree_dealloc },
+    { Py_tp_iter,     BTree_iter },
+    { Py_sq_length,   BTree_len },
+    { Py_sq_contains, BTree_contains },
+    { Py_tp_methods,  BTREE_METHODS },
+    { Py_tp_getset,   BTREE_GETSETTERS },
+    { 0, NULL }  /* Sentinel */
+};
+
+
+static PyType_Spec BTREE_SPEC = {
+    .name      = "cbtree.BTree",
+    .basicsize = sizeof(struct BTree),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE,
+    .slots     = BTREE_SLOTS,
+};
+
+
+static PyType_Slot ITERATOR_SLOTS[] = {
+    { Py_tp_doc,      "BTree iterator" },
+    { Py_tp_new,      PyType_GenericNew },
+    { Py_tp_init,     Iterator_init },
+    { Py_tp_dealloc,  Iterator_dealloc },
+    { Py_tp_iter,     PyObject_SelfIter },
+    { Py_tp_iternext, Iterator_next },
+    { Py_tp_methods,  ITERATOR_METHODS },
+    { 0, NULL }  /* Sentinel */
+};
+
+
+static PyType_Spec ITERATOR_SPEC = {
+    .name      = "cbtree.Iterator",
+    .basicsize = sizeof(struct Iterator),
+    .itemsize  = 0,
+    .flags     = Py_TPFLAGS_DEFAULT,
+    .slots     = ITERATOR_SLOTS,
+};
+
+
+static PyModuleDef_Slot CBTREE_SLOTS[] = {
+    { Py_mod_exec, cbtree_exec },
+#ifdef Py_mod_gil
+    { Py_mod_gil,  Py_MOD_GIL_NOT_USED },
+#endif
+    { 0, NULL }  /* Sentinel */
+};
+
+
+static PyModuleDef CBTREE_MODULE = {
+    PyModuleDef_HEAD_INIT,
+
+    .m_name     = "cbtree",
+    .m_doc      = "B+tree extension type.",
+    .m_size     = sizeof(struct ModuleState),
+    .m_slots    = CBTREE_SLOTS,
+    .m_traverse = cbtree_traverse,
+    .m_clear    = cbtree_clear,
+    .m_free     = (freefunc) cbtree_clear,
+};
+
+
+PyMODINIT_FUNC PyInit_cbtree(void)
+{
+    return PyModuleDef_Init(&CBTREE_MODULE);
+}
+
+
+static int cbtree_exec(PyObject *m)
+{
+    struct ModuleState *state = PyModule_GetState(m);
+    int rv = -1;
+
+    if ((state->btree_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &BTREE_SPEC, NULL)) == NULL ||
+	(state->iterator_type = (PyTypeObject *)
+	 PyType_FromModuleAndSpec(m, &ITERATOR_SPEC, NULL)) == NULL) {
+	goto cleanup;
+    }
+
+    /* Construct instances of the exact type without an argument tuple. */
+    state->btree_type->tp_vectorcall = BTree_vectorcall;
+
+    if (PyModule_AddType(m, state->btree_type) == -1) {
+	goto cleanup;
+    }
+
+    rv = 0;
+
+ cleanup:
+    return rv;
+}
+
+
+static int cbtree_traverse(PyObject *m, visitproc visit, void *arg)
+{
+    struct ModuleState *state = PyModule_GetState(m);
+
+    Py_VISIT(state->btree_type);
+    Py_VISIT(state->iterator_type);
+
+    return 0;
+}
+
+
+static int cbtree_clear(PyObject *m)
+{
+    struct ModuleState *state = PyModule_GetState(m);
+
+    Py_CLEAR(state->btree_type);
+    Py_CLEAR(state->iterator_type);
+
+    return 0;
+}
+
+
+static struct ModuleState *type_state(PyTypeObject *type)
+{
+    PyObject *m = NULL;
+
+#if PY_VERSION_HEX >= 0x030B0000
+    m = PyType_GetModuleByDef(type, &CBTREE_MODULE);
+#else
+    /* Find the defining class, type may be a subclass. */
+    for (; type != NULL; type = type->tp_base) {
+	if ((m = PyType_GetModule(type)) != NULL &&
+	    PyModule_GetDef(m) == &CBTREE_MODULE) {
+	    break;
+	}
+
+	PyErr_Clear();
+	m = NULL;
+    }
+
+    if (m == NULL) {
+	PyErr_SetString(PyExc_TypeError, "cbtree type expected");
+    }
+#endif
+
+    return m ? PyModule_GetState(m) : NULL;
+}
+
+
+/* Parse vectorcall arguments into values, in the order of kwds.
+ * Optional arguments that are not given are set to NULL.
+ */
+static inline int parse_args(const char *name, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+			     const char *const *kwds, Py_ssize_t count, Py_ssize_t required, PyObject **values)
+{
+    Py_ssize_t i = 0, j = 0;
+    PyObject *key = NULL;
+
+    /* Positional arguments only ==> fast path */
+    if (kwnames == NULL && nargs >= required && nargs <= count) {
+	for (i = 0; i < count; i++) {
+	    values[i] = i < nargs ? args[i] : NULL;
+	}
+
+	return 0;
+    }
+
+    if (nargs > count) {
+	PyErr_Format(PyExc_TypeError, "%s() takes at most %zd arguments (%zd given)",
+		     name, count, nargs);
+	return -1;
+    }
+
+    for (i = 0; i < count; i++) {
+	values[i] = i < nargs ? args[i] : NULL;
+    }
+
+    for (i = 0; kwnames != NULL && i < PyTuple_GET_SIZE(kwnames); i++) {
+	key = PyTuple_GET_ITEM(kwnames, i);
+
+	for (j = 0; j < count; j++) {
+	    if (PyUnicode_CompareWithASCIIString(key, kwds[j]) == 0) {
+		break;
+	    }
+	}
+
+	if (j == count) {
+	    PyErr_Format(PyExc_TypeError, "%s() got an unexpected keyword argument '%U'",
+			 name, key);
+	    return -1;
+	}
+
+	if (values[j] != NULL) {
+	    PyErr_Format(PyExc_TypeError, "%s() got multiple values for argument '%s'",
+			 name, kwds[j]);
+	    return -1;
+	}
+
+	values[j] = args[nargs + i];
+    }
+
+    for (i = 0; i < required; i++) {
+	if (values[i] == NULL) {
+	    PyErr_Format(PyExc_TypeError, "%s() missing required argument '%s'",
+			 name, kwds[i]);
+	    return -1;
+	}
+    }
+
+    return 0;
+}
+
+
+static PyObject *BTree_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    struct BTree *self = NULL;
+
+    if ((self = (struct BTree *) PyType_GenericNew(type, args, kwargs)) != NULL) {
+	RWLOCK_INIT(&self->lock);
+    }
+
+    return (PyObject *) self;
+}
+
+
+static PyObject *BTree_vectorcall(PyObject *type, PyObject *const *args,
+				  size_t nargsf, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "iterable", NULL };
+    PyObject *values[1] = { NULL }, *self = NULL;
+
+    if (parse_args("BTree", args, PyVectorcall_NARGS(nargsf), kwnames, KWDS, 1, 0, values) == -1) {
+	return NULL;
+    }
+
+    if ((self = BTree_new((PyTypeObject *) type, NULL, NULL)) == NULL) {
+	return NULL;
+    }
+
+    if (values[0] != NULL && tree_update((struct BTree *) self, values[0]) == -1) {
+	Py_CLEAR(self);
+    }
+
+    return self;
+}
+
+
+static int BTree_init(struct BTree *self, PyObject *args, PyObject *kwargs)
+{
+    static char *KWDS[] = { "iterable", NULL };
+    PyObject *iterable = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", KWDS, &iterable)) {
+	return -1;
+    }
+
+    return iterable != NULL ? tree_update(self, iterable) : 0;
+}
+
+
+static void BTree_dealloc(struct BTree *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+
+    node_release(self->root);
+
+    RWLOCK_DESTROY(&self->lock);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
+
+
+static PyObject *BTree_iter(struct BTree *self)
+{
+    struct ModuleState *state = NULL;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    return PyObject_CallFunction((PyObject *) state->iterator_type, "O", self);
+}
+
+
+static PyObject *BTree_reversed(struct BTree *self,
+				PyObject *Py_UNUSED(ignored))
+{
+    struct ModuleState *state = NULL;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    return PyObject_CallFunction((PyObject *) state->iterator_type, "OO", self, Py_True);
+}
+
+
+static Py_ssize_t BTree_len(struct BTree *self)
+{
+    Py_ssize_t rv = 0;
+
+    RWLOCK_READ(&self->lock);
+    rv = self->count;
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static int BTree_contains(struct BTree *self, PyObject *element)
+{
+    struct Node *node = NULL;
+    unsigned int i = 0;
+    int rv = -1;
+
+    RWLOCK_READ(&self->lock);
+
+    if ((node = self->root) == NULL) {
+	rv = 0;
+	goto cleanup;
+    }
+
+    while (!node->leaf) {
+	if (inner_search((struct Inner *) node, element, &i) == -1) {
+	    goto cleanup;
+	}
+
+	node = ((struct Inner *) node)->children[i];
+    }
+
+    rv = leaf_search((struct Leaf *) node, element, &i);
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *BTree_insert(struct BTree *self, PyObject *const *args,
+			      Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "element", "replace", NULL };
+    PyObject *values[2] = { NULL, NULL }, *rv = NULL;
+    int replace = 0;
+
+    if (parse_args("insert", args, nargs, kwnames, KWDS, 2, 1, values) == -1) {
+	return NULL;
+    }
+
+    if (values[1] != NULL && (replace = PyObject_IsTrue(values[1])) == -1) {
+	return NULL;
+    }
+
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_insert(self, values[0], replace);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *BTree_delete(struct BTree *self, PyObject *const *args,
+			      Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "element", NULL };
+    PyObject *values[1] = { NULL }, *rv = NULL;
+
+    if (parse_args("delete", args, nargs, kwnames, KWDS, 1, 1, values) == -1) {
+	return NULL;
+    }
+
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_delete(self, values[0]);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *BTree_get(struct BTree *self, PyObject *const *args,
+			   Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "key", "default", NULL };
+    PyObject *values[2] = { NULL, NULL }, *rv = NULL;
+    struct Leaf *leaf = NULL;
+    unsigned int i = 0;
+    int res = 0;
+
+    if (parse_args("get", args, nargs, kwnames, KWDS, 2, 1, values) == -1) {
+	return NULL;
+    }
+
+    RWLOCK_READ(&self->lock);
+
+    if (self->root != NULL && (res = tree_seek(self, values[0], NULL, NULL, NULL, &leaf, &i)) == -1) {
+	goto cleanup;
+    }
+
+    if (res) {
+	rv = leaf->elements[i];
+    }
+    else {
+	rv = values[1] != NULL ? values[1] : Py_None;
+    }
+
+    Py_INCREF(rv);
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *BTree_pop_until(struct BTree *self, PyObject *const *args,
+				 Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "key", NULL };
+    PyObject *values[1] = { NULL }, *rv = NULL;
+
+    if (parse_args("pop_until", args, nargs, kwnames, KWDS, 1, 1, values) == -1) {
+	return NULL;
+    }
+
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_pop(self, values[0], 0);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *BTree_pop_expired(struct BTree *self, PyObject *const *args,
+				   Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "now", NULL };
+    PyObject *values[1] = { NULL }, *rv = NULL;
+
+    if (parse_args("pop_expired", args, nargs, kwnames, KWDS, 1, 1, values) == -1) {
+	return NULL;
+    }
+
+    RWLOCK_WRITE(&self->lock);
+    rv = tree_pop(self, values[0], 1);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *BTree_next_deadline(struct BTree *self,
+				     PyObject *Py_UNUSED(ignored))
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_READ(&self->lock);
+    rv = self->first != NULL ? self->first->elements[0] : Py_None;
+    Py_INCREF(rv);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+static PyObject *BTree_update(struct BTree *self, PyObject *iterable)
+{
+    if (tree_update(self, iterable) == -1) {
+	return NULL;
+    }
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *BTree_aupdate(struct BTree *self, PyObject *iterable)
+{
+    PyObject *update = NULL, *rv = NULL;
+
+    if ((update = PyObject_GetAttrString((PyObject *) self, "update")) != NULL) {
+	rv = run_in_executor(update, iterable);
+	Py_DECREF(update);
+    }
+
+    return rv;
+}
+
+
+/* Start at the least element e where lo <= e, or when reversed, the
+ * greatest element where e < hi. The iterator stops at the other
+ * bound.
+ */
+static PyObject *BTree_range(struct BTree *self, PyObject *const *args,
+			     Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "lo", "hi", "reverse", NULL };
+    PyObject *values[3] = { NULL, NULL, NULL }, *lo = NULL, *hi = NULL, *bound = NULL;
+    struct Iterator *iterator = NULL;
+    struct ModuleState *state = NULL;
+    struct Leaf *leaf = NULL;
+    unsigned int i = 0;
+    int reverse = 0;
+
+    if (parse_args("range", args, nargs, kwnames, KWDS, 3, 0, values) == -1) {
+	return NULL;
+    }
+
+    lo = values[0] != Py_None ? values[0] : NULL;
+    hi = values[1] != Py_None ? values[1] : NULL;
+
+    if (values[2] != NULL && (reverse = PyObject_IsTrue(values[2])) == -1) {
+	return NULL;
+    }
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	return NULL;
+    }
+
+    if ((iterator = (struct Iterator *) PyObject_CallFunction((PyObject *) state->iterator_type, "OO",
+							      self, reverse ? Py_True : Py_False)) == NULL) {
+	return NULL;
+    }
+
+    RWLOCK_READ(&self->lock);
+
+    iterator->version = self->version;
+    iterator->remaining = -1;
+    iterator->stop = reverse ? lo : hi;
+    Py_XINCREF(iterator->stop);
+
+    /* Take the start and version together. */
+    iterator->leaf = reverse ? self->last : self->first;
+    iterator->index = iterator->leaf != NULL && reverse ? iterator->leaf->node.count - 1 : 0;
+
+    if ((bound = reverse ? hi : lo) != NULL && self->root != NULL) {
+	if (tree_seek(self, bound, NULL, NULL, NULL, &leaf, &i) == -1) {
+	    Py_CLEAR(iterator);
+	    goto cleanup;
+	}
+
+	/* i is the least element where bound <= e */
+	if (!reverse && i == leaf->node.count) {
+	    leaf = leaf->next;
+	    i = 0;
+	}
+	else if (reverse && i == 0) {
+	    leaf = leaf->prev;
+	    i = leaf != NULL ? leaf->node.count : 0;
+	}
+
+	iterator->leaf = leaf;
+	iterator->index = reverse ? i - 1 : i;
+    }
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return (PyObject *) iterator;
+}
+
+
+static PyObject *BTree_to_tuple(struct BTree *self,
+				PyObject *Py_UNUSED(ignored))
+{
+    PyObject *rv = NULL;
+
+    RWLOCK_READ(&self->lock);
+    rv = node_to_tuple(self->root);
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+/* Fill a list of the exact size by following the leaves.
+ */
+static PyObject *BTree_to_list(struct BTree *self,
+			       PyObject *Py_UNUSED(ignored))
+{
+    struct Leaf *leaf = NULL;
+    PyObject *rv = NULL;
+    Py_ssize_t n = 0;
+    unsigned int i = 0;
+
+    RWLOCK_READ(&self->lock);
+
+    if ((rv = PyList_New(self->count)) == NULL) {
+	goto cleanup;
+    }
+
+    for (leaf = self->first; leaf != NULL; leaf = leaf->next) {
+	for (i = 0; i < leaf->node.count; i++) {
+	    Py_INCREF(leaf->elements[i]);
+	    PyList_SET_ITEM(rv, n++, leaf->elements[i]);
+	}
+    }
+
+ cleanup:
+    RWLOCK_RELEASE(&self->lock);
+
+    return rv;
+}
+
+
+/* Operation counters are not implemented, as in a cavltree built
+ * with AVLTREE_STATS=0, so they are all zero.
+ */
+static PyObject *BTree_stats(struct BTree *Py_UNUSED(self),
+			     PyObject *Py_UNUSED(ignored))
+{
+    return Py_BuildValue("{sisisisisisisisi}",
+			 "comparisons", 0, "rotations", 0, "double_rotations", 0, "allocs", 0,
+			 "frees", 0, "updates", 0, "unwind", 0, "unwind_max", 0);
+}
+
+
+static PyObject *BTree_reset_stats(struct BTree *Py_UNUSED(self),
+				   PyObject *Py_UNUSED(ignored))
+{
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *BTree_set_stats_callback(struct BTree *Py_UNUSED(self), PyObject *const *args,
+					  Py_ssize_t nargs, PyObject *kwnames)
+{
+    static const char *const KWDS[] = { "callback", "interval", NULL };
+    PyObject *values[2] = { NULL, NULL };
+
+    if (parse_args("set_stats_callback", args, nargs, kwnames, KWDS, 2, 1, values) == -1) {
+	return NULL;
+    }
+
+    if (values[0] != Py_None) {
+	PyErr_SetString(PyExc_NotImplementedError, "BTree does not count operations");
+	return NULL;
+    }
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *BTree_getheight(struct BTree *self,
+				 void *Py_UNUSED(ignored))
+{
+    struct Node *node = NULL;
+    unsigned int height = 0;
+
+    RWLOCK_READ(&self->lock);
+
+    for (node = self->root; node != NULL; node = node->leaf ? NULL : ((struct Inner *) node)->children[0]) {
+	height++;
+    }
+
+    RWLOCK_RELEASE(&self->lock);
+
+    return PyLong_FromUnsignedLong(height);
+}
+
+
+static PyObject *BTree_getcollect_stats(struct BTree *Py_UNUSED(self),
+					void *Py_UNUSED(ignored))
+{
+    Py_RETURN_FALSE;
+}
+
+
+static int BTree_setcollect_stats(struct BTree *Py_UNUSED(self), PyObject *value,
+				  void *Py_UNUSED(ignored))
+{
+    int enable = 0;
+
+    if (value == NULL) {
+	PyErr_SetString(PyExc_AttributeError, "cannot delete collect_stats");
+	return -1;
+    }
+
+    if ((enable = PyObject_IsTrue(value)) == -1) {
+	return -1;
+    }
+
+    if (enable) {
+	PyErr_SetString(PyExc_NotImplementedError, "BTree does not count operations");
+	return -1;
+    }
+
+    return 0;
+}
+
+
+static int Iterator_init(struct Iterator *self, PyObject *args, PyObject *kwargs)
+{
+    static char *KWDS[] = { "tree", "reverse", NULL };
+    struct ModuleState *state = NULL;
+    PyObject *tree = NULL;
+    int rv = -1, reverse = 0;
+
+    if ((state = type_state(Py_TYPE(self))) == NULL) {
+	goto cleanup;
+    }
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!|p", KWDS,
+				     state->btree_type, &tree, &reverse)) {
+	goto cleanup;
+    }
+
+    Py_INCREF(tree);
+    Py_XSETREF(self->tree, (struct BTree *)tree);
+    Py_CLEAR(self->stop);
+
+    RWLOCK_READ(&self->tree->lock);
+
+    self->version = self->tree->version;
+    self->leaf = reverse ? self->tree->last : self->tree->first;
+    self->index = self->leaf != NULL && reverse ? self->leaf->node.count - 1 : 0;
+    self->remaining = self->tree->count;
+    self->reverse = reverse;
+
+    RWLOCK_RELEASE(&self->tree->lock);
+
+    rv = 0;
+
+ cleanup:
+    return rv;
+}
+
+
+static void Iterator_dealloc(struct Iterator *self)
+{
+    PyTypeObject *type = Py_TYPE(self);
+
+    Py_XDECREF(self->tree);
+    Py_XDECREF(self->stop);
+    type->tp_free((PyObject *) self);
+    Py_DECREF(type);
+}
+
+
+static PyObject *Iterator_next(struct Iterator *self)
+{
+    PyObject *element = NULL;
+    struct Leaf *leaf = NULL;
+    int res = -1;
+
+    if ((leaf = self->leaf) == NULL) {
+	return NULL;
+    }
+
+    RWLOCK_READ(&self->tree->lock);
+
+    if (self->version != self->tree->version) {
+	PyErr_SetString(PyExc_RuntimeError, "BTree changed during iteration");
+	self->leaf = NULL;
+	self->remaining = 0;
+	goto cleanup;
+    }
+
+    /* !(e < hi), or when reversed e < lo ==> end of range */
+    if (self->stop != NULL) {
+	if ((res = PyObject_RichCompareBool(leaf->elements[self->index], self->stop, Py_LT)) == -1) {
+	    goto cleanup;
+	}
+
+	if (res == self->reverse) {
+	    self->leaf = NULL;
+	    goto cleanup;
+	}
+    }
+
+    element = leaf->elements[self->index];
+    Py_INCREF(element);
+
+    if (!self->reverse && ++self->index == leaf->node.count) {
+	self->leaf = leaf->next;
+	self->index = 0;
+    }
+    else if (self->reverse && self->index-- == 0) {
+	self->leaf = leaf->prev;
+	self->index = self->leaf != NULL ? self->leaf->node.count - 1 : 0;
+    }
+
+    if (self->remaining > 0) {
+	self->remaining--;
+    }
+
+ cleanup:
+    RWLOCK_RELEASE(&self->tree->lock);
+
+    return element;
+}
+
+
+/* The length of a range is not known (-1).
+ */
+static PyObject *Iterator_length_hint(struct Iterator *self,
+				      PyObject *Py_UNUSED(ignored))
+{
+    if (self->remaining < 0) {
+	Py_RETURN_NOTIMPLEMENTED;
+    }
+
+    return PyLong_FromSsize_t(self->remaining);
+}
+
+
+/* Insert elements one by one, taking the lock for each so that
+ * the iterable is not consumed with the lock held.
+ */
+static int tree_update(struct BTree *self, PyObject *iterable)
+{
+    PyObject *iterator = NULL, *element = NULL, *result = NULL;
+    int rv = -1;
+
+    if ((iterator = PyObject_GetIter(iterable)) == NULL) {
+	goto cleanup;
+    }
+
+    while ((element = PyIter_Next(iterator)) != NULL) {
+	RWLOCK_WRITE(&self->lock);
+	result = tree_insert(self, element, 0);
+	RWLOCK_RELEASE(&self->lock);
+
+	Py_DECREF(element);
+
+	if (result == NULL) {
+	    goto cleanup;
+	}
+
+	Py_DECREF(result);
+    }
+
+    if (PyErr_Occurred()) {
+	goto cleanup;
+    }
+
+    rv = 0;
+
+ cleanup:
+    Py_XDECREF(iterator);
+
+    return rv;
+}
+
+
+/* Find the leaf for element and i, the least position where
+ * element <= e. The path of inner nodes and child indexes is stored
+ * unless path is NULL. Returns 1 if element is at i, 0 if not, and
+ * -1 on error. The tree must not be empty.
+ */
+static int tree_seek(struct BTree *self, PyObject *element, struct Inner **path, unsigned int *index,
+		     unsigned int *depth, struct Leaf **leaf, unsigned int *i)
+{
+    struct Node *node = self->root;
+    unsigned int n = 0;
+
+    while (!node->leaf) {
+	if (inner_search((struct Inner *) node, element, i) == -1) {
+	    return -1;
+	}
+
+	if (path != NULL) {
+	    if (n == DEPTH_MAX) {
+		PyErr_SetString(PyExc_RuntimeError, "stack overflow");
+		return -1;
+	    }
+
+	    path[n] = (struct Inner *) node;
+	    index[n++] = *i;
+	}
+
+	node = ((struct Inner *) node)->children[*i];
+    }
+
+    if (depth != NULL) {
+	*depth = n;
+    }
+
+    *leaf = (struct Leaf *) node;
+
+    return leaf_search(*leaf, element, i);
+}
+
+
+/* Nodes for the splits are allocated up front, so that a failed
+ * allocation leaves the tree unchanged: one for the leaf, one for
+ * each full inner node above it, and one for a new root if they are
+ * all full.
+ */
+static PyObject *tree_insert(struct BTree *self,
+			     PyObject *element, int replace)
+{
+    struct Inner *path[DEPTH_MAX], *inner = NULL, *right = NULL, *spare[DEPTH_MAX + 1] = { 0 };
+    struct Node *child = NULL;
+    struct Leaf *leaf = NULL, *split = NULL;
+    unsigned int index[DEPTH_MAX], depth = 0, i = 0, j = 0, n = 0, used = 0;
+    PyObject *key = NULL, *up = NULL, *rv = NULL;
+    int res = -1;
+
+    if (self->root == NULL) {
+	if ((leaf = leaf_alloc()) == NULL) {
+	    goto cleanup;
+	}
+
+	leaf->elements[leaf->node.count++] = element;
+	Py_INCREF(element);
+
+	self->root = (struct Node *) leaf;
+	self->first = self->last = leaf;
+	self->count++;
+	self->version++;
+
+	rv = Py_None;
+	goto cleanup;
+    }
+
+    if ((res = tree_seek(self, element, path, index, &depth, &leaf, &i)) == -1) {
+	goto cleanup;
+    }
+
+    /* equal ==> return element */
+    if (res) {
+	rv = leaf->elements[i];
+
+	if (replace) {
+	    /* The reference to the old element passes to the caller. */
+	    Py_INCREF(element);
+	    leaf->elements[i] = element;
+	    return rv;
+	}
+
+	goto cleanup;
+    }
+
+    if (leaf->node.count < NODE_MAX) {
+	leaf_insert(leaf, i, element);
+    }
+    else {
+	for (j = depth; j > 0 && path[j - 1]->node.count == NODE_MAX; j--) {
+	    n++;
+	}
+
+	n += j == 0;
+
+	if ((split = leaf_alloc()) == NULL) {
+	    goto cleanup;
+	}
+
+	for (j = 0; j < n; j++) {
+	    if ((spare[j] = inner_alloc()) == NULL) {
+		PyMem_RawFree(split);
+		goto cleanup;
+	    }
+	}
+
+	/* Split the leaf in halves and link the right half in. */
+	split->node.count = NODE_MAX - NODE_MIN;
+	memcpy(split->elements, leaf->elements + NODE_MIN, split->node.count * sizeof (PyObject *));
+	leaf->node.count = NODE_MIN;
+
+	split->prev = leaf;
+	split->next = leaf->next;
+	leaf->next = split;
+
+	if (split->next != NULL) {
+	    split->next->prev = split;
+	}
+	else {
+	    self->last = split;
+	}
+
+	if (i <= NODE_MIN) {
+	    leaf_insert(leaf, i, element);
+	}
+	else {
+	    leaf_insert(split, i - NODE_MIN, element);
+	}
+
+	key = split->elements[0];
+	Py_INCREF(key);
+	child = (struct Node *) split;
+
+	/* Insert key and child into the parents, splitting full ones. */
+	for (;;) {
+	    if (depth == 0) {
+		inner = spare[used++];
+		inner->node.count = 2;
+		inner->keys[0] = key;
+		inner->children[0] = self->root;
+		inner->children[1] = child;
+
+		self->root = (struct Node *) inner;
+		break;
+	    }
+
+	    inner = path[--depth];
+	    i = index[depth];
+
+	    if (inner->node.count < NODE_MAX) {
+		inner_insert(inner, i, key, child);
+		break;
+	    }
+
+	    /* The key at NODE_MIN - 1 moves up between the halves. */
+	    up = inner->keys[NODE_MIN - 1];
+
+	    right = spare[used++];
+	    right->node.count = NODE_MAX - NODE_MIN;
+	    memcpy(right->keys, inner->keys + NODE_MIN, (right->node.count - 1) * sizeof (PyObject *));
+	    memcpy(right->children, inner->children + NODE_MIN, right->node.count * sizeof (struct Node *));
+	    inner->node.count = NODE_MIN;
+
+	    if (i < NODE_MIN) {
+		inner_insert(inner, i, key, child);
+	    }
+	    else {
+		inner_insert(right, i - NODE_MIN, key, child);
+	    }
+
+	    key = up;
+	    child = (struct Node *) right;
+	}
+    }
+
+    self->count++;
+    self->version++;
+
+    rv = Py_None;
+
+ cleanup:
+    for (j = used; j < n; j++) {
+	PyMem_RawFree(spare[j]);
+    }
+
+    Py_XINCREF(rv);
+
+    return rv;
+}
+
+
+static PyObject *tree_delete(struct BTree *self,
+			     PyObject *element)
+{
+    struct Inner *path[DEPTH_MAX];
+    struct Leaf *leaf = NULL;
+    unsigned int index[DEPTH_MAX], depth = 0, i = 0;
+    PyObject *rv = NULL;
+    int res = -1;
+
+    if (self->root == NULL) {
+	Py_RETURN_NONE;
+    }
+
+    if ((res = tree_seek(self, element, path, index, &depth, &leaf, &i)) == -1) {
+	goto cleanup;
+    }
+
+    if (!res) {
+	Py_RETURN_NONE;
+    }
+
+    rv = tree_remove(self, path, index, depth, leaf, i);
+
+ cleanup:
+    return rv;
+}
+
+
+/* Remove the element at i in leaf, found along path, and return it.
+ * The reference to the element passes to the caller.
+ */
+static PyObject *tree_remove(struct BTree *self, struct Inner **path, unsigned int *index,
+			     unsigned int depth, struct Leaf *leaf, unsigned int i)
+{
+    struct Inner *root = NULL;
+    struct Node *node = NULL;
+    PyObject *rv = NULL;
+
+    rv = leaf->elements[i];
+    memmove(leaf->elements + i, leaf->elements + i + 1, (leaf->node.count - i - 1) * sizeof (PyObject *));
+    leaf->node.count--;
+
+    self->count--;
+    self->version++;
+
+    if (depth == 0) {
+	if (leaf->node.count == 0) {
+	    PyMem_RawFree(leaf);
+	    self->root = NULL;
+	    self->first = self->last = NULL;
+	}
+
+	goto cleanup;
+    }
+
+    /* Refill nodes that fell below NODE_MIN from a sibling, or merge
+     * them with it, up to the root.
+     */
+    for (node = (struct Node *) leaf; depth > 0 && node->count < NODE_MIN; node = (struct Node *) path[depth]) {
+	depth--;
+
+	if (node->leaf) {
+	    leaf_rebalance(self, path[depth], index[depth]);
+	}
+	else {
+	    inner_rebalance(path[depth], index[depth]);
+	}
+    }
+
+    /* A root with a single child ==> child is the new root */
+    root = (struct Inner *) self->root;
+
+    if (!root->node.leaf && root->node.count == 1) {
+	self->root = root->children[0];
+	PyMem_RawFree(root);
+    }
+
+ cleanup:
+    return rv;
+}
+
+
+/* Remove the elements e where e < bound, or when inclusive, where
+ * !(bound < e), and return them in order. They are counted along the
+ * leaves first, so that a failed comparison leaves the tree as it
+ * was, and then removed from the front one by one, so popping k
+ * elements takes O(k log n).
+ */
+static PyObject *tree_pop(struct BTree *self,
+			  PyObject *bound, int inclusive)
+{
+    struct Inner *path[DEPTH_MAX];
+    struct Node *node = NULL;
+    struct Leaf *leaf = NULL;
+    unsigned int index[DEPTH_MAX], depth = 0, i = 0;
+    Py_ssize_t n = 0, k = 0;
+    PyObject *rv = NULL;
+    int res = -1;
+
+    for (leaf = self->first; leaf != NULL; leaf = leaf->next) {
+	for (i = 0; i < leaf->node.count; i++, k++) {
+	    /* e < bound, or !(bound < e) when inclusive ==> popped */
+	    if ((res = inclusive ?
+		 PyObject_RichCompareBool(bound, leaf->elements[i], Py_LT) :
+		 PyObject_RichCompareBool(leaf->elements[i], bound, Py_LT)) == -1) {
+		goto cleanup;
+	    }
+
+	    if (res == inclusive) {
+		goto counted;
+	    }
+	}
+    }
+
+ counted:
+    if ((rv = PyList_New(k)) == NULL) {
+	goto cleanup;
+    }
+
+    for (n = 0; n < k; n++) {
+	for (depth = 0, node = self->root; !node->leaf; node = ((struct Inner *) node)->children[0]) {
+	    path[depth] = (struct Inner *) node;
+	    index[depth++] = 0;
+	}
+
+	PyList_SET_ITEM(rv, n, tree_remove(self, path, index, depth, (struct Leaf *) node, 0));
+    }
+
+ cleanup:
+    return rv;
+}
+
+
+static struct Leaf *leaf_alloc(void)
+{
+    struct Leaf *leaf = NULL;
+
+    if ((leaf = PyMem_RawMalloc(sizeof *leaf)) == NULL) {
+	PyErr_NoMemory();
+	goto cleanup;
+    }
+
+    leaf->node.leaf  = 1;
+    leaf->node.count = 0;
+    leaf->prev = leaf->next = NULL;
+
+ cleanup:
+    return leaf;
+}
+
+
+static struct Inner *inner_alloc(void)
+{
+    struct Inner *inner = NULL;
+
+    if ((inner = PyMem_RawMalloc(sizeof *inner)) == NULL) {
+	PyErr_NoMemory();
+	goto cleanup;
+    }
+
+    inner->node.leaf  = 0;
+    inner->node.count = 0;
+
+ cleanup:
+    return inner;
+}
+
+
+/* Release a subtree. The recursion is bounded by the tree height.
+ */
+static void node_release(struct Node *node)
+{
+    struct Inner *inner = NULL;
+    struct Leaf *leaf = NULL;
+    unsigned int i = 0;
+
+    if (node == NULL) {
+	return;
+    }
+
+    if (node->leaf) {
+	leaf = (struct Leaf *) node;
+
+	for (i = 0; i < leaf->node.count; i++) {
+	    Py_DECREF(leaf->elements[i]);
+	}
+    }
+    else {
+	inner = (struct Inner *) node;
+
+	for (i = 0; i < inner->node.count; i++) {
+	    if (i > 0) {
+		Py_DECREF(inner->keys[i - 1]);
+	    }
+
+	    node_release(inner->children[i]);
+	}
+    }
+
+    PyMem_RawFree(node);
+}
+
+
+/* Set i to the least position where element <= e. Returns 1 if
+ * element is there, 0 if not, and -1 on error.
+ */
+static int leaf_search(struct Leaf *leaf, PyObject *element, unsigned int *i)
+{
+    unsigned int lo = 0, hi = leaf->node.count, mid = 0;
+    int res = -1;
+
+    while (lo < hi) {
+	mid = (lo + hi) / 2;
+
+	/* e < element ==> right of mid */
+	if ((res = PyObject_RichCompareBool(leaf->elements[mid], element, Py_LT)) == -1) {
+	    return -1;
+	}
+
+	if (res) {
+	    lo = mid + 1;
+	}
+	else {
+	    hi = mid;
+	}
+    }
+
+    *i = lo;
+
+    if (lo == leaf->node.count) {
+	return 0;
+    }
+
+    /* !(element < e) ==> equal */
+    if ((res = PyObject_RichCompareBool(element, leaf->elements[lo], Py_LT)) == -1) {
+	return -1;
+    }
+
+    return !res;
+}
+
+
+/* Set i to the child that may contain element, the number of keys
+ * that are less than or equal to it.
+ */
+static int inner_search(struct Inner *inner, PyObject *element, unsigned int *i)
+{
+    unsigned int lo = 0, hi = inner->node.count - 1, mid = 0;
+    int res = -1;
+
+    while (lo < hi) {
+	mid = (lo + hi) / 2;
+
+	/* element < key ==> left of mid */
+	if ((res = PyObject_RichCompareBool(element, inner->keys[mid], Py_LT)) == -1) {
+	    return -1;
+	}
+
+	if (res) {
+	    hi = mid;
+	}
+	else {
+	    lo = mid + 1;
+	}
+    }
+
+    *i = lo;
+
+    return 0;
+}
+
+
+static void leaf_insert(struct Leaf *leaf, unsigned int i, PyObject *element)
+{
+    memmove(leaf->elements + i + 1, leaf->elements + i, (leaf->node.count - i) * sizeof (PyObject *));
+
+    Py_INCREF(element);
+    leaf->elements[i] = element;
+    leaf->node.count++;
+}
+
+
+/* Insert key at i and child to the right of it, stealing the
+ * reference to key.
+ */
+static void inner_insert(struct Inner *inner, unsigned int i, PyObject *key, struct Node *child)
+{
+    memmove(inner->keys + i + 1, inner->keys + i, (inner->node.count - 1 - i) * sizeof (PyObject *));
+    memmove(inner->children + i + 2, inner->children + i + 1, (inner->node.count - 1 - i) * sizeof (struct Node *));
+
+    inner->keys[i] = key;
+    inner->children[i + 1] = child;
+    inner->node.count++;
+}
+
+
+/* Remove key i and the child to the right of it. The reference to
+ * the key passes to the caller.
+ */
+static void inner_remove(struct Inner *inner, unsigned int i)
+{
+    memmove(inner->keys + i, inner->keys + i + 1, (inner->node.count - 2 - i) * sizeof (PyObject *));
+    memmove(inner->children + i + 1, inner->children + i + 2, (inner->node.count - 2 - i) * sizeof (struct Node *));
+
+    inner->node.count--;
+}
+
+
+/* Refill leaf i of parent from a sibling with elements to spare, or
+ * merge it with one.
+ */
+static void leaf_rebalance(struct BTree *self, struct Inner *parent, unsigned int i)
+{
+    struct Leaf *leaf = (struct Leaf *) parent->children[i], *left = NULL, *right = NULL;
+
+    left = i > 0 ? (struct Leaf *) parent->children[i - 1] : NULL;
+    right = i + 1 < parent->node.count ? (struct Leaf *) parent->children[i + 1] : NULL;
+
+    if (left != NULL && left->node.count > NODE_MIN) {
+	memmove(leaf->elements + 1, leaf->elements, leaf->node.count * sizeof (PyObject *));
+	leaf->elements[0] = left->elements[--left->node.count];
+	leaf->node.count++;
+
+	Py_INCREF(leaf->elements[0]);
+	Py_SETREF(parent->keys[i - 1], leaf->elements[0]);
+	return;
+    }
+
+    if (right != NULL && right->node.count > NODE_MIN) {
+	leaf->elements[leaf->node.count++] = right->elements[0];
+	memmove(right->elements, right->elements + 1, --right->node.count * sizeof (PyObject *));
+
+	Py_INCREF(right->elements[0]);
+	Py_SETREF(parent->keys[i], right->elements[0]);
+	return;
+    }
+
+    /* Merge the right one of the pair into the left one. */
+    if (left != NULL) {
+	right = leaf;
+	i--;
+    }
+    else {
+	left = leaf;
+    }
+
+    memcpy(left->elements + left->node.count, right->elements, right->node.count * sizeof (PyObject *));
+    left->node.count += right->node.count;
+
+    left->next = right->next;
+
+    if (left->next != NULL) {
+	left->next->prev = left;
+    }
+    else {
+	self->last = left;
+    }
+
+    Py_DECREF(parent->keys[i]);
+    inner_remove(parent, i);
+    PyMem_RawFree(right);
+}
+
+
+/* Refill inner node i of parent from a sibling with children to
+ * spare, rotating a key through the parent, or merge it with one,
+ * pulling the key between them down.
+ */
+static void inner_rebalance(struct Inner *parent, unsigned int i)
+{
+    struct Inner *inner = (struct Inner *) parent->children[i], *left = NULL, *right = NULL;
+    unsigned int n = 0;
+
+    left = i > 0 ? (struct Inner *) parent->children[i - 1] : NULL;
+    right = i + 1 < parent->node.count ? (struct Inner *) parent->children[i + 1] : NULL;
+
+    if (left != NULL && left->node.count > NODE_MIN) {
+	n = inner->node.count;
+	memmove(inner->keys + 1, inner->keys, (n - 1) * sizeof (PyObject *));
+	memmove(inner->children + 1, inner->children, n * sizeof (struct Node *));
+
+	inner->keys[0] = parent->keys[i - 1];
+	inner->children[0] = left->children[left->node.count - 1];
+	parent->keys[i - 1] = left->keys[left->node.count - 2];
+
+	left->node.count--;
+	inner->node.count++;
+	return;
+    }
+
+    if (right != NULL && right->node.count > NODE_MIN) {
+	n = inner->node.count;
+	inner->keys[n - 1] = parent->keys[i];
+	inner->children[n] = right->children[0];
+	parent->keys[i] = right->keys[0];
+
+	n = right->node.count;
+	memmove(right->keys, right->keys + 1, (n - 2) * sizeof (PyObject *));
+	memmove(right->children, right->children + 1, (n - 1) * sizeof (struct Node *));
+
+	right->node.count--;
+	inner->node.count++;
+	return;
+    }
+
+    /* Merge the right one of the pair into the left one. */
+    if (left != NULL) {
+	right = inner;
+	i--;
+    }
+    else {
+	left = inner;
+    }
+
+    n = left->node.count;
+    left->keys[n - 1] = parent->keys[i];
+    memcpy(left->keys + n, right->keys, (right->node.count - 1) * sizeof (PyObject *));
+    memcpy(left->children + n, right->children, right->node.count * sizeof (struct Node *));
+    left->node.count += right->node.count;
+
+    inner_remove(parent, i);
+    PyMem_RawFree(right);
+}
+
+
+/* Leaves as tuples of elements, inner nodes as tuples of children.
+ */
+static PyObject *node_to_tuple(struct Node *node)
+{
+    PyObject *t = NULL, *c = NULL;
+    unsigned int i = 0;
+
+    if (node == NULL) {
+	Py_RETURN_NONE;
+    }
+
+    if ((t = PyTuple_New(node->count)) == NULL) {
+	return NULL;
+    }
+
+    for (i = 0; i < node->count; i++) {
+	if (node->leaf) {
+	    c = ((struct Leaf *) node)->elements[i];
+	    Py_INCREF(c);
+	}
+	else if ((c = node_to_tuple(((struct Inner *) node)->children[i])) == NULL) {
+	    Py_CLEAR(t);
+	    break;
+	}
+
+	PyTuple_SET_ITEM(t, i, c);
+    }
+
+    return t;
+}
+
+
+/* Call func(arg) in the default executor of the running event loop
+ * and return the future.
+ */
+static PyObject *run_in_executor(PyObject *func, PyObject *arg)
+{
+    PyObject *asyncio = NULL, *loop = NULL, *rv = NULL;
+
+    if ((asyncio = PyImport_ImportModule("asyncio")) == NULL) {
+	goto cleanup;
+    }
+
+    if ((loop = PyObject_CallMethod(asyncio, "get_running_loop", NULL)) == NULL) {
+	goto cleanup;
+    }
+
+    rv = PyObject_CallMethod(loop, "run_in_executor", "OOO", Py_None, func, arg);
+
+ cleanup:
+    Py_XDECREF(loop);
+    Py_XDECREF(asyncio);
+
+    return rv;
+}
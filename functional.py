@@ -80,6 +80,21 @@ def insert(t, e):
     return t
 
 
+def contains(t, e):
+    if not t:
+        return False
+
+    p = element(t)
+
+    if p > e:
+        return contains(left(t), e)
+
+    if p < e:
+        return contains(right(t), e)
+
+    return True
+
+
 def leftmost(t):
     if not left(t):
         return element(t), right(t)
@@ -116,8 +131,40 @@ def avltree(iterable=None, t=None):
     return t
 
 
-def inorder(t):
-    if t:
-        yield from inorder(left(t))
-        yield element(t)
-        yield from inorder(right(t))
+def inorder(t, lo=None, hi=None, reverse=False):
+    """
+    Iterate over elements e where lo <= e < hi, using an explicit
+    stack rather than nested generators.
+    """
+    stack = []
+
+    if reverse:
+        near, far = right, left
+        start = lambda e: hi is None or e < hi
+        stop = lambda e: lo is not None and e < lo
+    else:
+        near, far = left, right
+        start = lambda e: lo is None or not e < lo
+        stop = lambda e: hi is not None and not e < hi
+
+    while t:
+        if start(element(t)):
+            stack.append(t)
+            t = near(t)
+        else:
+            t = far(t)
+
+    while stack:
+        t = stack.pop()
+        e = element(t)
+
+        if stop(e):
+            return
+
+        yield e
+
+        t = far(t)
+
+        while t:
+            stack.append(t)
+            t = near(t)
@@ -97,25 +97,121 @@ def unwind(stack, node):
         node = parent
 
 
+class Iterator:
+    """
+    In-order iterator with an explicit stack of nodes, optionally
+    limited to elements in the range [lo, hi).
+    """
+    def __init__(self, node, count=None, lo=None, hi=None, reverse=False):
+        self.stack = []
+        self.count = count
+        self.lo = lo
+        self.hi = hi
+        self.reverse = reverse
+        self.push(node)
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        if not self.stack:
+            raise StopIteration
+
+        node = self.stack.pop()
+        element = node[ELEMENT]
+
+        if self.reverse:
+            if self.lo is not None and element < self.lo:
+                self.stack.clear()
+                raise StopIteration
+
+            self.push(node[LEFT])
+
+        else:
+            if self.hi is not None and not element < self.hi:
+                self.stack.clear()
+                raise StopIteration
+
+            self.push(node[RIGHT])
+
+        if self.count is not None:
+            self.count -= 1
+
+        return element
+
+
+    def __length_hint__(self):
+        return NotImplemented if self.count is None else self.count
+
+
+    def push(self, node):
+        """
+        Push path to the next element, skipping elements before
+        the start of the range.
+        """
+        stack = self.stack
+
+        if self.reverse:
+            hi = self.hi
+
+            while node is not None:
+                if hi is not None and not node[ELEMENT] < hi:
+                    node = node[LEFT]
+                else:
+                    stack.append(node)
+                    node = node[RIGHT]
+
+        else:
+            lo = self.lo
+
+            while node is not None:
+                if lo is not None and node[ELEMENT] < lo:
+                    node = node[RIGHT]
+                else:
+                    stack.append(node)
+                    node = node[LEFT]
+
+
 class AVLTree:
     """
     Balanced binary tree.
     """
     def __init__(self, iterable=None):
         self.root = [ None ]
+        self.count = 0
 
         for e in iterable or ():
             self.insert(e)
 
 
     def __iter__(self):
-        def in_order(node):
-            if node is not None:
-                yield from in_order(node[LEFT])
-                yield node[ELEMENT]
-                yield from in_order(node[RIGHT])
+        return Iterator(self.root[NODE], self.count)
+
+
+    def __reversed__(self):
+        return Iterator(self.root[NODE], self.count, reverse=True)
 
-        yield from in_order(self.root[NODE])
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, element):
+        node = self.root[NODE]
+
+        while node:
+            if node[ELEMENT] > element:
+                node = node[LEFT]
+
+            elif node[ELEMENT] < element:
+                node = node[RIGHT]
+
+            else:
+                return True
+
+        return False
 
 
     @property
@@ -123,6 +219,14 @@ class AVLTree:
         return height(self.root[NODE])
 
 
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Iterate over elements e where lo <= e < hi.
+        A bound of None is unlimited.
+        """
+        return Iterator(self.root[NODE], None, lo, hi, reverse)
+
+
     def insert(self, element, replace=False):
         """
         Insert element into tree.
@@ -133,6 +237,7 @@ class AVLTree:
 
         if node is None:
             self.root[NODE] = make_node(element)
+            self.count += 1
             return
 
         stack = [ (self.root, NODE) ]
@@ -162,6 +267,8 @@ class AVLTree:
 
                 return rv
 
+        self.count += 1
+
         unwind(stack, node)
 
 
@@ -189,6 +296,7 @@ class AVLTree:
                 break
 
         rv = node[ELEMENT]
+        self.count -= 1
 
         if node[LEFT] and node[RIGHT]:
             target = node
@@ -205,14 +313,12 @@ class AVLTree:
         else:
             node = node[LEFT] or node[RIGHT]
 
-        parent, field = stack[-1]
+        parent, field = stack.pop()
         parent[field] = node
 
-        if not node:
-            node = parent
-            stack.pop()
-
-        unwind(stack, node)
+        # The subtree that took the place of the removed node has
+        # not changed height, so balancing starts at its parent.
+        unwind(stack, parent)
 
         return rv
 
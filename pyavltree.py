@@ -0,0 +1,1331 @@
+"""
+AVL tree in pure Python, tuned for speed.
+
+Same API as the C module. Nodes use __slots__, the balancing is
+inlined into a single unwind loop, and the path to the root is a
+plain list of nodes, so no tuples are created per step.
+
+PersistentTree keeps its nodes as tuples in the functional layout,
+shared between versions.
+"""
+
+import operator
+
+class Node:
+    __slots__ = ('left', 'right', 'element', 'height')
+
+    def __init__(self, element):
+        self.left = None
+        self.right = None
+        self.element = element
+        self.height = 1
+
+
+class Iterator:
+    """
+    In-order iterator with an explicit stack of nodes.
+    """
+    __slots__ = ('tree', 'stack', 'remaining', 'version', 'reverse')
+
+    def __init__(self, tree, reverse=False):
+        self.tree = tree
+        self.stack = []
+        self.remaining = tree.count
+        self.version = tree.version
+        self.reverse = reverse
+
+        node = tree.root
+
+        while node is not None:
+            self.stack.append(node)
+            node = node.right if reverse else node.left
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        stack = self.stack
+
+        if not stack:
+            raise StopIteration
+
+        if self.version != self.tree.version:
+            stack.clear()
+            raise RuntimeError('AVLTree changed during iteration')
+
+        node = stack.pop()
+
+        if self.reverse:
+            child = node.left
+
+            while child is not None:
+                stack.append(child)
+                child = child.right
+
+        else:
+            child = node.right
+
+            while child is not None:
+                stack.append(child)
+                child = child.left
+
+        self.remaining -= 1
+
+        return node.element
+
+
+    def __length_hint__(self):
+        return self.remaining
+
+
+class RangeIterator(Iterator):
+    """
+    In-order iterator over elements in the range [lo, hi).
+    """
+    __slots__ = ('stop',)
+
+    def __init__(self, tree, reverse=False, lo=None, hi=None):
+        self.tree = tree
+        self.stack = []
+        self.remaining = None
+        self.version = tree.version
+        self.reverse = reverse
+        self.stop = lo if reverse else hi
+
+        node = tree.root
+
+        # Skip subtrees before the start of the range
+        if reverse:
+            while node is not None:
+                if hi is not None and not node.element < hi:
+                    node = node.left
+                else:
+                    self.stack.append(node)
+                    node = node.right
+
+        else:
+            while node is not None:
+                if lo is not None and node.element < lo:
+                    node = node.right
+                else:
+                    self.stack.append(node)
+                    node = node.left
+
+
+    def __next__(self):
+        stack = self.stack
+
+        if not stack:
+            raise StopIteration
+
+        if self.version != self.tree.version:
+            stack.clear()
+            raise RuntimeError('AVLTree changed during iteration')
+
+        node = stack.pop()
+        stop = self.stop
+
+        if self.reverse:
+            if stop is not None and node.element < stop:
+                stack.clear()
+                raise StopIteration
+
+            child = node.left
+
+            while child is not None:
+                stack.append(child)
+                child = child.right
+
+        else:
+            if stop is not None and not node.element < stop:
+                stack.clear()
+                raise StopIteration
+
+            child = node.right
+
+            while child is not None:
+                stack.append(child)
+                child = child.left
+
+        return node.element
+
+
+    def __length_hint__(self):
+        return NotImplemented
+
+
+class AVLTree:
+    """
+    Balanced binary tree.
+    """
+    __slots__ = ('root', 'count', 'version', 'index', 'counters')
+
+    def __init__(self, iterable=None, indexed=False):
+        self.root = None
+        self.count = 0
+        self.version = 0
+        self.index = {} if indexed else None
+        self.counters = None
+
+        if iterable is not None:
+            self.update(iterable)
+
+
+    def __iter__(self):
+        return Iterator(self)
+
+
+    def __reversed__(self):
+        return Iterator(self, True)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, element):
+        if self.index is not None:
+            return element in self.index
+
+        if self.counters is not None:
+            return self.lookup(element, _MISSING) is not _MISSING
+
+        node = self.root
+
+        while node is not None:
+            e = node.element
+
+            if element < e:
+                node = node.left
+            elif e < element:
+                node = node.right
+            else:
+                return True
+
+        return False
+
+
+    def get(self, key, default=None):
+        """
+        Return the element equal to key, or default.
+        """
+        if self.index is not None:
+            return self.index.get(key, default)
+
+        if self.counters is not None:
+            return self.lookup(key, default)
+
+        node = self.root
+
+        while node is not None:
+            e = node.element
+
+            if key < e:
+                node = node.left
+            elif e < key:
+                node = node.right
+            else:
+                return e
+
+        return default
+
+
+    @property
+    def height(self):
+        return 0 if self.root is None else self.root.height
+
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Iterate over elements e where lo <= e < hi.
+        A bound of None is unlimited.
+        """
+        return RangeIterator(self, reverse, lo, hi)
+
+
+    def insert(self, element, replace=False):
+        """
+        Insert element into tree.
+        Replaces any existing element if `replace` is True.
+        Returns existing element, if any.
+        """
+        index = self.index
+
+        if index is not None:
+            if not replace and element in index:
+                return index[element]
+
+        node = self.root
+
+        if node is None:
+            self.root = Node(element)
+
+            if index is not None:
+                index[element] = element
+
+            self.count += 1
+            self.version += 1
+
+            if self.counters is not None:
+                self.counters.allocs += 1
+                self.tally(0)
+
+            return
+
+        path = []
+
+        while True:
+            path.append(node)
+            e = node.element
+
+            if element < e:
+                child = node.left
+
+                if child is None:
+                    node.left = child = Node(element)
+                    break
+
+            elif e < element:
+                child = node.right
+
+                if child is None:
+                    node.right = child = Node(element)
+                    break
+
+            else:
+                if replace:
+                    node.element = element
+
+                    if index is not None:
+                        index[element] = element
+
+                if self.counters is not None:
+                    self.counters.comparisons += _steps(path[:-1], node) + 2
+
+                return e
+
+            node = child
+
+        if index is not None:
+            index[element] = element
+
+        self.count += 1
+        self.version += 1
+
+        if self.counters is None:
+            self.unwind(path)
+        else:
+            self.counters.comparisons += _steps(path, child)
+            self.counters.allocs += 1
+            self.tally(self.unwind(path))
+
+
+    def delete(self, element):
+        """
+        Delete element from tree.
+        Returns existing element, if any.
+        """
+        if self.index is not None and element not in self.index:
+            return
+
+        node = self.root
+        path = []
+
+        if node is None:
+            return
+
+        # A miss is noticed where it happens, so that the comparisons
+        # of the last step are known.
+        while True:
+            e = node.element
+
+            if element < e:
+                path.append(node)
+                node = node.left
+
+                if node is None:
+                    if self.counters is not None:
+                        self.counters.comparisons += _steps(path[:-1], path[-1]) + 1
+
+                    return
+
+            elif e < element:
+                path.append(node)
+                node = node.right
+
+                if node is None:
+                    if self.counters is not None:
+                        self.counters.comparisons += _steps(path[:-1], path[-1]) + 2
+
+                    return
+
+            else:
+                break
+
+        if self.counters is not None:
+            self.counters.comparisons += _steps(path, node) + 2
+
+        rv = node.element
+
+        if node.left is not None and node.right is not None:
+            target = node
+            path.append(node)
+            node = node.right
+
+            while node.left is not None:
+                path.append(node)
+                node = node.left
+
+            target.element = node.element
+            child = node.right
+
+        else:
+            child = node.left if node.left is not None else node.right
+
+        if path:
+            parent = path[-1]
+
+            if parent.left is node:
+                parent.left = child
+            else:
+                parent.right = child
+
+        else:
+            self.root = child
+
+        if self.index is not None:
+            del self.index[element]
+
+        self.count -= 1
+        self.version += 1
+
+        if self.counters is None:
+            self.unwind(path)
+        else:
+            self.counters.frees += 1
+            self.tally(self.unwind(path))
+
+        return rv
+
+
+    def pop_until(self, key):
+        """
+        Remove and return elements e where e < key, in order.
+        """
+        return self.pop(lambda e: e < key)
+
+
+    def pop_expired(self, now):
+        """
+        Remove and return elements e where e <= now, in order.
+        """
+        return self.pop(lambda e: not now < e)
+
+
+    def next_deadline(self):
+        """
+        Return least element, or None if empty.
+        """
+        node = self.root
+
+        if node is None:
+            return None
+
+        while node.left is not None:
+            node = node.left
+
+        return node.element
+
+
+    def update(self, iterable):
+        """
+        Insert the elements of iterable.
+        """
+        for e in iterable:
+            self.insert(e)
+
+
+    async def aupdate(self, iterable):
+        """
+        Run update(iterable) in the event loop's executor.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.update, iterable)
+
+
+    @classmethod
+    def build_sorted(cls, buffer):
+        """
+        Return a tree of the sorted numbers in buffer, a one-dimensional
+        buffer of integers or floats. Duplicates are dropped.
+        """
+        view = memoryview(buffer)
+
+        if view.ndim != 1 or view.format.lstrip('@') not in tuple('bBhHiIlLqQnNfd'):
+            raise TypeError(f"build_sorted() argument must be a buffer of numbers, not {type(buffer).__name__}")
+
+        elements = []
+
+        for e in view.tolist():
+            if e != e:
+                raise ValueError("cannot order NaN")
+
+            if elements and not elements[-1] < e:
+                if e < elements[-1]:
+                    raise ValueError("buffer is not sorted")
+
+                continue
+
+            elements.append(e)
+
+        tree = cls()
+        tree.root = _build(elements, 0, len(elements))
+        tree.count = len(elements)
+        return tree
+
+
+    @classmethod
+    async def abuild_sorted(cls, buffer):
+        """
+        Run build_sorted(buffer) in the event loop's executor.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, cls.build_sorted, buffer)
+
+
+    def pop(self, popped):
+        """
+        Remove and return the elements for which popped is true, which
+        must be a prefix of the tree. The nodes on the path where it
+        turns left are kept and joined back with their right subtrees.
+        """
+        rv = []
+        kept = []
+        counters = self.counters
+        steps = 0
+        node = self.root
+
+        while node is not None:
+            steps += 1
+
+            if popped(node.element):
+                _inorder(node.left, rv)
+                rv.append(node.element)
+                node = node.right
+
+            else:
+                kept.append(node)
+                node = node.left
+
+        if counters is not None:
+            counters.comparisons += steps
+
+        if rv:
+            if self.index is not None:
+                for e in rv:
+                    del self.index[e]
+
+            root = None
+
+            for node in reversed(kept):
+                root = _join(root, node, node.right, counters)
+
+            self.root = root
+            self.count -= len(rv)
+            self.version += 1
+
+            if counters is not None:
+                counters.frees += len(rv)
+                self.tally(len(kept))
+
+        return rv
+
+
+    def unwind(self, path):
+        """
+        Unwind path, balancing as we go, until a subtree keeps
+        its height. Returns the number of ancestors visited.
+        """
+        counters = self.counters
+        count = len(path)
+
+        while path:
+            node = path.pop()
+            old = node.height
+            l, r = node.left, node.right
+            lh = 0 if l is None else l.height
+            rh = 0 if r is None else r.height
+
+            if rh - lh == 2:
+                rl, rr = r.left, r.right
+                rlh = 0 if rl is None else rl.height
+                rrh = 0 if rr is None else rr.height
+
+                if rlh > rrh:
+                    # Right-left rotation
+                    if counters is not None:
+                        counters.double_rotations += 1
+
+                    node.right, r.left = rl.left, rl.right
+                    rl.left, rl.right = node, r
+                    node.height = 1 + max(lh, 0 if node.right is None else node.right.height)
+                    r.height = 1 + max(0 if r.left is None else r.left.height, rrh)
+                    rl.height = 1 + max(node.height, r.height)
+                    root = rl
+
+                else:
+                    # Left rotation
+                    if counters is not None:
+                        counters.rotations += 1
+
+                    node.right, r.left = rl, node
+                    node.height = 1 + max(lh, rlh)
+                    r.height = 1 + max(node.height, rrh)
+                    root = r
+
+            elif lh - rh == 2:
+                ll, lr = l.left, l.right
+                llh = 0 if ll is None else ll.height
+                lrh = 0 if lr is None else lr.height
+
+                if lrh > llh:
+                    # Left-right rotation
+                    if counters is not None:
+                        counters.double_rotations += 1
+
+                    node.left, l.right = lr.right, lr.left
+                    lr.right, lr.left = node, l
+                    node.height = 1 + max(0 if node.left is None else node.left.height, rh)
+                    l.height = 1 + max(llh, 0 if l.right is None else l.right.height)
+                    lr.height = 1 + max(l.height, node.height)
+                    root = lr
+
+                else:
+                    # Right rotation
+                    if counters is not None:
+                        counters.rotations += 1
+
+                    node.left, l.right = lr, node
+                    node.height = 1 + max(lrh, rh)
+                    l.height = 1 + max(llh, node.height)
+                    root = l
+
+            else:
+                height = 1 + (lh if lh > rh else rh)
+
+                if height == old:
+                    return count - len(path)
+
+                node.height = height
+                continue
+
+            if path:
+                parent = path[-1]
+
+                if parent.left is node:
+                    parent.left = root
+                else:
+                    parent.right = root
+
+            else:
+                self.root = root
+
+            if root.height == old:
+                # The C module visits the parent too before it stops.
+                return count - len(path) + (1 if path else 0)
+
+        return count
+
+
+    def to_list(self):
+        """
+        Return elements as a list.
+        """
+        rv = []
+        stack = []
+        node = self.root
+
+        while True:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+            if not stack:
+                return rv
+
+            node = stack.pop()
+            rv.append(node.element)
+            node = node.right
+
+
+    def to_tuple(self):
+        """
+        Return tree as tuples.
+        """
+        def tpl(n):
+            if n is not None:
+                return (tpl(n.left), n.element, n.height, tpl(n.right))
+
+        return tpl(self.root)
+
+
+    def lookup(self, key, default):
+        """
+        Return the element equal to key, or default, counting the
+        comparisons.
+        """
+        counters = self.counters
+        node = self.root
+
+        while node is not None:
+            e = node.element
+            counters.comparisons += 1
+
+            if key < e:
+                node = node.left
+                continue
+
+            counters.comparisons += 1
+
+            if e < key:
+                node = node.right
+            else:
+                return e
+
+        return default
+
+
+    def tally(self, unwind):
+        """
+        Count an update that rebalanced through unwind ancestors, and
+        call the stats callback when it is due. Its exceptions are
+        reported, not raised, as the update has succeeded.
+        """
+        counters = self.counters
+        counters.updates += 1
+        counters.unwind += unwind
+
+        if unwind > counters.unwind_max:
+            counters.unwind_max = unwind
+
+        callback = counters.callback
+
+        if callback is None or counters.updates - counters.notified < counters.interval:
+            return
+
+        counters.notified = counters.updates
+
+        try:
+            callback(self.stats())
+
+        except Exception:
+            import sys
+            import traceback
+
+            print(f'Exception ignored in: {callback!r}', file=sys.stderr)
+            traceback.print_exc()
+
+
+    def stats(self):
+        """
+        Return operation counters, all zero unless collect_stats
+        is set.
+        """
+        counters = self.counters
+
+        if counters is None:
+            return dict.fromkeys(STATS, 0)
+
+        return { name: getattr(counters, name) for name in STATS }
+
+
+    def reset_stats(self):
+        """
+        Reset operation counters, keeping the callback.
+        """
+        counters = self.counters
+
+        if counters is not None:
+            self.counters = Stats(counters.callback, counters.interval)
+
+
+    def set_stats_callback(self, callback, interval=1024):
+        """
+        Call callback(stats) every interval updates, turning
+        collection on. A callback of None removes it.
+        """
+        if callback is not None and not callable(callback):
+            raise TypeError('callback must be callable or None')
+
+        interval = operator.index(interval)
+
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+
+        if callback is not None and self.counters is None:
+            self.counters = Stats()
+
+        counters = self.counters
+
+        if counters is not None:
+            counters.callback = callback
+            counters.interval = interval
+            counters.notified = counters.updates
+
+
+    @property
+    def indexed(self):
+        return self.index is not None
+
+
+    @indexed.setter
+    def indexed(self, value):
+        if not value:
+            self.index = None
+        elif self.index is None:
+            self.index = { e: e for e in self.to_list() }
+
+
+    @property
+    def collect_stats(self):
+        return self.counters is not None
+
+
+    @collect_stats.setter
+    def collect_stats(self, value):
+        if not value:
+            self.counters = None
+        elif self.counters is None:
+            self.counters = Stats()
+
+
+STATS = ('comparisons', 'rotations', 'double_rotations', 'allocs', 'frees', 'updates', 'unwind', 'unwind_max')
+
+
+class Stats:
+    """
+    Operation counters of a tree, and the callback that samples them.
+    """
+    __slots__ = STATS + ('callback', 'interval', 'notified')
+
+    def __init__(self, callback=None, interval=1024):
+        for name in STATS:
+            setattr(self, name, 0)
+
+        self.callback = callback
+        self.interval = interval
+        self.notified = 0
+
+
+_MISSING = object()
+
+
+def _steps(path, node):
+    """
+    Return the comparisons made descending along path to node: one
+    for a left turn, two for a right turn.
+    """
+    rv = 0
+
+    for parent in reversed(path):
+        rv += 1 if parent.left is node else 2
+        node = parent
+
+    return rv
+
+
+def _inorder(node, rv):
+    """
+    Append the elements of subtree node to rv, in order.
+    """
+    stack = []
+
+    while True:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+
+        if not stack:
+            return
+
+        node = stack.pop()
+        rv.append(node.element)
+        node = node.right
+
+
+def _balance(node, counters=None):
+    """
+    Update the height of node and rotate it back into balance if
+    needed, counting the rotations in counters. Returns the root of
+    the subtree.
+    """
+    l, r = node.left, node.right
+    lh = 0 if l is None else l.height
+    rh = 0 if r is None else r.height
+
+    if rh - lh == 2:
+        double = (0 if r.left is None else r.left.height) > (0 if r.right is None else r.right.height)
+
+        if double:
+            node.right = _rotate_right(r)
+
+        if counters is not None:
+            _rotated(counters, double)
+
+        return _rotate_left(node)
+
+    if lh - rh == 2:
+        double = (0 if l.right is None else l.right.height) > (0 if l.left is None else l.left.height)
+
+        if double:
+            node.left = _rotate_left(l)
+
+        if counters is not None:
+            _rotated(counters, double)
+
+        return _rotate_right(node)
+
+    node.height = 1 + (lh if lh > rh else rh)
+    return node
+
+
+def _rotate_left(node):
+    root = node.right
+    node.right, root.left = root.left, node
+    _height(node)
+    _height(root)
+    return root
+
+
+def _rotate_right(node):
+    root = node.left
+    node.left, root.right = root.right, node
+    _height(node)
+    _height(root)
+    return root
+
+
+def _height(node):
+    node.height = 1 + max(0 if node.left is None else node.left.height,
+                          0 if node.right is None else node.right.height)
+
+
+def _rotated(counters, double):
+    if double:
+        counters.double_rotations += 1
+    else:
+        counters.rotations += 1
+
+
+def _join(l, node, r, counters=None):
+    """
+    Join l, node and r into a balanced tree, where the elements of l
+    are less than node and those of r greater. Returns the root.
+    """
+    lh = 0 if l is None else l.height
+    rh = 0 if r is None else r.height
+
+    if lh > rh + 1:
+        l.right = _join(l.right, node, r, counters)
+        return _balance(l, counters)
+
+    if rh > lh + 1:
+        r.left = _join(l, node, r.left, counters)
+        return _balance(r, counters)
+
+    node.left, node.right = l, r
+    node.height = 1 + (lh if lh > rh else rh)
+    return node
+
+
+def _build(elements, lo, hi):
+    """
+    Return a tree of minimal height of the sorted elements[lo:hi].
+    """
+    if lo == hi:
+        return None
+
+    mid = (lo + hi) // 2
+    node = Node(elements[mid])
+    node.left = _build(elements, lo, mid)
+    node.right = _build(elements, mid + 1, hi)
+    node.height = 1 + (0 if node.left is None else node.left.height)
+    return node
+
+
+def _node(l, e, r):
+    """
+    Return balanced node (l, e, height, r), in the functional layout.
+    """
+    lh = 0 if l is None else l[2]
+    rh = 0 if r is None else r[2]
+
+    if rh - lh == 2:
+        rl, re, _, rr = r
+        rlh = 0 if rl is None else rl[2]
+        rrh = 0 if rr is None else rr[2]
+
+        if rlh > rrh:
+            # Right-left rotation
+            rll, rle, _, rlr = rl
+            return (_node(l, e, rll), rle, rlh + 1, _node(rlr, re, rr))
+
+        # Left rotation
+        h = 1 + max(lh, rlh)
+        return ((l, e, h, rl), re, 1 + max(h, rrh), rr)
+
+    if lh - rh == 2:
+        ll, le, _, lr = l
+        llh = 0 if ll is None else ll[2]
+        lrh = 0 if lr is None else lr[2]
+
+        if lrh > llh:
+            # Left-right rotation
+            lrl, lre, _, lrr = lr
+            return (_node(ll, le, lrl), lre, lrh + 1, _node(lrr, e, r))
+
+        # Right rotation
+        h = 1 + max(lrh, rh)
+        return (ll, le, 1 + max(llh, h), (lr, e, h, r))
+
+    return (l, e, 1 + (lh if lh > rh else rh), r)
+
+
+def _unwind(path, node):
+    """
+    Copy path back to the root with node in place of the child that
+    was followed, balancing as we go.
+    """
+    for parent, right in reversed(path):
+        l, e, _, r = parent
+        node = _node(l, e, node) if right else _node(node, e, r)
+
+    return node
+
+
+class PersistentIterator:
+    """
+    In-order iterator over a persistent tree, which cannot change.
+    """
+    __slots__ = ('stack', 'remaining', 'near', 'far')
+
+    def __init__(self, tree, reverse=False):
+        self.stack = []
+        self.remaining = tree.count
+        self.near, self.far = (3, 0) if reverse else (0, 3)
+
+        node = tree.root
+
+        while node is not None:
+            self.stack.append(node)
+            node = node[self.near]
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        stack = self.stack
+
+        if not stack:
+            raise StopIteration
+
+        node = stack.pop()
+        child = node[self.far]
+
+        while child is not None:
+            stack.append(child)
+            child = child[self.near]
+
+        self.remaining -= 1
+
+        return node[1]
+
+
+    def __length_hint__(self):
+        return self.remaining
+
+
+class PersistentRangeIterator(PersistentIterator):
+    """
+    In-order iterator over elements in the range [lo, hi).
+    """
+    __slots__ = ('reverse', 'stop')
+
+    def __init__(self, tree, reverse=False, lo=None, hi=None):
+        self.stack = []
+        self.remaining = None
+        self.near, self.far = (3, 0) if reverse else (0, 3)
+        self.reverse = reverse
+        self.stop = lo if reverse else hi
+
+        node = tree.root
+
+        # Skip subtrees before the start of the range
+        if reverse:
+            while node is not None:
+                if hi is not None and not node[1] < hi:
+                    node = node[0]
+                else:
+                    self.stack.append(node)
+                    node = node[3]
+
+        else:
+            while node is not None:
+                if lo is not None and node[1] < lo:
+                    node = node[3]
+                else:
+                    self.stack.append(node)
+                    node = node[0]
+
+
+    def __next__(self):
+        stack = self.stack
+
+        if not stack:
+            raise StopIteration
+
+        node = stack.pop()
+        stop = self.stop
+
+        if stop is not None and (node[1] < stop) == self.reverse:
+            stack.clear()
+            raise StopIteration
+
+        child = node[self.far]
+
+        while child is not None:
+            stack.append(child)
+            child = child[self.near]
+
+        return node[1]
+
+
+    def __length_hint__(self):
+        return NotImplemented
+
+
+class PersistentTree:
+    """
+    Immutable balanced binary tree. Modifications return new trees
+    that share all nodes off the modified path.
+    """
+    __slots__ = ('root', 'count')
+
+    def __init__(self, iterable=None):
+        self.root = None
+        self.count = 0
+
+        for e in iterable or ():
+            t = self.insert(e)
+            self.root, self.count = t.root, t.count
+
+
+    @classmethod
+    def _new(cls, root, count):
+        t = cls.__new__(cls)
+        t.root = root
+        t.count = count
+        return t
+
+
+    def __iter__(self):
+        return PersistentIterator(self)
+
+
+    def __reversed__(self):
+        return PersistentIterator(self, True)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, element):
+        node = self.root
+
+        while node is not None:
+            e = node[1]
+
+            if element < e:
+                node = node[0]
+            elif e < element:
+                node = node[3]
+            else:
+                return True
+
+        return False
+
+
+    @property
+    def height(self):
+        return 0 if self.root is None else self.root[2]
+
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Iterate over elements e where lo <= e < hi.
+        A bound of None is unlimited.
+        """
+        return PersistentRangeIterator(self, reverse, lo, hi)
+
+
+    def insert(self, element, replace=False):
+        """
+        Return tree with element inserted.
+        Replaces any existing element if `replace` is True.
+        """
+        node = self.root
+        path = []
+
+        while node is not None:
+            l, e, h, r = node
+
+            if element < e:
+                path.append((node, False))
+                node = l
+
+            elif e < element:
+                path.append((node, True))
+                node = r
+
+            elif replace:
+                return self._new(_unwind(path, (l, element, h, r)), self.count)
+
+            else:
+                return self
+
+        return self._new(_unwind(path, (None, element, 1, None)), self.count + 1)
+
+
+    def delete(self, element):
+        """
+        Return tree with element deleted.
+        """
+        node = self.root
+        path = []
+
+        while node is not None:
+            l, e, _, r = node
+
+            if element < e:
+                path.append((node, False))
+                node = l
+
+            elif e < element:
+                path.append((node, True))
+                node = r
+
+            else:
+                break
+
+        else:
+            return self
+
+        if l is not None and r is not None:
+            spine = []
+            node = r
+
+            while node[0] is not None:
+                spine.append((node, False))
+                node = node[0]
+
+            child = _node(l, node[1], _unwind(spine, node[3]))
+
+        else:
+            child = r if l is None else l
+
+        return self._new(_unwind(path, child), self.count - 1)
+
+
+    def diff(self, other):
+        """
+        Return (removed, added) elements relative to other tree.
+        Shared subtrees are skipped without looking at their elements.
+        """
+        if not isinstance(other, PersistentTree):
+            raise TypeError(f'diff() argument must be PersistentTree, not {type(other).__name__}')
+
+        removed, added = [], []
+        # Entries are [node, expanded]
+        a = [] if self.root is None else [[self.root, False]]
+        b = [] if other.root is None else [[other.root, False]]
+
+        def expand(stack):
+            top = stack[-1]
+            top[1] = True
+
+            if top[0][0] is not None:
+                stack.append([top[0][0], False])
+
+        def advance(stack):
+            node = stack.pop()[0]
+
+            if node[3] is not None:
+                stack.append([node[3], False])
+
+        while a or b:
+            ta = a[-1] if a else None
+            tb = b[-1] if b else None
+
+            if ta and not ta[1] and tb and not tb[1]:
+                if ta[0] is tb[0]:
+                    a.pop()
+                    b.pop()
+                else:
+                    expand(a if ta[0][2] >= tb[0][2] else b)
+
+            elif ta and not ta[1]:
+                expand(a)
+
+            elif tb and not tb[1]:
+                expand(b)
+
+            elif not b or (a and ta[0][1] < tb[0][1]):
+                removed.append(ta[0][1])
+                advance(a)
+
+            elif not a or tb[0][1] < ta[0][1]:
+                added.append(tb[0][1])
+                advance(b)
+
+            else:
+                advance(a)
+                advance(b)
+
+        return removed, added
+
+
+    def to_list(self):
+        """
+        Return elements as a list.
+        """
+        rv = []
+        stack = []
+        node = self.root
+
+        while True:
+            while node is not None:
+                stack.append(node)
+                node = node[0]
+
+            if not stack:
+                return rv
+
+            node = stack.pop()
+            rv.append(node[1])
+            node = node[3]
+
+
+    def to_tuple(self):
+        """
+        Return tree as tuples.
+        """
+        return self.root
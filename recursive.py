@@ -4,31 +4,21 @@ AVL tree in object-oriented, recursive style.
 
 class AVLTree:
     class Node:
-        def __init__(self, element=None, left=None, right=None, height=0):
+        def __init__(self, element=None, left=None, right=None, height=0, size=0):
             self.element = element
             self.left = left
             self.right = right
             self.height = height
+            self.size = size
 
 
         def __bool__(self):
             return self != AVLTree.NONE
 
 
-        def __iter__(self):
-            if self.left:
-                yield from self.left
-
-            if self:
-                yield self.element
-
-            if self.right:
-                yield from self.right
-
-
         def insert(self, element):
             if not self:
-                return AVLTree.Node(element, AVLTree.NONE, AVLTree.NONE, 1)
+                return AVLTree.Node(element, AVLTree.NONE, AVLTree.NONE, 1, 1)
 
             elif self.element > element:
                 self.left = self.left.insert(element)
@@ -69,6 +59,19 @@ class AVLTree:
             return node.balance()
 
 
+        def contains(self, element):
+            if not self:
+                return False
+
+            elif self.element > element:
+                return self.left.contains(element)
+
+            elif self.element < element:
+                return self.right.contains(element)
+
+            return True
+
+
         def leftMost(self):
             if not self.left:
                 return self, self.right
@@ -82,6 +85,7 @@ class AVLTree:
 
         def updateHeight(self):
             self.height = 1 + max(self.left.height, self.right.height)
+            self.size = 1 + self.left.size + self.right.size
 
 
         def balanceFactor(self):
@@ -128,6 +132,70 @@ class AVLTree:
             return node
 
 
+    class Iterator:
+        def __init__(self, node, size=None, lo=None, hi=None, reverse=False):
+            self.stack = []
+            self.size = size
+            self.lo = lo
+            self.hi = hi
+            self.reverse = reverse
+            self.push(node)
+
+
+        def __iter__(self):
+            return self
+
+
+        def __next__(self):
+            if not self.stack:
+                raise StopIteration
+
+            node = self.stack.pop()
+
+            if self.reverse:
+                if self.lo is not None and node.element < self.lo:
+                    self.stack.clear()
+                    raise StopIteration
+
+                self.push(node.left)
+
+            else:
+                if self.hi is not None and not node.element < self.hi:
+                    self.stack.clear()
+                    raise StopIteration
+
+                self.push(node.right)
+
+            if self.size is not None:
+                self.size -= 1
+
+            return node.element
+
+
+        def __length_hint__(self):
+            return NotImplemented if self.size is None else self.size
+
+
+        def push(self, node):
+            stack, none = self.stack, AVLTree.NONE
+
+            if self.reverse:
+                while node is not none:
+                    if self.hi is not None and not node.element < self.hi:
+                        node = node.left
+                    else:
+                        stack.append(node)
+                        node = node.right
+
+            else:
+                while node is not none:
+                    if self.lo is not None and node.element < self.lo:
+                        node = node.right
+                    else:
+                        stack.append(node)
+                        node = node.left
+
+
     NONE = Node()
 
 
@@ -139,7 +207,19 @@ class AVLTree:
 
 
     def __iter__(self):
-        yield from self.root
+        return self.Iterator(self.root, self.root.size)
+
+
+    def __reversed__(self):
+        return self.Iterator(self.root, self.root.size, reverse=True)
+
+
+    def __len__(self):
+        return self.root.size
+
+
+    def __contains__(self, element):
+        return self.root.contains(element)
 
 
     @property
@@ -147,6 +227,10 @@ class AVLTree:
         return self.root.height
 
 
+    def range(self, lo=None, hi=None, reverse=False):
+        return self.Iterator(self.root, None, lo, hi, reverse)
+
+
     def insert(self, element):
         self.root = self.root.insert(element)
 
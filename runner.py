@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import gc
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import unittest
+
+import tests
+
+
+# Worker state set by the initializer
+WORKER = {}
+
+
+def pin(cpus):
+    """
+    Pin the calling process to a CPU taken from the cpus queue.
+    """
+    cpu = cpus.get()
+
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, { cpu })
+
+    return cpu
+
+
+def calibrate() -> float:
+    """
+    Time a fixed CPU bound workload, best of three. Comparing the time
+    in a lone process to the times in busy workers shows how much the
+    workers disturb each other.
+    """
+    rng = random.Random(0)
+    v = [ rng.random() for _ in range(200000) ]
+    best = math.inf
+
+    for _ in range(3):
+        start = time.perf_counter()
+        sorted(v)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def run(names: list, height: int, seed: str=None) -> dict:
+    """
+    Run performance tests for a single height and try, and return
+    their output by file name.
+    """
+    output = tempfile.mkdtemp(prefix='avltree-')
+
+    try:
+        tests.PerformanceTest.HEIGHTS = [ height ]
+        tests.PerformanceTest.TRIES = 1
+        tests.PerformanceTest.OUTPUT = output
+
+        if seed is None:
+            os.environ.pop('SEED', None)
+        else:
+            os.environ['SEED'] = seed
+
+        suite = unittest.defaultTestLoader.loadTestsFromNames(names, tests)
+        result = unittest.TextTestRunner(stream=io.StringIO()).run(suite)
+
+        if not result.wasSuccessful():
+            failures = result.errors + result.failures
+            raise RuntimeError(f'{names} failed at height {height}:\n{failures[0][1]}')
+
+        files = {}
+
+        for name in os.listdir(output):
+            with open(os.path.join(output, name)) as fp:
+                files[name] = json.load(fp)
+
+        return files
+
+    finally:
+        shutil.rmtree(output)
+
+
+def initialize(cpus, names: list, height: int, collect: bool):
+    """
+    Pin the worker, warm up by running the tests once at the smallest
+    height, then calibrate while the other workers do the same.
+    """
+    WORKER['cpu'] = pin(cpus)
+    WORKER['collect'] = collect
+
+    run(names, height)
+
+    WORKER['calibration'] = calibrate()
+
+
+def task(name: str, height: int, n: int, seed: str):
+    """
+    Run one (test, height, try) of the matrix with the GC state
+    reset, or disabled if collection is off.
+    """
+    gc.collect()
+    gc.freeze()
+
+    if not WORKER['collect']:
+        gc.disable()
+
+    try:
+        files = run([ name ], height, None if seed is None else f'{seed}-{name}-{height}-{n}')
+
+    finally:
+        gc.enable()
+        gc.unfreeze()
+
+    return os.getpid(), WORKER['cpu'], WORKER['calibration'], files
+
+
+def merge(into: dict, output: dict):
+    """
+    Merge test output for some heights and tries into output for
+    others. Samples are appended and histograms added.
+    """
+    heights = { d['height']: d for d in into['result'] }
+
+    for d in output['result']:
+        if d['height'] not in heights:
+            heights[d['height']] = d
+            into['result'].append(d)
+            continue
+
+        m = heights[d['height']]
+
+        for t in output['types']:
+            if 'sample' in output:
+                counts = collections.Counter(dict(map(tuple, m[t])))
+                counts.update(dict(map(tuple, d[t])))
+                m[t] = [ [ v, n ] for v, n in sorted(counts.items()) ]
+
+            else:
+                m[t].extend(d[t])
+
+    into['result'].sort(key=lambda d: d['height'])
+
+
+def noise(output: dict) -> list:
+    """
+    Coefficients of variation of the tries of each type at each
+    height.
+    """
+    cv = []
+
+    if 'sample' in output:
+        return cv
+
+    for d in output['result']:
+        for t in output['types']:
+            if len(d[t]) > 1 and statistics.mean(d[t]) > 0:
+                cv.append(statistics.stdev(d[t]) / statistics.mean(d[t]))
+
+    return cv
+
+
+def names(specs: list) -> list:
+    """
+    Expand test specifications, e.g. PerformanceTest.testFill, to the
+    performance test methods they name.
+    """
+    suite = unittest.defaultTestLoader.loadTestsFromNames(specs, tests)
+    found = []
+
+    def walk(s):
+        for t in s:
+            if isinstance(t, unittest.TestSuite):
+                walk(t)
+
+            elif isinstance(t, tests.PerformanceTest):
+                found.append(f'PerformanceTest.{t._testMethodName}')
+
+            else:
+                raise ValueError(f'not a performance test: {t.id()}')
+
+    walk(suite)
+
+    return found
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser('Run performance tests in parallel')
+
+    ap.add_argument('tests', metavar='TEST', nargs='*', default=[ 'PerformanceTest' ],
+                    help='Tests to run (default: PerformanceTest)')
+
+    ap.add_argument('--jobs', metavar='N', type=int,
+                    help='Number of worker processes (default: one per CPU but one)')
+
+    ap.add_argument('--gc', choices=('on','off'), default='on',
+                    help='Keep garbage collection on during tests, or turn it off (default: on)')
+
+    param = ap.parse_args()
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else [ None ] * os.cpu_count()
+    jobs = param.jobs or max(len(cpus) - 1, 1)
+
+    try:
+        specs = names(param.tests)
+    except ValueError as e:
+        ap.error(str(e))
+
+    heights = tests.PerformanceTest.HEIGHTS
+    output = tests.PerformanceTest.OUTPUT
+    seed = os.environ.get('SEED')
+
+    if jobs > len(cpus):
+        print(f'{jobs} jobs share {len(cpus)} CPUs, workers are not pinned', file=sys.stderr)
+
+    # Hand out CPUs from the end, leaving the first to the system
+    queue = multiprocessing.Queue()
+
+    for i in range(jobs):
+        queue.put(cpus[-1 - i] if jobs <= len(cpus) else None)
+
+    alone = calibrate()
+
+    # Largest heights first, so the pool drains evenly
+    matrix = [ (name, height, n)
+               for height in sorted(heights, reverse=True)
+               for n in range(1, tests.PerformanceTest.TRIES + 1)
+               for name in specs ]
+
+    merged = {}
+    calibration = {}
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=initialize,
+                                                initargs=(queue, specs, min(heights), param.gc == 'on')) as pool:
+        futures = [ pool.submit(task, name, height, n, seed) for name, height, n in matrix ]
+
+        for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            pid, cpu, t, files = future.result()
+            calibration[pid] = (cpu, t)
+
+            for name, d in files.items():
+                if name in merged:
+                    merge(merged[name], d)
+                else:
+                    merged[name] = d
+
+            print(f'\r{i}/{len(matrix)} done', end='', file=sys.stderr, flush=True)
+
+    print(file=sys.stderr)
+
+    for name, d in merged.items():
+        with open(os.path.join(output, name), 'w') as fp:
+            json.dump(d, fp, indent=4)
+
+    # Report the noise rather than hide it
+    busy = statistics.median(t for _, t in calibration.values())
+
+    print(f'Calibration: {alone * 1000:.1f} ms alone, {busy * 1000:.1f} ms median in '
+          f'{len(calibration)} workers ({(busy / alone - 1) * 100:+.1f}%)')
+
+    for pid, (cpu, t) in sorted(calibration.items(), key=lambda e: str(e[1][0])):
+        print(f'  worker {pid} on CPU {cpu}: {t * 1000:.1f} ms')
+
+    for name, d in sorted(merged.items()):
+        cv = noise(d)
+
+        if cv:
+            print(f'{name}: coefficient of variation of tries median {statistics.median(cv) * 100:.1f}%, '
+                  f'max {max(cv) * 100:.1f}%')
@@ -1,8 +1,11 @@
-from distutils.core import setup, Extension
-
-setup(name='cavltree',
-      version='1.0',
-      ext_modules=[Extension('cavltree', ['cavltree.c'])],
-      script_args=['build_ext'],
-      options={'build_ext': {'build_temp': '.',
-                             'build_lib': '.'}})
+try:
+    from setuptools import setup, Extension
+except ImportError:
+    from distutils.core import setup, Extension
+
+setup(name='avltree',
+      version='1.1',
+      packages=['avltree'],
+      py_modules=['pyavltree'],
+      ext_modules=[Extension('cavltree', ['cavltree.c'], optional=True),
+                   Extension('cbtree', ['cbtree.c'], optional=True)])
@@ -2,6 +2,8 @@
 
 import argparse
 import json
+import math
+import sys
 
 
 def display(field):
@@ -26,7 +28,7 @@ def average(v: list, cnt: int, scale: float) -> float:
     return sum(map(lambda x: (x * scale) / cnt, v)) / len(v)
 
 
-def table(param, scale, unit, test, operation, types, result):
+def table(param, scale, unit, test, operation, types, result, keys='int'):
     """
     Print average time of an operation.
     """
@@ -40,13 +42,13 @@ def table(param, scale, unit, test, operation, types, result):
 
         lines.append(line)
 
-    print(f'{test.title()} - {operation} performance ({unit}s):')
+    print(f'{test.title()} - {operation} performance with {keys} keys ({unit}s):')
 
     for line in lines:
         print('\t'.join(map(display, line)))
 
 
-def graph(param, scale, unit, test, operation, types, result):
+def graph(param, scale, unit, test, operation, types, result, keys='int'):
     """
     Use matplotlib to create graph as a SVG file.
     """
@@ -64,7 +66,7 @@ def graph(param, scale, unit, test, operation, types, result):
 
         plt.plot(x, y, label=t)
 
-    plt.title(f'{test.title()} performance')
+    plt.title(f'{test.title()} performance with {keys} keys')
     plt.xlabel('Tree height')
     plt.ylabel(f'Average {operation} time ({unit}s)')
     plt.legend()
@@ -72,6 +74,220 @@ def graph(param, scale, unit, test, operation, types, result):
     plt.savefig(param.output, type='svg')
 
 
+def memory_table(param, test, operation, types, measure, result, keys='int'):
+    """
+    Print average bytes per element.
+    """
+    lines = [ [ 'height', 'count', *types ] ]
+
+    for d in result:
+        line = [ d['height'], d['count'] ]
+
+        for t in types:
+            line.append(round(average(d[t], d['count'], 1.0), 1))
+
+        lines.append(line)
+
+    print(f'{test.title()} - bytes per element with {keys} keys:')
+
+    for line in lines:
+        print('\t'.join(map(display, line)))
+
+
+def memory_graph(param, test, operation, types, measure, result, keys='int'):
+    """
+    Use matplotlib to create graph of bytes per element as a SVG file.
+    """
+    import matplotlib
+    matplotlib.use('cairo')
+
+    import matplotlib.pyplot as plt
+
+    for t in types:
+        x, y = [], []
+
+        for d in result:
+            x.append(d['height'])
+            y.append(average(d[t], d['count'], 1.0))
+
+        plt.plot(x, y, label=t)
+
+    plt.title(f'{test.title()} footprint with {keys} keys')
+    plt.xlabel('Tree height')
+    plt.ylabel('Bytes per element')
+    plt.legend()
+
+    plt.savefig(param.output, format='svg')
+
+
+PERCENTILES = [ 50, 90, 99, 99.9 ]
+
+
+def percentile(histogram: list, p: float):
+    """
+    Smallest value in a histogram of [value, count] pairs such that
+    p percent of the values are less than or equal to it.
+    """
+    rank = sum(n for _, n in histogram) * p / 100
+    seen = 0
+
+    for value, n in histogram:
+        seen += n
+
+        if seen >= rank:
+            return value
+
+    return None
+
+
+def latency(histogram: list, p: float, scale: float):
+    value = percentile(histogram, p)
+    return None if value is None else value * scale / 1e9
+
+
+def latency_table(param, scale, unit, test, operation, types, sample, result, keys='int'):
+    """
+    Print latency percentiles of an operation.
+    """
+    lines = [ [ 'height', 'count', 'type', *(f'p{p}' for p in PERCENTILES) ] ]
+
+    for d in result:
+        for t in types:
+            lines.append([ d['height'], d['count'], t, *(latency(d[t], p, scale) for p in PERCENTILES) ])
+
+    print(f'{test.title()} - {operation} latency with {keys} keys, 1 in {sample} sampled ({unit}s):')
+
+    for line in lines:
+        print('\t'.join(map(display, line)))
+
+
+def latency_graph(param, scale, unit, test, operation, types, sample, result, keys='int'):
+    """
+    Use matplotlib to create a graph per percentile as a SVG file.
+    """
+    import matplotlib
+    matplotlib.use('cairo')
+
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(2, 2, figsize=(12, 9), sharex=True)
+
+    for p, ax in zip(PERCENTILES, axes.flat):
+        for t in types:
+            x, y = [], []
+
+            for d in result:
+                x.append(d['height'])
+                y.append(latency(d[t], p, scale))
+
+            ax.plot(x, y, label=t)
+
+        ax.set_title(f'p{p}')
+        ax.set_xlabel('Tree height')
+        ax.set_ylabel(f'{operation.title()} latency ({unit}s)')
+
+    axes.flat[0].legend()
+    fig.suptitle(f'{test.title()} with {keys} keys')
+
+    fig.savefig(param.output, format='svg')
+
+
+# Two-sided 95% critical values of Student's t by degrees of freedom
+T95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365,
+    8: 2.306, 9: 2.262, 10: 2.228, 12: 2.179, 15: 2.131, 20: 2.086,
+    30: 2.042, 60: 2.000, 120: 1.980
+}
+
+
+def t95(df: float) -> float:
+    """
+    Critical value for the largest tabulated degrees of freedom not
+    above df, which errs on the wide side.
+    """
+    return min((t for k, t in T95.items() if k <= df), default=T95[1]) if df < math.inf else 1.960
+
+
+def ratio(baseline: list, candidate: list):
+    """
+    Ratio of the geometric means of candidate to baseline samples,
+    with a 95% confidence interval from Welch's t-test on the log
+    samples. The interval is None with fewer than two samples.
+    """
+    x = [ math.log(v) for v in baseline ]
+    y = [ math.log(v) for v in candidate ]
+    mx, my = sum(x) / len(x), sum(y) / len(y)
+    r = math.exp(my - mx)
+
+    if len(x) < 2 or len(y) < 2:
+        return r, None, None
+
+    vx = sum((v - mx) ** 2 for v in x) / (len(x) - 1) / len(x)
+    vy = sum((v - my) ** 2 for v in y) / (len(y) - 1) / len(y)
+    se = math.sqrt(vx + vy)
+
+    if se == 0.0:
+        return r, r, r
+
+    df = (vx + vy) ** 2 / (vx ** 2 / (len(x) - 1) + vy ** 2 / (len(y) - 1))
+    t = t95(df)
+
+    return r, math.exp(my - mx - t * se), math.exp(my - mx + t * se)
+
+
+def compare(param, baseline: dict, candidate: dict) -> int:
+    """
+    Print the candidate to baseline ratio of each type at each height
+    and return the number of significant regressions past the
+    threshold.
+    """
+    if 'sample' in candidate:
+        print(f'{candidate["test"].title()} - latency histograms are not compared')
+        return 0
+
+    types = [ t for t in candidate['types'] if t in baseline['types'] ]
+    heights = { d['height']: d for d in baseline['result'] }
+    limit = 1.0 + param.threshold / 100
+    failed = 0
+
+    lines = [ [ 'height', 'count', 'type', 'ratio', 'low', 'high', '' ] ]
+
+    for d in candidate['result']:
+        b = heights.get(d['height'])
+
+        if b is None:
+            continue
+
+        for t in types:
+            r, lo, hi = ratio([ v / b['count'] for v in b[t] ], [ v / d['count'] for v in d[t] ])
+
+            if lo is not None and lo > 1.0:
+                mark = 'slower'
+
+                if r > limit:
+                    mark = 'FAIL'
+                    failed += 1
+
+            elif hi is not None and hi < 1.0:
+                mark = 'faster'
+
+            else:
+                mark = ''
+
+            lines.append([ d['height'], d['count'], t, r, lo, hi, mark ])
+
+    keys = candidate.get('keys', 'int')
+
+    print(f'{candidate["test"].title()} - {candidate["operation"]} candidate / baseline with {keys} keys:')
+
+    for line in lines:
+        print('\t'.join(map(display, line)))
+
+    print(f'{failed} significant regressions over {param.threshold}%')
+
+    return failed
+
+
 UNITS = {
     's':  (1.0,            ''),
     'ms': (1000.0,         'm'),
@@ -83,9 +299,15 @@ UNITS = {
 if __name__ == '__main__':
     ap = argparse.ArgumentParser('Display tree')
 
-    ap.add_argument('--type', choices=('table','graph'), default='table',
+    ap.add_argument('--type', choices=('table','graph','compare'), default='table',
                     help='Output type (default: table)')
 
+    ap.add_argument('--baseline', metavar='PATH',
+                    help='Baseline file to compare result with')
+
+    ap.add_argument('--threshold', metavar='PERCENT', type=float, default=10.0,
+                    help='Exit with 1 on regressions over this (default: 10)')
+
     ap.add_argument('--result', metavar='PATH', default='result.json',
                     help='Input file (default: result.json)')
 
@@ -101,7 +323,32 @@ if __name__ == '__main__':
     with open(param.result) as fp:
         d = json.load(fp)
 
-    if param.type == 'table':
+    if param.type == 'compare':
+        if param.baseline is None:
+            ap.error('compare requires --baseline')
+
+        with open(param.baseline) as fp:
+            baseline = json.load(fp)
+
+        sys.exit(1 if compare(param, baseline, d) else 0)
+
+    # Memory tests store bytes rather than times
+    if 'measure' in d:
+        if param.type == 'table':
+            memory_table(param, **d)
+
+        else:
+            memory_graph(param, **d)
+
+    # Latency tests store histograms rather than times
+    elif 'sample' in d:
+        if param.type == 'table':
+            latency_table(param, scale, unit, **d)
+
+        else:
+            latency_graph(param, scale, unit, **d)
+
+    elif param.type == 'table':
         table(param, scale, unit, **d)
 
     else:
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import asyncio
 import bisect
+import collections
+import functools
+import gc
 import inspect
 import json
 import logging
 import os
 import random
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 import unittest
 
 sys.path.append(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))
@@ -16,7 +25,9 @@ sys.path.append(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentf
 import recursive
 import functional
 import iterative
+import pyavltree
 import cavltree
+import cbtree
 
 
 class CorrectnessTest(unittest.TestCase):
@@ -51,6 +62,7 @@ class CorrectnessTest(unittest.TestCase):
         f = None
         r = recursive.AVLTree()
         i = iterative.AVLTree()
+        o = pyavltree.AVLTree()
         c = cavltree.AVLTree()
 
         for e, expected in self.INSERT:
@@ -63,6 +75,9 @@ class CorrectnessTest(unittest.TestCase):
             i.insert(e)
             self.assertEqual(i.to_tuple(), expected)
 
+            o.insert(e)
+            self.assertEqual(o.to_tuple(), expected)
+
             c.insert(e)
             self.assertEqual(c.to_tuple(), expected)
 
@@ -87,6 +102,12 @@ class CorrectnessTest(unittest.TestCase):
             i.delete(e)
             self.assertEqual(i.to_tuple(), expected)
 
+            o = pyavltree.AVLTree(t[0] for t in self.INSERT)
+            self.assertEqual(o.to_tuple(), self.INSERT[-1][1])
+
+            o.delete(e)
+            self.assertEqual(o.to_tuple(), expected)
+
             c = cavltree.AVLTree(t[0] for t in self.INSERT)
             self.assertEqual(c.to_tuple(), self.INSERT[-1][1])
 
@@ -94,6 +115,523 @@ class CorrectnessTest(unittest.TestCase):
             self.assertEqual(c.to_tuple(), expected)
 
 
+    def testDeleteHeight(self):
+        """
+        Removing a node with one child must update the heights above it.
+        """
+        expected = ((None, 1, 1, None), 2, 2, (None, 4, 1, None))
+
+        f = functional.delete(functional.avltree([2, 1, 3, 4]), 3)
+        self.assertEqual(f, expected)
+
+        r = recursive.AVLTree([2, 1, 3, 4])
+        r.delete(3)
+        self.assertEqual(r.toTuple(), expected)
+
+        for tree in (iterative.AVLTree([2, 1, 3, 4]), pyavltree.AVLTree([2, 1, 3, 4]), cavltree.AVLTree([2, 1, 3, 4])):
+            tree.delete(3)
+            self.assertEqual(tree.to_tuple(), expected)
+
+
+    def testIterate(self):
+        elements = [ t[0] for t in self.INSERT ]
+        expected = sorted(elements)
+
+        for tree in (recursive.AVLTree(elements), iterative.AVLTree(elements),
+                     pyavltree.AVLTree(elements), cavltree.AVLTree(elements)):
+            self.assertEqual(len(tree), len(expected))
+            self.assertEqual(list(tree), expected)
+            self.assertEqual(list(reversed(tree)), expected[::-1])
+
+            it = iter(tree)
+            next(it)
+            self.assertEqual(it.__length_hint__(), len(expected) - 1)
+
+        for tree in (recursive.AVLTree(elements), iterative.AVLTree(elements),
+                     pyavltree.AVLTree(elements), cavltree.AVLTree(elements),
+                     pyavltree.PersistentTree(elements), cavltree.PersistentTree(elements)):
+            self.assertEqual(list(tree.range('I', 'N')), [ 'I', 'K', 'L', 'M' ])
+            self.assertEqual(list(tree.range('J', reverse=True)), [ 'Q', 'P', 'O', 'N', 'M', 'L', 'K' ])
+            self.assertEqual(list(tree.range(hi='C')), [ 'A' ])
+            self.assertEqual(list(tree.range('B', 'C')), [])
+            self.assertIn('K', tree)
+            self.assertNotIn('J', tree)
+
+        f = functional.avltree(elements)
+        self.assertTrue(functional.contains(f, 'K'))
+        self.assertFalse(functional.contains(f, 'J'))
+        self.assertEqual(list(functional.inorder(f)), expected)
+        self.assertEqual(list(functional.inorder(f, reverse=True)), expected[::-1])
+        self.assertEqual(list(functional.inorder(f, 'I', 'N')), [ 'I', 'K', 'L', 'M' ])
+
+        for tree in (pyavltree.AVLTree(elements), cavltree.AVLTree(elements)):
+            self.assertEqual(tree.to_list(), expected)
+
+            it = iter(tree)
+            tree.delete(expected[0])
+
+            with self.assertRaises(RuntimeError):
+                next(it)
+
+
+    def testReplace(self):
+        for tree in (iterative.AVLTree([1, 2, 3]), pyavltree.AVLTree([1, 2, 3]), cavltree.AVLTree([1, 2, 3])):
+            old = tree.insert(2.0)
+            self.assertIs(type(old), int)
+            self.assertIs(type(list(tree)[1]), int)
+
+            old = tree.insert(2.0, replace=True)
+            self.assertIs(type(old), int)
+            self.assertIs(type(list(tree)[1]), float)
+
+
+    def testPopUntil(self):
+        """
+        Popping must leave the rest of the tree in order, threaded and
+        balanced.
+        """
+        def height(t):
+            if t is None:
+                return 0
+
+            l, _, h, r = t
+            self.assertLessEqual(abs(height(l) - height(r)), 1)
+            self.assertEqual(h, 1 + max(height(l), height(r)))
+            return h
+
+        for cls in (pyavltree.AVLTree, cavltree.AVLTree):
+            rng = random.Random(0)
+            v = list(range(0, 2000, 2))
+            tree = cls(v)
+            self.assertEqual(tree.next_deadline(), 0)
+
+            while v:
+                bound = v[0] + rng.randrange(-1, 100)
+
+                if rng.random() < 0.5:
+                    expected = [ e for e in v if e < bound ]
+                    self.assertEqual(tree.pop_until(bound), expected)
+                else:
+                    expected = [ e for e in v if e <= bound ]
+                    self.assertEqual(tree.pop_expired(bound), expected)
+
+                v = v[len(expected):]
+                self.assertEqual(list(tree), v)
+                self.assertEqual(list(reversed(tree)), v[::-1])
+                self.assertEqual(len(tree), len(v))
+                self.assertEqual(tree.next_deadline(), v[0] if v else None)
+                height(tree.to_tuple())
+
+            self.assertEqual(tree.pop_until(10), [])
+            tree.insert(1)
+            self.assertEqual(list(tree), [ 1 ])
+
+            it = iter(tree)
+            tree.pop_expired(1)
+            self.assertRaises(RuntimeError, next, it)
+
+
+    def testIndexed(self):
+        """
+        The index must follow every change to the tree.
+        """
+        for cls in (pyavltree.AVLTree, cavltree.AVLTree):
+            rng = random.Random(0)
+            tree = cls(indexed=True)
+            d = {}
+
+            for n in range(5000):
+                e = rng.randrange(500)
+                op = rng.choice(('insert', 'replace', 'delete', 'pop'))
+
+                if op == 'insert':
+                    self.assertEqual(tree.insert(e), d.get(e))
+                    d.setdefault(e, e)
+                elif op == 'replace':
+                    f = float(e)
+                    self.assertEqual(tree.insert(f, replace=True), d.get(e))
+                    d[e] = f
+                elif op == 'delete':
+                    self.assertEqual(tree.delete(e), d.pop(e, None))
+                elif n % 50 == 0:
+                    self.assertEqual(tree.pop_until(e), sorted(k for k in d if k < e))
+                    d = { k: v for k, v in d.items() if k >= e }
+
+                # Turning the index off and on rebuilds it
+                if n % 1000 == 0:
+                    tree.indexed = False
+                    self.assertFalse(tree.indexed)
+                    tree.indexed = True
+
+                self.assertEqual(e in tree, e in d)
+                self.assertIs(tree.get(e, d), d.get(e, d))
+
+            self.assertTrue(tree.indexed)
+            self.assertEqual(list(tree), sorted(d))
+
+        # A failed descent leaves the index as it was
+        class Key(int):
+            fail = False
+
+            def __lt__(self, other):
+                if Key.fail:
+                    raise ValueError('no order')
+
+                return int(self) < int(other)
+
+            __hash__ = int.__hash__
+
+        for cls in (pyavltree.AVLTree, cavltree.AVLTree):
+            tree = cls([ Key(1), Key(2), Key(3) ], indexed=True)
+            self.assertRaises(TypeError, tree.insert, 'x')
+            self.assertNotIn('x', tree)
+
+            Key.fail = True
+            self.assertRaises(ValueError, tree.delete, Key(2))
+            Key.fail = False
+            self.assertIn(2, tree)
+            self.assertEqual(list(tree), [ 1, 2, 3 ])
+
+        tree = cavltree.AVLTree(range(1000))
+        size = sys.getsizeof(tree)
+        tree.indexed = True
+        self.assertGreater(sys.getsizeof(tree), size)
+
+        self.assertRaises(TypeError, tree.insert, [ 1 ])
+        self.assertEqual(len(tree), 1000)
+
+        self.assertRaises(TypeError, cavltree.AVLTree, [ [ 1 ] ], indexed=True)
+
+
+    def testBulk(self):
+        """
+        Bulk updates and sorted builds, whether run directly or awaited,
+        must give the same trees as inserting one by one.
+        """
+        def height(t):
+            if t is None:
+                return 0
+
+            l, _, h, r = t
+            self.assertLessEqual(abs(height(l) - height(r)), 1)
+            self.assertEqual(h, 1 + max(height(l), height(r)))
+            return h
+
+        async def build(cls, buffer, v):
+            tree = cls([ -1 ])
+            await tree.aupdate(buffer)
+            return await cls.abuild_sorted(array.array(buffer.typecode, sorted(v))), tree
+
+        for cls in (pyavltree.AVLTree, cavltree.AVLTree):
+            rng = random.Random(0)
+
+            for typecode in 'bBiIqQd':
+                for n in (0, 1, 2, 100, 1000):
+                    v = [ rng.randrange(100) for _ in range(n) ]
+                    buffer = array.array(typecode, v)
+                    expected = sorted(set(v))
+
+                    built, updated = asyncio.run(build(cls, buffer, v))
+                    trees = [ (cls(buffer), expected), (cls(buffer, indexed=True), expected),
+                              (built, expected), (updated, [ -1 ] + expected) ]
+
+                    for tree, elements in trees:
+                        self.assertEqual(list(tree), elements)
+                        self.assertEqual(list(reversed(tree)), elements[::-1])
+                        self.assertEqual(len(tree), len(elements))
+                        self.assertEqual({ type(e) for e in tree.range(0) }, { type(e) for e in buffer })
+                        height(tree.to_tuple())
+
+                    tree = cls(v[::2], indexed=True)
+                    tree.update(buffer)
+                    self.assertEqual(list(tree), expected)
+                    self.assertTrue(all(tree.get(e) == e for e in v))
+
+            tree = cls.build_sorted(b'abc')
+            self.assertEqual(list(tree), [ 97, 98, 99 ])
+            tree.insert(100)
+            self.assertEqual(tree.next_deadline(), 97)
+
+            self.assertRaises(ValueError, cls.build_sorted, array.array('q', [ 2, 1 ]))
+            self.assertRaises(ValueError, cls.build_sorted, array.array('d', [ 1, float('nan') ]))
+            self.assertRaises(TypeError, cls.build_sorted, [ 1, 2 ])
+
+        # NaN has no order, so such buffers are inserted element by element
+        buffer = array.array('d', [ float('nan'), 1.0, 2.0 ])
+
+        for start in ([], [ 0.5 ]):
+            trees = []
+
+            for cls in (pyavltree.AVLTree, cavltree.AVLTree):
+                trees.append(cls(start))
+                trees[-1].update(buffer)
+
+            self.assertEqual(*[ [ repr(e) for e in tree ] for tree in trees ])
+
+
+    def testPersistent(self):
+        for cls in (pyavltree.PersistentTree, cavltree.PersistentTree):
+            versions = [ cls() ]
+
+            for e, expected in self.INSERT:
+                versions.append(versions[-1].insert(e))
+                self.assertEqual(versions[-1].to_tuple(), expected)
+
+            # Old versions are unchanged
+            for t, (e, expected) in zip(versions[1:], self.INSERT):
+                self.assertEqual(t.to_tuple(), expected)
+
+            full = versions[-1]
+            self.assertIs(full.insert('M'), full)
+            self.assertIs(full.delete('Z'), full)
+
+            for e, expected in self.DELETE:
+                t = full.delete(e)
+                self.assertEqual(t.to_tuple(), expected)
+                self.assertEqual(len(t), len(full) - 1)
+                self.assertEqual(full.to_tuple(), self.INSERT[-1][1])
+                self.assertEqual(full.diff(t), ([ e ], []))
+                self.assertEqual(t.diff(full), ([], [ e ]))
+
+            t = full.delete('A').delete('Q').insert('B').insert('R')
+            self.assertEqual(full.diff(t), ([ 'A', 'Q' ], [ 'B', 'R' ]))
+            self.assertEqual(full.diff(full), ([], []))
+            self.assertEqual(versions[0].diff(full), ([], list(full)))
+
+            elements = sorted(t[0] for t in self.INSERT)
+            self.assertEqual(list(full), elements)
+            self.assertEqual(list(reversed(full)), elements[::-1])
+            self.assertEqual(full.to_list(), elements)
+            self.assertIn('K', full)
+            self.assertNotIn('B', full)
+
+            self.assertRaises(TypeError, full.diff, elements)
+
+
+    def testBTree(self):
+        rng = random.Random(0)
+        tree = cbtree.BTree()
+        v = []
+
+        # Enough elements for inner nodes to split and merge
+        for _ in range(20000):
+            e = rng.randrange(5000)
+            i = bisect.bisect_left(v, e)
+            found = i < len(v) and v[i] == e
+
+            if rng.random() < 0.6:
+                self.assertEqual(tree.insert(e), e if found else None)
+
+                if not found:
+                    v.insert(i, e)
+
+            else:
+                self.assertEqual(tree.delete(e), e if found else None)
+
+                if found:
+                    del v[i]
+
+        self.assertEqual(len(tree), len(v))
+        self.assertEqual(list(tree), v)
+        self.assertEqual(list(reversed(tree)), v[::-1])
+        self.assertEqual(tree.to_list(), v)
+        self.assertEqual(tree.height, 3)
+
+        for lo, hi in ((None, None), (100, 200), (None, 300), (4000, None), (200, 100)):
+            expected = [ e for e in v if (lo is None or lo <= e) and (hi is None or e < hi) ]
+            self.assertEqual(list(tree.range(lo, hi)), expected)
+            self.assertEqual(list(tree.range(lo, hi, reverse=True)), expected[::-1])
+
+        e = float(v[0])
+        self.assertEqual(tree.insert(e, replace=True), v[0])
+        self.assertIs(next(iter(tree)), e)
+
+        it = iter(tree)
+        next(it)
+        tree.delete(v[1])
+        self.assertRaises(RuntimeError, next, it)
+
+        self.assertEqual(tree.get(v[2]), v[2])
+        self.assertEqual(tree.get(-1, 'missing'), 'missing')
+        self.assertEqual(tree.next_deadline(), v[0])
+
+        # Popping across leaves, rebalancing as they empty
+        self.assertEqual(tree.pop_until(v[100]), [ v[0] ] + v[2:100])
+        self.assertEqual(tree.pop_expired(v[500]), v[100:501])
+        self.assertEqual(tree.pop_until(v[400]), [])
+        self.assertRaises(TypeError, tree.pop_until, 'x')
+        self.assertEqual(list(tree), v[501:])
+
+        async def aupdate():
+            await tree.aupdate(v[2:501])
+
+        asyncio.run(aupdate())
+        tree.update([ v[0] ])
+        self.assertEqual(list(tree), [ v[0] ] + v[2:])
+
+        for e in v:
+            tree.delete(e)
+
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(tree.height, 0)
+        self.assertIsNone(tree.to_tuple())
+        self.assertIsNone(tree.next_deadline())
+
+        # No hash index or sorted builds
+        for name in ('indexed', 'build_sorted', 'abuild_sorted'):
+            self.assertFalse(hasattr(tree, name))
+
+
+    def testStats(self):
+        counts = []
+
+        for cls in (cavltree.AVLTree, pyavltree.AVLTree):
+            tree = cls()
+            self.assertFalse(tree.collect_stats)
+            self.assertEqual(set(tree.stats().values()), { 0 })
+
+            samples = []
+            tree.set_stats_callback(samples.append, interval=2)
+            self.assertTrue(tree.collect_stats)
+
+            for e, expected in self.INSERT:
+                tree.insert(e)
+
+            tree.insert(self.INSERT[0][0])
+            tree.delete(self.DELETE[0][0])
+            self.assertIn(self.INSERT[0][0], tree)
+
+            stats = tree.stats()
+            self.assertEqual(stats['allocs'], len(self.INSERT))
+            self.assertEqual(stats['frees'], 1)
+            self.assertEqual(stats['updates'], len(self.INSERT) + 1)
+            self.assertGreater(stats['rotations'] + stats['double_rotations'], 0)
+            self.assertGreaterEqual(stats['comparisons'], stats['unwind'])
+            self.assertLessEqual(stats['unwind_max'], tree.height + 1)
+            self.assertEqual(len(samples), stats['updates'] // 2)
+            self.assertEqual(samples[-1]['updates'], len(samples) * 2)
+
+            tree.reset_stats()
+            self.assertEqual(set(tree.stats().values()), { 0 })
+            tree.insert(self.DELETE[0][0])
+            self.assertEqual(tree.stats()['allocs'], 1)
+
+            tree.collect_stats = False
+            self.assertEqual(set(tree.stats().values()), { 0 })
+            self.assertRaises(TypeError, tree.set_stats_callback, 1)
+            self.assertRaises(ValueError, tree.set_stats_callback, samples.append, interval=0)
+
+            # Both engines count the same
+            rng = random.Random(0)
+            tree = cls()
+            tree.collect_stats = True
+
+            for n in range(2000):
+                tree.insert(rng.randrange(500))
+                tree.delete(rng.randrange(500))
+                tree.get(rng.randrange(500))
+
+            tree.pop_until(250)
+            counts.append(tree.stats())
+
+        self.assertEqual(counts[0], counts[1])
+
+
+    def testPackage(self):
+        def run(code, backend):
+            env = dict(os.environ)
+            env.pop('AVLTREE_BACKEND', None)
+
+            if backend:
+                env['AVLTREE_BACKEND'] = backend
+
+            output = subprocess.run([sys.executable, '-c', 'import sys, avltree; ' + code], env=env,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, check=True)
+            return output.stdout.decode().split()
+
+        loaded = 'print("cavltree" in sys.modules, "pyavltree" in sys.modules)'
+
+        for backend, expected in ((None, 'c'), ('c', 'c'), ('python', 'python')):
+            self.assertEqual(run(loaded, backend), ['False', 'False'])
+            self.assertEqual(run('print(avltree.backend(), list(avltree.AVLTree([3, 1, 2]))); ' + loaded, backend),
+                             [expected, '[1,', '2,', '3]', str(expected == 'c'), str(expected == 'python')])
+
+        # Only the async bulk operations need asyncio
+        self.assertEqual(run('avltree.AVLTree; print("asyncio" in sys.modules)', 'python'), ['False'])
+
+
+    def testMapped(self):
+        def ords(t):
+            if t:
+                return (ords(t[0]), ord(t[1]), t[2], ords(t[3]))
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'tree.avl')
+
+            with cavltree.MappedTree(path) as m:
+                for e, expected in self.INSERT:
+                    m.insert(ord(e))
+                    self.assertEqual(m.to_tuple(), ords(expected))
+
+            with cavltree.MappedTree(path) as m:
+                self.assertEqual(list(m), sorted(ord(t[0]) for t in self.INSERT))
+                self.assertEqual(len(m), len(self.INSERT))
+                self.assertIn(ord('M'), m)
+                self.assertNotIn(ord('Z'), m)
+
+            for e, expected in self.DELETE:
+                path = os.path.join(d, e + '.avl')
+
+                with cavltree.MappedTree(path, (ord(t[0]) for t in self.INSERT)) as m:
+                    self.assertEqual(m.to_tuple(), ords(self.INSERT[-1][1]))
+
+                with cavltree.MappedTree(path) as m:
+                    self.assertEqual(m.delete(ord(e)), ord(e))
+                    self.assertEqual(m.to_tuple(), ords(expected))
+
+            with cavltree.MappedTree(path, [1, 2, 3]) as m:
+                it = iter(m)
+                self.assertEqual(next(it), 1)
+                m.insert(4)
+                self.assertRaises(RuntimeError, next, it)
+
+            # Not a tree, or a header with offsets outside the file
+            with open(path, 'r+b') as f:
+                f.seek(8)
+                f.write((1 << 40).to_bytes(8, sys.byteorder))
+
+            self.assertRaises(ValueError, cavltree.MappedTree, path)
+
+            # Corrupt links: outside the file, not on a node, or a cycle
+            # that would overflow the iterator's stack
+            path = os.path.join(d, 'links.avl')
+            header, node = 64, 32
+
+            for left in (1 << 40, header + 1, header):
+                with cavltree.MappedTree(path, [2, 1, 3]) as m:
+                    pass
+
+                with open(path, 'r+b') as f:
+                    f.seek(header + node + 8) # left of 1
+                    f.write(left.to_bytes(8, sys.byteorder))
+
+                with cavltree.MappedTree(path) as m:
+                    self.assertRaises(ValueError, m.__contains__, 0)
+                    self.assertRaises(ValueError, m.to_tuple)
+                    self.assertRaises(ValueError, list, m)
+                    self.assertRaises(ValueError, m.insert, 0)
+                    self.assertRaises(ValueError, m.delete, 0)
+
+                os.remove(path)
+
+            path = os.path.join(d, 'zeros')
+
+            with open(path, 'wb') as f:
+                f.write(bytes(4096))
+
+            self.assertRaises(ValueError, cavltree.MappedTree, path)
+
+
 UINT64_MAX = 2 ** 64 - 1
 
 
@@ -126,6 +664,97 @@ def insort(v: list, iterable):
         v.insert(i, e)
 
 
+class Key:
+    """
+    Element ordered by comparison methods written in Python.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+    def __lt__(self, other):
+        return self.value < other.value
+
+
+    def __gt__(self, other):
+        return self.value > other.value
+
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+    def __repr__(self):
+        return f'Key({self.value!r})'
+
+
+# Order preserving maps from 64-bit integers to key types
+KEYTYPES = {
+    'int':    int,
+    'float':  float,
+    'str':    lambda n: f'{n:016x}',
+    'bytes':  lambda n: n.to_bytes(8, 'big'),
+    'tuple':  lambda n: (n >> 32, n & 0xffffffff),
+    'object': Key,
+}
+
+
+def workload(mix: dict, source: list, count: int, scan: int, key=int):
+    """
+    Generate count operations in the proportions of mix, as tuples
+    (operation, a, b). Lookups, updates and range starts pick
+    existing elements. Ranges span about scan elements. Operations
+    are generated on the integers in source and mapped with key.
+    """
+    elements = list(set(source))
+    present = set(elements)
+    width = UINT64_MAX // max(len(elements), 1) * scan
+    ops = []
+
+    def fresh():
+        e = next(randints(1))
+
+        while e in present:
+            e = next(randints(1))
+
+        present.add(e)
+        return e
+
+    for op in random.choices(list(mix), list(mix.values()), k=count):
+        if op == 'lookup':
+            ops.append((op, random.choice(elements), None))
+
+        elif op == 'range':
+            lo = random.choice(elements)
+            ops.append((op, lo, min(lo + width, UINT64_MAX)))
+
+        elif op == 'insert':
+            e = fresh()
+            elements.append(e)
+            ops.append((op, e, None))
+
+        elif op == 'update':
+            # Replace a random element with a new one
+            i = random.randrange(len(elements))
+            old, new = elements[i], fresh()
+            present.discard(old)
+            elements[i] = new
+            ops.append((op, old, new))
+
+        else:
+            raise ValueError(f'unknown operation: {op}')
+
+    ops = [ (op, key(a), None if b is None else key(b)) for op, a, b in ops ]
+
+    return ops, sorted(map(key, elements))
+
+
 def rexp(s: str):
     """
     Parse range expression.
@@ -181,17 +810,130 @@ class Stopwatch:
         return lap
 
 
+def keyed(test):
+    """
+    Run a performance test once for each key type in KEYS, with the
+    same random integers mapped to each type.
+    """
+    @functools.wraps(test)
+    def wrapper(self):
+        for keys in self.KEYS:
+            if keys not in KEYTYPES:
+                raise ValueError(f'unknown key type: {keys}')
+
+            with self.subTest(keys=keys):
+                random.seed(os.environ.get('SEED'))
+                self.keys, self.key = keys, KEYTYPES[keys]
+                test(self)
+
+    return wrapper
+
+
+def footprint(build, source: list) -> int:
+    """
+    Bytes allocated by build(source) and still held by its result,
+    as traced by tracemalloc.
+    """
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        tree = build(source)
+        gc.collect()
+
+        return tracemalloc.get_traced_memory()[0]
+
+    finally:
+        tracemalloc.stop()
+
+
+class Histogram:
+    """
+    Latency histogram in the style of HdrHistogram. Values are
+    bucketed with SIGNIFICANT bits of precision, so a bucket is
+    within 1% of the values counted in it.
+    """
+    SIGNIFICANT = 7
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+
+    def record(self, values):
+        for v in values:
+            shift = max(v.bit_length() - self.SIGNIFICANT, 0)
+            self.counts[v >> shift << shift] += 1
+
+
+    def to_list(self) -> list:
+        """
+        Buckets as sorted [value, count] pairs.
+        """
+        return [ [ v, n ] for v, n in sorted(self.counts.items()) ]
+
+
+def timed(op, elements, sample: int) -> list:
+    """
+    Call op for each element and return the latency in nanoseconds
+    of every sample'th call.
+    """
+    clock = time.perf_counter_ns
+    ns = []
+
+    for i, e in enumerate(elements):
+        if i % sample:
+            op(e)
+        else:
+            start = clock()
+            op(e)
+            ns.append(clock() - start)
+
+    return ns
+
+
 class PerformanceTest(unittest.TestCase):
     HEIGHTS = list(rexp(os.environ.get('HEIGHTS', '5-20')))
     TRIES   = int(os.environ.get('TRIES', 5))
+    THREADS = list(rexp(os.environ.get('THREADS', '1,2,4')))
     OUTPUT  = os.environ.get('OUTPUT', '.')
-    TYPES   = [ 'list', 'functional', 'recursive', 'iterative', 'extension' ]
+    SCAN    = int(os.environ.get('SCAN', 10))
+    MIX     = os.environ.get('MIX')
+    KEYS    = os.environ.get('KEYS', 'int').split(',')
+    LATENCY = int(os.environ.get('LATENCY', 1))
+    TYPES   = [ 'list', 'functional', 'recursive', 'iterative', 'optimized', 'extension', 'persistent', 'btree', 'indexed' ]
+
+    # YCSB style workloads, percentage of each operation
+    WORKLOADS = {
+        'read-heavy':   { 'lookup': 95, 'update': 5 },
+        'update-heavy': { 'lookup': 50, 'update': 50 },
+        'scan-heavy':   { 'range': 95, 'insert': 5 },
+    }
 
 
     def setUp(self):
         random.seed(os.environ.get('SEED'))
 
 
+    def randkeys(self, cnt: int):
+        """
+        Random keys of the type under test.
+        """
+        return map(self.key, randints(cnt))
+
+
+    def dump(self, output: dict):
+        """
+        Write test output tagged with the key type. Results for int
+        keys keep the plain file name.
+        """
+        output['keys'] = self.keys
+        name = output['test'] if self.keys == 'int' else f"{output['test']}-{self.keys}"
+
+        with open(os.path.join(self.OUTPUT, f'{name}.json'), 'w') as fp:
+            json.dump(output, fp, indent=4)
+
+
+    @keyed
     def testFill(self):
         """
         Measure the time it takes to fill a tree to a given height.
@@ -220,7 +962,7 @@ class PerformanceTest(unittest.TestCase):
             for n in range(1, self.TRIES + 1):
                 logging.debug('height: %d, count: %d, try: %d', height, count, n)
 
-                source = list(randints(count))
+                source = list(self.randkeys(count))
 
                 # Built-in list
                 v = []
@@ -248,17 +990,45 @@ class PerformanceTest(unittest.TestCase):
 
                 d['iterative'].append(sw.total)
 
+                # Optimized
+                with Stopwatch() as sw:
+                    otree = pyavltree.AVLTree(source)
+
+                d['optimized'].append(sw.total)
+
                 # Extension
                 with Stopwatch() as sw:
                     etree = cavltree.AVLTree(source)
 
                 d['extension'].append(sw.total)
 
+                # Persistent
+                with Stopwatch() as sw:
+                    ptree = cavltree.PersistentTree(source)
+
+                d['persistent'].append(sw.total)
+
+                # B+tree
+                with Stopwatch() as sw:
+                    btree = cbtree.BTree(source)
+
+                d['btree'].append(sw.total)
+
+                # Indexed
+                with Stopwatch() as sw:
+                    xtree = cavltree.AVLTree(source, indexed=True)
+
+                d['indexed'].append(sw.total)
+
                 # Check correctness
                 f = list(functional.inorder(ftree))
                 r = list(rtree)
                 i = list(itree)
+                o = list(otree)
                 e = list(etree)
+                p = list(ptree)
+                b = list(btree)
+                x = list(xtree)
 
                 source = sorted(set(source))
 
@@ -266,12 +1036,16 @@ class PerformanceTest(unittest.TestCase):
                 self.assertEqual(f, source)
                 self.assertEqual(r, source)
                 self.assertEqual(i, source)
+                self.assertEqual(o, source)
                 self.assertEqual(e, source)
+                self.assertEqual(p, source)
+                self.assertEqual(b, source)
+                self.assertEqual(x, source)
 
-        with open(os.path.join(self.OUTPUT, 'fill.json'), 'w') as fp:
-            json.dump(output, fp, indent=4)
+        self.dump(output)
 
 
+    @keyed
     def testInsert(self):
         """
         First fill a tree to a given height such that the bottom
@@ -304,8 +1078,8 @@ class PerformanceTest(unittest.TestCase):
             for n in range(1, self.TRIES + 1):
                 logging.debug('height: %d, count: %d, try: %d', height, count, n)
 
-                source = list(randints(initial))
-                extend = list(randints(count))
+                source = list(self.randkeys(initial))
+                extend = list(self.randkeys(count))
 
                 # Built-in list
                 v = []
@@ -342,6 +1116,15 @@ class PerformanceTest(unittest.TestCase):
 
                 d['iterative'].append(sw.total)
 
+                # Optimized
+                otree = pyavltree.AVLTree(source)
+
+                with Stopwatch() as sw:
+                    for e in extend:
+                        otree.insert(e)
+
+                d['optimized'].append(sw.total)
+
                 # Extension
                 etree = cavltree.AVLTree(source)
 
@@ -351,11 +1134,42 @@ class PerformanceTest(unittest.TestCase):
 
                 d['extension'].append(sw.total)
 
+                # Persistent
+                ptree = cavltree.PersistentTree(source)
+
+                with Stopwatch() as sw:
+                    for e in extend:
+                        ptree = ptree.insert(e)
+
+                d['persistent'].append(sw.total)
+
+                # B+tree
+                btree = cbtree.BTree(source)
+
+                with Stopwatch() as sw:
+                    for e in extend:
+                        btree.insert(e)
+
+                d['btree'].append(sw.total)
+
+                # Indexed
+                xtree = cavltree.AVLTree(source, indexed=True)
+
+                with Stopwatch() as sw:
+                    for e in extend:
+                        xtree.insert(e)
+
+                d['indexed'].append(sw.total)
+
                 # Check correctness
                 f = list(functional.inorder(ftree))
                 r = list(rtree)
                 i = list(itree)
+                o = list(otree)
                 e = list(etree)
+                p = list(ptree)
+                b = list(btree)
+                x = list(xtree)
 
                 source = sorted(set(source + extend))
 
@@ -363,12 +1177,16 @@ class PerformanceTest(unittest.TestCase):
                 self.assertEqual(f, source)
                 self.assertEqual(r, source)
                 self.assertEqual(i, source)
+                self.assertEqual(o, source)
                 self.assertEqual(e, source)
+                self.assertEqual(p, source)
+                self.assertEqual(b, source)
+                self.assertEqual(x, source)
 
-        with open(os.path.join(self.OUTPUT, 'insert.json'), 'w') as fp:
-            json.dump(output, fp, indent=4)
+        self.dump(output)
 
 
+    @keyed
     def testDelete(self):
         """
         First fill a tree to a given height such that the bottom
@@ -401,7 +1219,7 @@ class PerformanceTest(unittest.TestCase):
             for n in range(1, self.TRIES + 1):
                 logging.debug('height: %d, count: %d, try: %d', height, count, n)
 
-                source = list(randints(initial))
+                source = list(self.randkeys(initial))
                 remove = list(choices(source, count))
 
                 # Built-in list
@@ -442,6 +1260,15 @@ class PerformanceTest(unittest.TestCase):
 
                 d['iterative'].append(sw.total)
 
+                # Optimized
+                otree = pyavltree.AVLTree(source)
+
+                with Stopwatch() as sw:
+                    for e in remove:
+                        otree.delete(e)
+
+                d['optimized'].append(sw.total)
+
                 # Extension
                 ctree = cavltree.AVLTree(source)
 
@@ -451,11 +1278,42 @@ class PerformanceTest(unittest.TestCase):
 
                 d['extension'].append(sw.total)
 
+                # Persistent
+                ptree = cavltree.PersistentTree(source)
+
+                with Stopwatch() as sw:
+                    for e in remove:
+                        ptree = ptree.delete(e)
+
+                d['persistent'].append(sw.total)
+
+                # B+tree
+                btree = cbtree.BTree(source)
+
+                with Stopwatch() as sw:
+                    for e in remove:
+                        btree.delete(e)
+
+                d['btree'].append(sw.total)
+
+                # Indexed
+                xtree = cavltree.AVLTree(source, indexed=True)
+
+                with Stopwatch() as sw:
+                    for e in remove:
+                        xtree.delete(e)
+
+                d['indexed'].append(sw.total)
+
                 # Check correctness
                 f = list(functional.inorder(ftree))
                 r = list(rtree)
                 i = list(itree)
+                o = list(otree)
                 c = list(ctree)
+                p = list(ptree)
+                b = list(btree)
+                x = list(xtree)
 
                 source.sort()
 
@@ -466,13 +1324,994 @@ class PerformanceTest(unittest.TestCase):
                 self.assertEqual(f, source)
                 self.assertEqual(r, source)
                 self.assertEqual(i, source)
+                self.assertEqual(o, source)
                 self.assertEqual(c, source)
+                self.assertEqual(p, source)
+                self.assertEqual(b, source)
+                self.assertEqual(x, source)
 
-        with open(os.path.join(self.OUTPUT, 'delete.json'), 'w') as fp:
-            json.dump(output, fp, indent=4)
+        self.dump(output)
+
+
+
+
+    @keyed
+    def testIterate(self):
+        """
+        Fill a tree to a given height, then measure the time it takes
+        to iterate over all elements.
+        """
+        result = []
+        output = {
+            'test': 'iterate',
+            'operation': 'next',
+            'types': self.TYPES,
+            'result': result
+        }
+
+        for height in self.HEIGHTS:
+            count = capacity(height)
+
+            d = {
+                'height': height,
+                'count': count
+            }
+
+            for k in output['types']:
+                d[k] = []
+
+            result.append(d)
+
+            for n in range(1, self.TRIES + 1):
+                logging.debug('height: %d, count: %d, try: %d', height, count, n)
+
+                source = list(self.randkeys(count))
+
+                v = []
+                insort(v, source)
+                ftree = functional.avltree(source)
+                rtree = recursive.AVLTree(source)
+                itree = iterative.AVLTree(source)
+                otree = pyavltree.AVLTree(source)
+                etree = cavltree.AVLTree(source)
+                ptree = cavltree.PersistentTree(source)
+                btree = cbtree.BTree(source)
+                xtree = cavltree.AVLTree(source, indexed=True)
+
+                # Built-in list
+                with Stopwatch() as sw:
+                    l = list(v)
+
+                d['list'].append(sw.total)
+
+                # Functional
+                with Stopwatch() as sw:
+                    f = list(functional.inorder(ftree))
+
+                d['functional'].append(sw.total)
+
+                # Recursive
+                with Stopwatch() as sw:
+                    r = list(rtree)
+
+                d['recursive'].append(sw.total)
+
+                # Iterative
+                with Stopwatch() as sw:
+                    i = list(itree)
+
+                d['iterative'].append(sw.total)
+
+                # Optimized
+                with Stopwatch() as sw:
+                    o = list(otree)
+
+                d['optimized'].append(sw.total)
+
+                # Extension
+                with Stopwatch() as sw:
+                    e = list(etree)
+
+                d['extension'].append(sw.total)
+
+                # Persistent
+                with Stopwatch() as sw:
+                    p = list(ptree)
+
+                d['persistent'].append(sw.total)
+
+                # B+tree
+                with Stopwatch() as sw:
+                    b = list(btree)
+
+                d['btree'].append(sw.total)
+
+                # Indexed
+                with Stopwatch() as sw:
+                    x = list(xtree)
+
+                d['indexed'].append(sw.total)
+
+                # Check correctness
+                source = sorted(set(source))
+
+                self.assertEqual(l, source)
+                self.assertEqual(f, source)
+                self.assertEqual(r, source)
+                self.assertEqual(i, source)
+                self.assertEqual(o, source)
+                self.assertEqual(e, source)
+                self.assertEqual(p, source)
+                self.assertEqual(b, source)
+                self.assertEqual(x, source)
+
+        self.dump(output)
+
+
+    @keyed
+    def testLookup(self):
+        """
+        Fill a tree to a given height, then measure the time it takes
+        to look up as many elements as there are in the bottom layer.
+        """
+        result = []
+        output = {
+            'test': 'lookup',
+            'operation': 'lookup',
+            'types': self.TYPES,
+            'result': result
+        }
+
+        for height in self.HEIGHTS:
+            count = layer(height)
+
+            d = {
+                'height': height,
+                'count': count
+            }
+
+            for k in output['types']:
+                d[k] = []
+
+            result.append(d)
+
+            for n in range(1, self.TRIES + 1):
+                logging.debug('height: %d, count: %d, try: %d', height, count, n)
+
+                source = list(self.randkeys(capacity(height)))
+                lookup = list(choices(source, count))
+
+                v = []
+                insort(v, source)
+                ftree = functional.avltree(source)
+                rtree = recursive.AVLTree(source)
+                itree = iterative.AVLTree(source)
+                otree = pyavltree.AVLTree(source)
+                etree = cavltree.AVLTree(source)
+                ptree = cavltree.PersistentTree(source)
+                btree = cbtree.BTree(source)
+                xtree = cavltree.AVLTree(source, indexed=True)
+
+                # Built-in list
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        i = bisect.bisect_left(v, e)
+                        found = i < len(v) and v[i] == e
+
+                d['list'].append(sw.total)
+
+                # Functional
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = functional.contains(ftree, e)
+
+                d['functional'].append(sw.total)
+
+                # Recursive
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = e in rtree
+
+                d['recursive'].append(sw.total)
+
+                # Iterative
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = e in itree
+
+                d['iterative'].append(sw.total)
+
+                # Optimized
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = e in otree
+
+                d['optimized'].append(sw.total)
+
+                # Extension
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = e in etree
+
+                d['extension'].append(sw.total)
+
+                # Persistent
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = e in ptree
+
+                d['persistent'].append(sw.total)
+
+                # B+tree
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = e in btree
+
+                d['btree'].append(sw.total)
+
+                # Indexed
+                with Stopwatch() as sw:
+                    for e in lookup:
+                        found = e in xtree
+
+                d['indexed'].append(sw.total)
+
+                # Check correctness
+                for e in lookup[:100]:
+                    self.assertTrue(functional.contains(ftree, e))
+                    self.assertIn(e, rtree)
+                    self.assertIn(e, itree)
+                    self.assertIn(e, otree)
+                    self.assertIn(e, etree)
+                    self.assertIn(e, ptree)
+                    self.assertIn(e, btree)
+                    self.assertIn(e, xtree)
+
+        self.dump(output)
+
+
+    @keyed
+    def testRange(self):
+        """
+        Fill a tree to a given height, then measure the time it takes
+        to run as many range queries as there are elements in the
+        bottom layer, each returning SCAN elements.
+        """
+        result = []
+        output = {
+            'test': 'range',
+            'operation': 'range',
+            'types': self.TYPES,
+            'result': result
+        }
+
+        for height in self.HEIGHTS:
+            count = layer(height)
+
+            d = {
+                'height': height,
+                'count': count
+            }
+
+            for k in output['types']:
+                d[k] = []
+
+            result.append(d)
+
+            for n in range(1, self.TRIES + 1):
+                logging.debug('height: %d, count: %d, try: %d', height, count, n)
+
+                source = list(self.randkeys(capacity(height)))
+
+                v = []
+                insort(v, source)
+                ftree = functional.avltree(source)
+                rtree = recursive.AVLTree(source)
+                itree = iterative.AVLTree(source)
+                otree = pyavltree.AVLTree(source)
+                etree = cavltree.AVLTree(source)
+                ptree = cavltree.PersistentTree(source)
+                btree = cbtree.BTree(source)
+                xtree = cavltree.AVLTree(source, indexed=True)
+
+                # [lo, hi) bounds with up to SCAN elements in between
+                ranges = []
+
+                for i in (random.randrange(len(v)) for _ in range(count)):
+                    ranges.append((v[i], v[i + self.SCAN] if i + self.SCAN < len(v) else None))
+
+                # Built-in list
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        l = v[bisect.bisect_left(v, lo):len(v) if hi is None else bisect.bisect_left(v, hi)]
+
+                d['list'].append(sw.total)
+
+                # Functional
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        f = list(functional.inorder(ftree, lo, hi))
+
+                d['functional'].append(sw.total)
+
+                # Recursive
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        r = list(rtree.range(lo, hi))
+
+                d['recursive'].append(sw.total)
+
+                # Iterative
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        i = list(itree.range(lo, hi))
+
+                d['iterative'].append(sw.total)
+
+                # Optimized
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        o = list(otree.range(lo, hi))
+
+                d['optimized'].append(sw.total)
+
+                # Extension
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        e = list(etree.range(lo, hi))
+
+                d['extension'].append(sw.total)
+
+                # Persistent
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        p = list(ptree.range(lo, hi))
+
+                d['persistent'].append(sw.total)
+
+                # B+tree
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        b = list(btree.range(lo, hi))
+
+                d['btree'].append(sw.total)
+
+                # Indexed
+                with Stopwatch() as sw:
+                    for lo, hi in ranges:
+                        x = list(xtree.range(lo, hi))
+
+                d['indexed'].append(sw.total)
+
+                # Check correctness, last query
+                self.assertEqual(f, l)
+                self.assertEqual(r, l)
+                self.assertEqual(i, l)
+                self.assertEqual(o, l)
+                self.assertEqual(e, l)
+                self.assertEqual(p, l)
+                self.assertEqual(b, l)
+                self.assertEqual(x, l)
+
+        self.dump(output)
+
+
+    @keyed
+    def testPopMin(self):
+        """
+        First fill a tree to a given height such that the bottom
+        layer is half full, then measure the time it takes to
+        remove the smallest element until it is quarter full.
+        """
+        result = []
+        output = {
+            'test': 'popmin',
+            'operation': 'pop',
+            'types': self.TYPES,
+            'result': result
+        }
+
+        for height in self.HEIGHTS:
+            bottom = layer(height)
+            initial = capacity(height - 1) + (bottom // 2)
+            count = bottom // 4
+
+            d = {
+                'height': height,
+                'count': count
+            }
+
+            for k in output['types']:
+                d[k] = []
+
+            result.append(d)
+
+            for n in range(1, self.TRIES + 1):
+                logging.debug('height: %d, count: %d, try: %d', height, count, n)
+
+                source = list(self.randkeys(initial))
+
+                # Built-in list
+                v = []
+                insort(v, source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        v.pop(0)
+
+                d['list'].append(sw.total)
+
+                # Functional
+                ftree = functional.avltree(source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        e, ftree = functional.leftmost(ftree)
+
+                d['functional'].append(sw.total)
+
+                # Recursive
+                rtree = recursive.AVLTree(source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        rtree.delete(next(iter(rtree)))
+
+                d['recursive'].append(sw.total)
+
+                # Iterative
+                itree = iterative.AVLTree(source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        itree.delete(next(iter(itree)))
+
+                d['iterative'].append(sw.total)
+
+                # Optimized
+                otree = pyavltree.AVLTree(source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        otree.delete(next(iter(otree)))
+
+                d['optimized'].append(sw.total)
+
+                # Extension
+                etree = cavltree.AVLTree(source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        etree.delete(next(iter(etree)))
+
+                d['extension'].append(sw.total)
+
+                # Persistent
+                ptree = cavltree.PersistentTree(source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        ptree = ptree.delete(next(iter(ptree)))
+
+                d['persistent'].append(sw.total)
+
+                # B+tree
+                btree = cbtree.BTree(source)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        btree.delete(next(iter(btree)))
+
+                d['btree'].append(sw.total)
+
+                # Indexed
+                xtree = cavltree.AVLTree(source, indexed=True)
+
+                with Stopwatch() as sw:
+                    for _ in range(count):
+                        xtree.delete(next(iter(xtree)))
+
+                d['indexed'].append(sw.total)
+
+                # Check correctness
+                f = list(functional.inorder(ftree))
+                r = list(rtree)
+                i = list(itree)
+                o = list(otree)
+                e = list(etree)
+                p = list(ptree)
+                b = list(btree)
+                x = list(xtree)
+
+                source = sorted(set(source))[count:]
+
+                self.assertEqual(v, source)
+                self.assertEqual(f, source)
+                self.assertEqual(r, source)
+                self.assertEqual(i, source)
+                self.assertEqual(o, source)
+                self.assertEqual(e, source)
+                self.assertEqual(p, source)
+                self.assertEqual(b, source)
+                self.assertEqual(x, source)
+
+        self.dump(output)
+
+
+    @keyed
+    def testMixed(self):
+        """
+        First fill a tree to a given height such that the bottom
+        layer is half full, then measure the time it takes to run
+        as many operations as there are elements in the bottom layer,
+        mixed as in WORKLOADS, or as in MIX if given, e.g.
+        MIX=lookup=90,range=5,update=5.
+        """
+        if self.MIX:
+            workloads = { 'custom': { k: int(v) for k, v in (e.split('=') for e in self.MIX.split(',')) } }
+        else:
+            workloads = self.WORKLOADS
+
+        for name, mix in workloads.items():
+            result = []
+            output = {
+                'test': f'mixed-{name}',
+                'operation': 'op',
+                'types': self.TYPES,
+                'result': result
+            }
+
+            for height in self.HEIGHTS:
+                bottom = layer(height)
+                initial = capacity(height - 1) + (bottom // 2)
+                count = bottom
+
+                d = {
+                    'height': height,
+                    'count': count
+                }
+
+                for k in output['types']:
+                    d[k] = []
+
+                result.append(d)
+
+                for n in range(1, self.TRIES + 1):
+                    logging.debug('workload: %s, height: %d, count: %d, try: %d', name, height, count, n)
+
+                    raw = list(randints(initial))
+                    source = list(map(self.key, raw))
+                    ops, expected = workload(mix, raw, count, self.SCAN, self.key)
+
+                    # Built-in list
+                    v = []
+                    insort(v, source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                i = bisect.bisect_left(v, a)
+                                found = i < len(v) and v[i] == a
+                            elif op == 'range':
+                                l = v[bisect.bisect_left(v, a):bisect.bisect_left(v, b)]
+                            elif op == 'insert':
+                                bisect.insort(v, a)
+                            else:
+                                del v[bisect.bisect_left(v, a)]
+                                bisect.insort(v, b)
+
+                    d['list'].append(sw.total)
+
+                    # Functional
+                    ftree = functional.avltree(source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = functional.contains(ftree, a)
+                            elif op == 'range':
+                                l = list(functional.inorder(ftree, a, b))
+                            elif op == 'insert':
+                                ftree = functional.insert(ftree, a)
+                            else:
+                                ftree = functional.insert(functional.delete(ftree, a), b)
+
+                    d['functional'].append(sw.total)
+
+                    # Recursive
+                    rtree = recursive.AVLTree(source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = a in rtree
+                            elif op == 'range':
+                                l = list(rtree.range(a, b))
+                            elif op == 'insert':
+                                rtree.insert(a)
+                            else:
+                                rtree.delete(a)
+                                rtree.insert(b)
+
+                    d['recursive'].append(sw.total)
+
+                    # Iterative
+                    itree = iterative.AVLTree(source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = a in itree
+                            elif op == 'range':
+                                l = list(itree.range(a, b))
+                            elif op == 'insert':
+                                itree.insert(a)
+                            else:
+                                itree.delete(a)
+                                itree.insert(b)
+
+                    d['iterative'].append(sw.total)
+
+                    # Optimized
+                    otree = pyavltree.AVLTree(source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = a in otree
+                            elif op == 'range':
+                                l = list(otree.range(a, b))
+                            elif op == 'insert':
+                                otree.insert(a)
+                            else:
+                                otree.delete(a)
+                                otree.insert(b)
+
+                    d['optimized'].append(sw.total)
+
+                    # Extension
+                    etree = cavltree.AVLTree(source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = a in etree
+                            elif op == 'range':
+                                l = list(etree.range(a, b))
+                            elif op == 'insert':
+                                etree.insert(a)
+                            else:
+                                etree.delete(a)
+                                etree.insert(b)
+
+                    d['extension'].append(sw.total)
+
+                    # Persistent
+                    ptree = cavltree.PersistentTree(source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = a in ptree
+                            elif op == 'range':
+                                l = list(ptree.range(a, b))
+                            elif op == 'insert':
+                                ptree = ptree.insert(a)
+                            else:
+                                ptree = ptree.delete(a).insert(b)
+
+                    d['persistent'].append(sw.total)
+
+                    # B+tree
+                    btree = cbtree.BTree(source)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = a in btree
+                            elif op == 'range':
+                                l = list(btree.range(a, b))
+                            elif op == 'insert':
+                                btree.insert(a)
+                            else:
+                                btree.delete(a)
+                                btree.insert(b)
+
+                    d['btree'].append(sw.total)
+
+                    # Indexed
+                    xtree = cavltree.AVLTree(source, indexed=True)
+
+                    with Stopwatch() as sw:
+                        for op, a, b in ops:
+                            if op == 'lookup':
+                                found = a in xtree
+                            elif op == 'range':
+                                l = list(xtree.range(a, b))
+                            elif op == 'insert':
+                                xtree.insert(a)
+                            else:
+                                xtree.delete(a)
+                                xtree.insert(b)
+
+                    d['indexed'].append(sw.total)
+
+                    # Check correctness
+                    self.assertEqual(v, expected)
+                    self.assertEqual(list(functional.inorder(ftree)), expected)
+                    self.assertEqual(list(rtree), expected)
+                    self.assertEqual(list(itree), expected)
+                    self.assertEqual(list(otree), expected)
+                    self.assertEqual(list(etree), expected)
+                    self.assertEqual(list(ptree), expected)
+                    self.assertEqual(list(btree), expected)
+                    self.assertEqual(list(xtree), expected)
+
+            self.dump(output)
+
+
+    def operations(self, source: list) -> dict:
+        """
+        Trees of each type filled with source, as tuples of insert,
+        lookup and delete functions and a function listing the
+        elements in order.
+        """
+        v = []
+        insort(v, source)
+        ftree = functional.avltree(source)
+        rtree = recursive.AVLTree(source)
+        itree = iterative.AVLTree(source)
+        otree = pyavltree.AVLTree(source)
+        etree = cavltree.AVLTree(source)
+        ptree = cavltree.PersistentTree(source)
+        btree = cbtree.BTree(source)
+        xtree = cavltree.AVLTree(source, indexed=True)
+
+        def linsert(e):
+            bisect.insort(v, e)
+
+        def llookup(e):
+            i = bisect.bisect_left(v, e)
+            return i < len(v) and v[i] == e
+
+        def ldelete(e):
+            del v[bisect.bisect_left(v, e)]
+
+        def finsert(e):
+            nonlocal ftree
+            ftree = functional.insert(ftree, e)
+
+        def flookup(e):
+            return functional.contains(ftree, e)
+
+        def fdelete(e):
+            nonlocal ftree
+            ftree = functional.delete(ftree, e)
+
+        def pinsert(e):
+            nonlocal ptree
+            ptree = ptree.insert(e)
+
+        def plookup(e):
+            return e in ptree
+
+        def pdelete(e):
+            nonlocal ptree
+            ptree = ptree.delete(e)
+
+        return {
+            'list':       (linsert, llookup, ldelete, lambda: v),
+            'functional': (finsert, flookup, fdelete, lambda: list(functional.inorder(ftree))),
+            'recursive':  (rtree.insert, rtree.__contains__, rtree.delete, lambda: list(rtree)),
+            'iterative':  (itree.insert, itree.__contains__, itree.delete, lambda: list(itree)),
+            'optimized':  (otree.insert, otree.__contains__, otree.delete, lambda: list(otree)),
+            'extension':  (etree.insert, etree.__contains__, etree.delete, lambda: list(etree)),
+            'persistent': (pinsert, plookup, pdelete, lambda: list(ptree)),
+            'btree':      (btree.insert, btree.__contains__, btree.delete, lambda: list(btree)),
+            'indexed':    (xtree.insert, xtree.__contains__, xtree.delete, lambda: list(xtree)),
+        }
+
+
+    @keyed
+    def testLatency(self):
+        """
+        First fill a tree to one less than a given height, then
+        measure the latency of each operation while inserting,
+        looking up and deleting the elements of the bottom layer.
+        Every LATENCY'th operation is timed and the latencies are
+        kept in histograms.
+        """
+        outputs = {}
+
+        for operation in ('insert', 'lookup', 'delete'):
+            outputs[operation] = {
+                'test': f'latency-{operation}',
+                'operation': operation,
+                'types': self.TYPES,
+                'sample': self.LATENCY,
+                'result': []
+            }
+
+        for height in self.HEIGHTS:
+            initial = capacity(height - 1)
+            count = layer(height)
+            histograms = {}
+
+            for operation, output in outputs.items():
+                d = {
+                    'height': height,
+                    'count': count
+                }
+
+                for k in output['types']:
+                    d[k] = Histogram()
+
+                output['result'].append(d)
+                histograms[operation] = d
+
+            for n in range(1, self.TRIES + 1):
+                logging.debug('height: %d, count: %d, try: %d', height, count, n)
+
+                source = list(self.randkeys(initial))
+                extend = list(self.randkeys(count))
+                operations = self.operations(source)
+
+                for k in self.TYPES:
+                    insert, lookup, delete, elements = operations[k]
+
+                    histograms['insert'][k].record(timed(insert, extend, self.LATENCY))
+                    histograms['lookup'][k].record(timed(lookup, extend, self.LATENCY))
+
+                    # Check correctness
+                    self.assertEqual(elements(), sorted(set(source + extend)))
+
+                    histograms['delete'][k].record(timed(delete, extend, self.LATENCY))
+
+                    self.assertEqual(elements(), sorted(set(source)))
+
+            for d in histograms.values():
+                for k in self.TYPES:
+                    d[k] = d[k].to_list()
+
+        for output in outputs.values():
+            self.dump(output)
+
+
+    @keyed
+    def testMemory(self):
+        """
+        Measure the memory it takes to hold a tree of a given height,
+        not counting the elements themselves. The C module allocates
+        nodes with PyMem_RawCalloc, which tracemalloc traces too.
+        """
+        result = []
+        output = {
+            'test': 'memory',
+            'operation': 'memory',
+            'types': self.TYPES,
+            'measure': 'memory',
+            'result': result
+        }
+
+        def sortedlist(source):
+            v = []
+            insort(v, source)
+            return v
+
+        build = {
+            'list':       sortedlist,
+            'functional': functional.avltree,
+            'recursive':  recursive.AVLTree,
+            'iterative':  iterative.AVLTree,
+            'optimized':  pyavltree.AVLTree,
+            'extension':  cavltree.AVLTree,
+            'persistent': cavltree.PersistentTree,
+            'btree':      cbtree.BTree,
+            'indexed':    functools.partial(cavltree.AVLTree, indexed=True),
+        }
+
+        for height in self.HEIGHTS:
+            count = capacity(height)
+
+            d = {
+                'height': height,
+                'count': count
+            }
+
+            for k in output['types']:
+                d[k] = []
+
+            result.append(d)
+
+            for n in range(1, self.TRIES + 1):
+                logging.debug('height: %d, count: %d, try: %d', height, count, n)
+
+                source = list(self.randkeys(count))
+
+                for k in self.TYPES:
+                    d[k].append(footprint(build[k], source))
+
+                # Check correctness
+                for k in self.TYPES:
+                    self.assertGreaterEqual(d[k][-1], count * 8)
+
+        self.dump(output)
+
+
+    @keyed
+    def testConcurrent(self):
+        """
+        Fill a tree to a given height, then measure the time it takes
+        for a number of threads to look up all elements while another
+        thread keeps inserting and deleting elements.
+        """
+        result = []
+        output = {
+            'test': 'concurrent',
+            'operation': 'lookup',
+            'types': [ f'readers-{n}' for n in self.THREADS ],
+            'result': result
+        }
+
+        for height in self.HEIGHTS:
+            count = capacity(height)
+
+            d = {
+                'height': height,
+                'count': count
+            }
+
+            for k in output['types']:
+                d[k] = []
+
+            result.append(d)
+
+            for n in range(1, self.TRIES + 1):
+                logging.debug('height: %d, count: %d, try: %d', height, count, n)
+
+                source = list(self.randkeys(count))
+                etree = cavltree.AVLTree(source)
+
+                for threads, k in zip(self.THREADS, output['types']):
+                    done = threading.Event()
+                    found = []
+
+                    def write():
+                        while not done.is_set():
+                            for e in self.randkeys(64):
+                                etree.insert(e)
+                                etree.delete(e)
+
+                    def read(v):
+                        found.append(sum(1 for e in v if e in etree))
+
+                    writer = threading.Thread(target=write)
+                    readers = [ threading.Thread(target=read, args=(source[i::threads],))
+                                for i in range(threads) ]
+
+                    writer.start()
+
+                    with Stopwatch() as sw:
+                        for t in readers:
+                            t.start()
+
+                        for t in readers:
+                            t.join()
+
+                    done.set()
+                    writer.join()
+
+                    d[k].append(sw.total)
+
+                    # Check correctness
+                    self.assertEqual(sum(found), count)
+                    self.assertEqual(list(etree), sorted(set(source)))
+
+        self.dump(output)
 
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)-15s %(levelname)s: %(message)s',
                         level='DEBUG', stream=sys.stderr)
+    logging.getLogger('asyncio').setLevel('WARNING')
     unittest.main()